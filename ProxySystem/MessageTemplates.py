@@ -54,6 +54,13 @@ model_response_read = {
 	}
 }
 
+# a feature collection in the upserts, checked without its features when only the envelope of a message is validated (see ProxyFS.createMessageFromTemplate)
+model_upsert_collection = {
+	"id": unicode,
+	"type": (u'FeatureCollection',),
+	"features": list
+}
+
 model_request_write = {
 	"token": unicode,
 	"message_type": [u'request',],
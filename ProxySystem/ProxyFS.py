@@ -14,14 +14,24 @@ import time
 import proxy_lock
 import sys
 import os
+import zlib
+import threading
 
 from errors import *
 import proxy_config_core as conf
 import proxy_core
+import proxy_diff
+import proxy_manifest
+import proxy_client
+import proxy_journal
+import proxy_json
+import proxy_metrics
+import proxy_log
 import MarconiLabsTools.ArDiVa
 
 """
 This module is called when a change happens in the filesystem (specifically in the upload directory, but the proxy checks anyway in case the fs monitor cannot filter before informing the proxy)
+The same entry point (handleFSChange) is used by the persistent daemon in proxy_daemon, which keeps a single warm process for all the events
 """
 
 def handleFSChange (eventpath):
@@ -40,61 +50,57 @@ def handleFSChange (eventpath):
 	eventpath = os.path.realpath(eventpath)
 	uploadpath = os.path.realpath(conf.baseuploadpath)
 	if not eventpath.startswith(uploadpath):
-		# if the event is not in a subdir of $upload we simply ignore it and exit
-		sys.exit(0)
+		# if the event is not in a subdir of $upload we simply ignore it
+		return
 
 	# otherwise we start the actual file update handling process
 	try:
-		handleFileEvent(eventpath)
+		with proxy_metrics.trace("event", path=eventpath):
+			handleFileEvent(eventpath)
 	except Exception as issue:
-		#TODO: add actual mailing code, decide how to log normal events
-		logEvent (issue, True)
+		# the proxy is taken from the path, as the verification may be what failed
+		proxy_id = os.path.relpath(eventpath, uploadpath).split(os.sep)[0]
+		if proxy_id in (os.curdir, os.pardir) or not os.path.isdir(os.path.join(conf.baseproxypath, proxy_id)):
+			proxy_id = None
+		logEvent (issue, True, proxy_id)
 
 
 
-def logEvent (eventdata, iserror=False):
+def logEvent (eventdata, iserror=False, proxy_id=None):
 	"""
 	Logs a standard event. Events are logged to file only, errors to file AND mail.
+	Both are done in background by proxy_log, so logging never blocks the event handling
 	:param eventdata: message
 	:param iserror: boolean, if the event is an error/exception
+	:param proxy_id: the proxy the event is about, None if unknown
 	:return:
 	"""
 	ctime = time.time()
-	currentdatetime = time.strftime("%Y-%m-%dT%H:%M:%SZ", ctime)
+	currentdatetime = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(ctime))
 	eventstring = "%d %s %s" % (int(ctime*1000), currentdatetime, eventdata)
 
-	#TODO: see if we can handle more gracefully issues in the file logging itself
-	try:
-		logToFile(eventstring)
-	except:
-		eventstring += "; FAILED TO LOG TO FILE"
+	logToFile(eventstring, proxy_id)
 
-	try:
+	if iserror:
 		logToMail(eventstring)
-	except:
-		pass
 
 
-def logToFile (message):
+def logToFile (message, proxy_id=None):
 	"""
-	Appends the message to the FSproxy logfile
+	Queues the message for the log file of the proxy, or for the general FSproxy logfile if the proxy is not known
 	:param message:
+	:param proxy_id:
 	:return:
 	"""
-	#TODO: remove filename placeholder, see if we can suggest different files from the ProxyFS module (proxy_id is actually determined further down in the process)
-	logfile = os.path.join (conf.log_folder, "proxyops.log")
-	fp = open(logfile,"a")
-	fp.write("\n"+message)
-	fp.close()
+	proxy_log.getLogWriter().log(message, proxy_id)
 
 def logToMail (message):
 	"""
-	Sends the message via mail to the proxy-set recipients
+	Queues the message for the error mail to the proxy admins (rate limited, see proxy_log)
 	:param message:
 	:return:
 	"""
-	#TODO: PLACEHOLDER, IMPLEMENT
-	pass
+	proxy_log.getLogWriter().mail(message)
 
 def handleFileEvent (eventpath):
 	"""
@@ -109,7 +115,9 @@ def handleFileEvent (eventpath):
 	# we detect what has actually changed.
 	# It MUST be a zip file or somebody is messing with the dir structure and we must exit and warn about it
 
-	proxy_id, meta_id, shape_id = proxy_core.verifyUpdateStructure(eventpath)
+	with proxy_metrics.span("verify"):
+		proxy_id, meta_id, shape_id = proxy_core.verifyUpdateStructure(eventpath)
+	proxy_metrics.setTraceLabels(proxy=proxy_id, meta=meta_id, shape=shape_id)
 
 	locker = proxy_lock.ProxyLocker (retries=3, wait=5)
 
@@ -122,23 +130,32 @@ def handleFileEvent (eventpath):
 	elif zipfile.is_zipfile(eventpath):
 		# upsert
 		#proxy_core.handleUpsert (proxy_id, meta_id, shape_id)
-		locker.performLocked(proxy_core.handleUpsert, proxy_id, meta_id, shape_id)
+		with proxy_metrics.span("extract"):
+			archivehash = locker.performLocked(proxy_core.handleUpsert, proxy_id, meta_id, shape_id)
+		if archivehash is None:
+			# same content as the current mirror data: nothing to convert, replicate or send
+			proxy_metrics.count("uploads", result="unchanged")
+			logEvent ("Upload of %s/%s on proxy %s has not changed, skipped" % (meta_id, shape_id, proxy_id), False, proxy_id)
+			return
 		upsert = (shape_id,)
 	else:
 		# wrong file type or directory creation
 		raise InvalidFSOperationException ("Unexpected file type or operation on path %s" % eventpath)
 
 	if upsert is not None:
-		shapedata = proxy_core.rebuildShape(proxy_id, meta_id, shape_id, modified=True)
+		shapedata = proxy_core.rebuildShape(proxy_id, meta_id, shape_id, modified=True, archivehash=archivehash)
 		#proxy_core.replicateShapeData (shapedata, proxy_id, meta_id, shape_id, modified=True)
-		locker.performLocked(proxy_core.replicateShapeData, shapedata, proxy_id, meta_id, shape_id, modified=True)
+		with proxy_metrics.span("replicate"):
+			locker.performLocked(proxy_core.replicateShapeData, shapedata, proxy_id, meta_id, shape_id, modified=True, archivehash=archivehash)
 	else:
 		# this is a delete
 		#proxy_core.replicateDelete (proxy_id, meta_id, shape_id)
-		locker.performLocked(proxy_core.replicateDelete, proxy_id, meta_id, shape_id)
+		with proxy_metrics.span("replicate"):
+			locker.performLocked(proxy_core.replicateDelete, proxy_id, meta_id, shape_id)
 
 	#no need of locking for this, since it simply adds/updates a file to the /next dir
-	proxy_core.queueForSend(proxy_id, meta_id)
+	with proxy_metrics.span("queue"):
+		proxy_core.queueForSend(proxy_id, meta_id)
 
 	#TODO: if the server is a write/full server, we launch the server update process
 
@@ -153,87 +170,409 @@ def gatherUpdatesForSend (proxy_id):
 	#TODO: placeholder, implement; note that right now it does too little to make it worth separating it from sendUpdatesToMain
 
 
-def sendMessageToServer (jsonmessage):
+def sendMessageToServer (messagefactory, compressed=True):
+	"""
+	Sends a json message to the main server and returns its response if the response code is correct
+	:param messagefactory: callable returning the (gzip compressed) json message as an iterable of byte strings, sent as a chunked request body; called again for each retry (see proxy_client)
+	:param compressed: True if the chunks are gzip compressed
+	:return: dict, the json response of the main server; None on failure
+	"""
+
+	# the shared client keeps the connections alive between messages and retries with backoff (see proxy_client)
+	try:
+		return proxy_client.getClient().sendMessage(messagefactory, compressed)
+	except Exception as issue:
+		logEvent ("Failed to send message to main server: %s" % issue, True)
+		return None
+
+
+def iterCompressedJson (message):
+	"""
+	Serializes a message to gzip compressed json as a sequence of chunks, so neither the full json string nor the full compressed payload is ever built in memory
+	The ArrayStreams in the message (features of the diffs and of the geojson files) are read while the message is compressed, see proxy_json
+	:param message: dict
+	:return: generator of byte strings
+	"""
+
+	compressor = zlib.compressobj(conf.send_compression_level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+	for fragment in proxy_json.iterChunks(proxy_json.iterEncode(message)):
+		if not isinstance(fragment, bytes):
+			fragment = fragment.encode('utf-8')
+		compressed = compressor.compress(fragment)
+		if compressed:
+			proxy_metrics.count("bytes", len(compressed), kind="sent")
+			yield compressed
+
+	compressed = compressor.flush()
+	proxy_metrics.count("bytes", len(compressed), kind="sent")
+	yield compressed
+
+
+def isMetaAcknowledged (response, meta_id, meta_upserts, meta_deletes):
+	"""
+	Checks if a response_write acknowledges all the data sent for a meta: the meta must be in the acknowledged upserts, or, if it carried deletes only, all of them must be in the acknowledged deletes
+	:param response: dict, model_response_write message
+	:param meta_id:
+	:param meta_upserts: list of feature collections sent for the meta
+	:param meta_deletes: list of feature ids deleted in the meta
+	:return: boolean
+	"""
+
+	try:
+		acknowledge = response['acknowledge']
+	except (KeyError, TypeError):
+		return False
+
+	if len(meta_upserts) > 0:
+		return meta_id in acknowledge.get('upsert', [])
+
+	acked_deletes = set(acknowledge.get('delete', []))
+	return all(delete_id in acked_deletes for delete_id in meta_deletes)
+
+
+# ArDiVa models of the message templates, compiled on first use: template id -> (template, model)
+messagemodels = {}
+# the cache is shared by the threads of the daemon; the models themselves are only read once compiled, so the messages are filled without holding the lock
+messagemodels_lock = threading.Lock()
+
+def getMessageModel (template):
+	"""
+	Returns the ArDiVa model of a template, compiling it only the first time
+	:param template: one of the models of MessageTemplates
+	:return: MarconiLabsTools.ArDiVa.Model
+	"""
+
+	with messagemodels_lock:
+		try:
+			return messagemodels[id(template)][1]
+		except KeyError:
+			pass
+
+		messagemodel = MarconiLabsTools.ArDiVa.Model(template)
+		# the template is kept referenced with its model, so its id cannot be reused by another object
+		messagemodels[id(template)] = (template, messagemodel)
+		return messagemodel
+
+
+def checkUpsertCollection (collection, proxy_id, meta_id):
 	"""
-	Sends a json message to the main server and returns success if the response code is correct
-	:param jsonmessage:
-	:return: True/False on success/failure
+	Validates a feature collection of data.upsert on MessageTemplates.model_upsert_collection without walking its features: id, type and the presence of the features are checked
+	:param collection: dict, its features a list or an ArrayStream
+	:param proxy_id:
+	:param meta_id:
+	:return: the collection, exception if it fails validation
 	"""
 
-	#TODO: placeholder, implement, note that cannot be async if we want to keep the full comm cycle in this one only; should we also keep the full response from the other server?
+	if not isinstance(collection, dict) or any(key not in collection for key in ("id", "type", "features")):
+		raise RuntimeProxyException ("Failed to create valid message for proxy %s: non valid feature collection in meta %s" % (proxy_id, meta_id))
+	if not isinstance(collection['features'], (list, proxy_json.ArrayStream)):
+		raise RuntimeProxyException ("Failed to create valid message for proxy %s: non valid features in collection %s of meta %s" % (proxy_id, collection['id'], meta_id))
+
+	filledok, filled = getMessageModel(MessageTemplates.model_upsert_collection).fillSafely(id=collection['id'], type=collection['type'], features=[])
+	if filledok is not True:
+		raise RuntimeProxyException ("Failed to create valid message for proxy %s: non valid feature collection %s in meta %s" % (proxy_id, collection['id'], meta_id))
+
+	return collection
 
 
-def createMessageFromTemplate (template, **customfields):
+class CheckedCollections ():
 	"""
-	Sends a json message to the main server and returns success if the response code is correct
+	Feature collections of a meta streamed in data.upsert (see createReadResponse), each validated with checkUpsertCollection when the message is serialized; re-iterable if its source is
+	"""
+
+	def __init__ (self, collections, proxy_id, meta_id):
+		self.collections = collections
+		self.proxy_id = proxy_id
+		self.meta_id = meta_id
+
+	def __iter__ (self):
+		for collection in self.collections:
+			yield checkUpsertCollection(collection, self.proxy_id, self.meta_id)
+
+
+def createMessageFromTemplate (template, envelopeonly=None, **customfields):
+	"""
+	Creates a message from a template, filling it with the custom fields and validating the result on the template
 	:param template: the model, must be ArDiVa.Model compliant
+	:param envelopeonly: if True the features in data.upsert are not walked by the validation, only the feature collections are checked (see checkUpsertCollection); defaults to conf.validate_envelope_only
 	:param customfields: a dict with all the custom data to be added to the model
 	:return: dictionary message ready for json.dumps, exception if the modified messge fails validation on the template
 	"""
 
 	#NOTE: should we keep proxy_id explicit in the message creation (for the purpose of logging)?
 
-	messagemodel = MarconiLabsTools.ArDiVa.Model(template)
+	if envelopeonly is None:
+		envelopeonly = conf.validate_envelope_only
 
-	filledok, requestmsg = messagemodel.fillSafely(**customfields)
+	# the upserts can hold all the features of the proxy: the message is validated with an empty dict of the same type in their place, their collections are checked on their own model and put back in the filled message
+	upsert = None
+	data = customfields.get('data')
+	if envelopeonly and isinstance(data, dict) and 'upsert' in data:
+		if not isinstance(data['upsert'], dict):
+			raise RuntimeProxyException ("Failed to create valid message for proxy %s: upsert data is not a dict" % customfields['token'])
+		upsert = {}
+		for meta_id, collections in data['upsert'].items():
+			if isinstance(collections, proxy_json.ArrayStream):
+				# streamed metas are checked one collection at a time while serialized
+				upsert[meta_id] = proxy_json.ArrayStream(CheckedCollections(collections.items, customfields['token'], meta_id))
+			elif isinstance(collections, list):
+				upsert[meta_id] = [checkUpsertCollection(collection, customfields['token'], meta_id) for collection in collections]
+			else:
+				raise RuntimeProxyException ("Failed to create valid message for proxy %s: upsert data of meta %s is not a list" % (customfields['token'], meta_id))
+		customfields['data'] = dict(data)
+		customfields['data']['upsert'] = {}
+
+	filledok, requestmsg = getMessageModel(template).fillSafely(**customfields)
 
 	if filledok is True:
+		if upsert is not None:
+			requestmsg['data']['upsert'] = upsert
 		return requestmsg
 	else:
 		raise RuntimeProxyException ("Failed to create valid Write Request message for proxy %s" % customfields['token'])
 
 
-def sendUpdatesToMain (proxy_id):
+# query types supported by the proxy: inventory and time from the summaries of proxy_summary, geographic (bounding boxes only) from the indexes of proxy_spatial
+QUERY_SUPPORT = {
+	"inventory": "full",
+	"time": "full",
+	"geographic": "BB"
+}
+
+def createCapabilitiesMessage (proxy_id):
 	"""
-	Sends the updates for a specific soft-proxy to the main server according to the list of updates. This is the version for Request Write with updates only
+	Creates the response_capabilities message of a soft proxy from its manifest
 	:param proxy_id:
+	:return: dictionary message ready for json.dumps
+	"""
+
+	manifest = proxy_manifest.getManifest(proxy_id)
+
+	operations = dict(manifest['operations'])
+	# the queries answered from the indexes kept by the replication, unless disabled in the manifest
+	query = dict(operations.get('query', {}))
+	for querytype, support in QUERY_SUPPORT.items():
+		if query.get(querytype) != "none":
+			query[querytype] = support
+	operations['query'] = query
+	operations['signs'] = manifest['signs']
+	operations['metadata'] = manifest['metadata']
+
+	customfields = {
+		"base_url": manifest['base_url'],
+		"area": manifest['area'],
+		"time": manifest['time'],
+		"operations": operations
+	}
+
+	return createMessageFromTemplate(MessageTemplates.model_response_capabilities, token=proxy_id, **customfields)
+
+
+def createReadResponse (proxy_id, metas=None):
+	"""
+	Creates a response_read (full) message with all the data of a soft proxy. The features are not read here: the message streams them from the geojson files when serialized (see iterCompressedJson), one feature at a time
+	:param proxy_id:
+	:param metas: list of meta_ids to include, None for all the metas in the manifest
+	:return: dictionary message, to be serialized once with proxy_json.iterEncode
+	"""
+
+	if metas is None:
+		metas = [currentmeta['name'] for currentmeta in proxy_manifest.getManifest(proxy_id)['metadata']]
+
+	locker = proxy_lock.ProxyLocker (retries=3, wait=5)
+
+	# the geojson files are linked under lock, so each meta is a consistent snapshot; they are opened one at a time while the message is serialized
+	meta_dict = {}
+	for meta_id in metas:
+		meta_dict[meta_id] = proxy_json.ArrayStream(locker.performLocked(proxy_core.iterMetaJson, proxy_id, meta_id))
+
+	customfields = {
+		"operation": "full",
+		"data": {
+			"upsert": meta_dict,
+			"delete": []
+		}
+	}
+
+	return createMessageFromTemplate(MessageTemplates.model_response_read, token=proxy_id, **customfields)
+
+
+def sendUpdatesToMain (proxy_id, metas=None):
+	"""
+	Sends the updates for a specific soft-proxy to the main server according to the list of updates. This is the version for Request Write with updates only: for each updated meta only the features added, changed or deleted since the latest successful send are transmitted (see proxy_diff)
+	:param proxy_id:
+	:param metas: list of meta_ids to send, None to send all the updated metas (see proxy_sender for the scheduling)
 	:return: tuple boolean/string (true/false, list of updates for logging/errors)
 	"""
 
-	# each meta is listed with its time of latest modification
-	updateslist = []
-	updatespath = os.path.join(conf.baseproxypath,proxy_id,"next")
-	for cupdate in os.listdir(updatespath):
-		updateslist.append((cupdate, os.path.getmtime(os.path.join(updatespath, cupdate))))
+	# the claim is a snapshot of the update journal: updates recorded from now on have higher sequence numbers and are not cleared by this send
+	journal = proxy_journal.getJournal(proxy_id)
+	claimseq, updateslist = journal.claim(metas)
 
 
 	locker = proxy_lock.ProxyLocker (retries=3, wait=5)
 
+	# the claimed diffs are split in parts of about conf.send_batch_bytes of data (a large meta gives several parts, see proxy_diff.splitMetaDiff) and the parts are grouped in batches of about the same size; each batch is a separate request_write, acknowledged on its own
+	# a meta is cleared only once all its parts are acknowledged: if one fails the whole meta is sent again with the next send (upserts and deletes can be repeated safely)
+	batches = []
+	batch = []
+	batchsize = 0
+	partcounts = {}
+	for meta_id in updateslist:
+		try:
+			known = proxy_manifest.hasMeta(proxy_id, meta_id)
+			problem = "is not in its manifest"
+		except (InvalidProxyException, InternalProxyException) as ex:
+			known = False
+			problem = "cannot be checked against its manifest (%s)" % ex
+		if not known:
+			#the meta has been removed from the manifest after the update, or the manifest is not valid; its updates stay in the journal for the admin to check, retried with a backoff and reported only when first found and when given up
+			attempts = journal.recordFailure(meta_id)
+			if attempts == 1:
+				logEvent ("Meta %s in the updates list of proxy %s %s" % (meta_id, proxy_id, problem), True, proxy_id)
+			reportGivenUp(proxy_id, meta_id, attempts)
+			continue
+		# claiming moves the pending diffs out of the way of new replications, so they can be read without holding the lock
+		locker.performLocked(proxy_diff.claimMetaDiff, proxy_id, meta_id)
+		parts = proxy_diff.splitMetaDiff(proxy_id, meta_id, conf.send_batch_bytes)
+		if len(parts) == 0:
+			# nothing left to send (e.g. the features changed back), the update is still acknowledged
+			parts = [(0, [])]
+		partcounts[meta_id] = len(parts)
+
+		for partsize, ranges in parts:
+			# a batch carries at most one part of each meta
+			if len(batch) > 0 and (batchsize + partsize > conf.send_batch_bytes or meta_id in [item[0] for item in batch]):
+				batches.append(batch)
+				batch = []
+				batchsize = 0
+			batch.append((meta_id, ranges))
+			batchsize += partsize
+
+	if len(batch) > 0:
+		batches.append(batch)
+
+	sentlist = []
+	failedlist = []
+	for batch in batches:
+		# the remaining parts of a meta that already failed would be sent again anyway
+		batch = [item for item in batch if item[0] not in failedlist]
+		if len(batch) == 0:
+			continue
+		batchmetas = [meta_id for meta_id, ranges in batch]
+		try:
+			with proxy_metrics.trace("send", proxy=proxy_id, metas=batchmetas):
+				acknowledged = sendUpdatesBatch(proxy_id, batch)
+		except Exception as ex:
+			# e.g. a message failing validation, counted as a failed send of its metas so they are retried with a backoff
+			logEvent ("Could not send updates for proxy %s (metas: %s): %s" % (proxy_id, batchmetas, ex), False, proxy_id)
+			acknowledged = []
+			# sent again one meta at a time, so a meta that cannot be sent does not hold back the others of its batch
+			if len(batch) > 1:
+				for item in batch:
+					try:
+						with proxy_metrics.trace("send", proxy=proxy_id, metas=[item[0]]):
+							acknowledged.extend(sendUpdatesBatch(proxy_id, [item]))
+					except Exception as ex:
+						logEvent ("Could not send updates for proxy %s (meta: %s): %s" % (proxy_id, item[0], ex), False, proxy_id)
+		completed = []
+		for meta_id in batchmetas:
+			if meta_id not in acknowledged:
+				failedlist.append(meta_id)
+				continue
+			partcounts[meta_id] -= 1
+			if partcounts[meta_id] == 0:
+				completed.append(meta_id)
+		completeMetas(proxy_id, completed, claimseq)
+		sentlist.extend(completed)
+
+	# the first failure of a meta is reported as an error, the following ones are only logged until it is given up
+	firstfailure = False
+	for meta_id in failedlist:
+		attempts = journal.recordFailure(meta_id)
+		firstfailure = firstfailure or attempts == 1
+		reportGivenUp(proxy_id, meta_id, attempts)
+
+	journal.compact()
+
+	if len(failedlist) == 0:
+		logEvent ("Sent updates for proxy %s to main server (metas: %s)" % (proxy_id, sentlist), False, proxy_id)
+		return True, sentlist
+	else:
+		#the journal entries of the failed metas are left as they are and their claimed diffs are merged into the next send
+		logEvent ("Failed to send updates for proxy %s (metas: %s)" % (proxy_id, failedlist), firstfailure, proxy_id)
+		return False, failedlist
+
+
+def reportGivenUp (proxy_id, meta_id, attempts):
+	"""
+	Logs, once, that a meta will not be sent again automatically after its latest failed send (see proxy_journal.isGivenUp)
+	:param proxy_id:
+	:param meta_id:
+	:param attempts: number of consecutive failed sends of the meta
+	:return:
+	"""
+
+	if proxy_journal.isGivenUp(attempts) and not proxy_journal.isGivenUp(attempts - 1):
+		logEvent ("Updates of meta %s of proxy %s not sent after %d attempts, they stay in the journal until the meta is updated again" % (meta_id, proxy_id, attempts), True, proxy_id)
+
+
+def sendUpdatesBatch (proxy_id, batch):
+	"""
+	Sends a request_write with the claimed diffs of a batch of metas, or of parts of them
+	:param proxy_id:
+	:param batch: list of (meta_id, ranges) tuples, ranges as in the parts of proxy_diff.splitMetaDiff (None for all the claimed diffs of the meta)
+	:return: list of meta_ids whose data in the batch has been acknowledged
+	"""
+
 	meta_dict = {}
-	for meta_id, timestamp in updateslist:
-		meta_dict [meta_id] = locker.performLocked(proxy_core.assembleMetaJson, proxy_id, meta_id)
+	meta_deletes = {}
+	deletes = []
+	for meta_id, ranges in batch:
+		meta_dict [meta_id], meta_deletes [meta_id] = proxy_diff.assembleMetaDiff(proxy_id, meta_id, ranges)
+		deletes.extend(meta_deletes[meta_id])
 
 	template = MessageTemplates.model_request_write
 	customfields = {
 		"data": {
-			"upserts" : meta_dict,
-			"delete" : []
+			"upsert" : meta_dict,
+			"delete" : deletes
 		}
 	}
 
 	requestmsg = createMessageFromTemplate(template, token=proxy_id, **customfields)
 
-	#TODO: actual implementation of message transmission handling, right now we only have an empty function call
-	send_success = sendMessageToServer(json.dumps(requestmsg))
+	# the message is serialized and compressed while it is sent, so this span covers both; a retry serializes it again, reading the features from the diff files again
+	with proxy_metrics.span("send"):
+		response = sendMessageToServer(lambda: iterCompressedJson(requestmsg), compressed=True)
 
-	if send_success:
-		#proceed to clean up the /next directory from meta that has not received other modifications, log the success with the list of metas sent
+	acknowledged = []
+	if response is None:
+		return acknowledged
 
-		for cupdate in os.listdir(updatespath):
-			# we remove only the entries that have not received additional updates from the time of sending; we check if the tuple filename/updatetime is in the updates list we created at the start of the process
+	for meta_id, ranges in batch:
+		if isMetaAcknowledged(response, meta_id, meta_dict[meta_id], meta_deletes[meta_id]):
+			acknowledged.append(meta_id)
 
-			if (cupdate, os.path.getmtime(os.path.join(updatespath, cupdate))) in updateslist:
-				#TODO: choose final exception handling in case something removed the files before us: currently we are ignoring it, logging and going on
-				try:
-					os.remove(os.path.join(updatespath,cupdate))
-				except:
-					logEvent ("Failed to remove meta %s from the updates list of proxy %s" % (cupdate, proxy_id), True)
+	return acknowledged
 
-		logEvent ("Sent updates for proxy %s to main server", False)
 
-	else:
-		#leave the /next listing as is and log the failure as issue
-		logEvent ("Failed to send updates for proxy %s (meta/timestamp list: %s)" % (proxy_id, updateslist), True)
+def completeMetas (proxy_id, meta_ids, claimseq):
+	"""
+	Clears the claimed diffs and the journal entries of the metas whose data has been fully acknowledged by the main server
+	:param proxy_id:
+	:param meta_ids:
+	:param claimseq: journal sequence number of the claim (see proxy_journal)
+	:return:
+	"""
+
+	for meta_id in meta_ids:
+		#the claimed diffs have been received, new ones may have been added in the meantime and are still pending
+		proxy_diff.clearMetaDiff(proxy_id, meta_id)
+
+	# only the updates up to the claim are removed, the ones recorded during the send stay pending
+	proxy_journal.getJournal(proxy_id).acknowledge(meta_ids, claimseq)
 
 
 
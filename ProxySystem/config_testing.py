@@ -9,6 +9,10 @@ UPLOADPATH = "./tests/uploads/"
 
 PROXYADMIN_MAIL = "avaccarino@labs.it"
 
+# local SMTP stand-in for the error mails, e.g. python -m smtpd -n -c DebuggingServer localhost:8025
+SMTP_HOST = "localhost"
+SMTP_PORT = 8025
+
 METADATA_FAKE = {
 	'name' : 'mapfile01',
 	'desc' : 'default testing map',
@@ -31,6 +31,10 @@ class InvalidFSOperationException (RuntimeProxyException):
 class InvalidShapeArchiveException (RuntimeProxyException):
 	pass
 
+# When a query message has non valid parameters
+class InvalidQueryException (RuntimeProxyException):
+	pass
+
 
 # wrapper class for failingsin the internal structure of the proxy (missing directories where they are expected to be etc)
 # When these exceptions are encountered an administrator should stop the proxy operations and fix or rebuild its filesystem and configuration structures
@@ -0,0 +1,476 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+__author__ = 'Antonio Vaccarino'
+__docformat__ = 'restructuredtext en'
+
+import os
+import sys
+import json
+import time
+import math
+import struct
+import random
+import shutil
+import zipfile
+import argparse
+import datetime
+import tempfile
+
+try:
+	import resource
+except ImportError:
+	resource = None
+
+import config_testing
+import proxy_config_core as conf
+import proxy_core
+import proxy_lock
+import proxy_json
+import proxy_metrics
+
+"""
+Benchmark of the upload-to-replicate pipeline of ProxyFS.handleFileEvent.
+Synthetic shapefile archives (polygons or points, with a configurable number of features, vertices and attributes) are uploaded to a throwaway hpinstance/uploads tree laid out as the one of config_testing, then each stage of the event handling is timed separately: verifyUpdateStructure, handleUpsert, rebuildShape, convert, replicateShapeData and queueForSend. The first run creates the shape, the following ones re-upload it with a fraction of the features changed.
+rebuildShape only opens the datasource (or the conversion cache entry of an archive uploaded before, see proxy_cache), the features are converted while replicateShapeData writes them: the time spent producing them is timed by replicateShapeData itself (proxy_metrics.timeIterator, the instrumentation is enabled for the benchmark) and reported as the convert stage, the rest as replicateShapeData.
+The results, with the peak RSS of the process after each stage, are written as json so they can be compared between releases:
+
+	python proxy_benchmark.py --features 100000 --vertices 32 --attributes 12 --runs 3 --output results.json
+"""
+
+STAGES = ("verifyUpdateStructure", "handleUpsert", "rebuildShape", "convert", "replicateShapeData", "queueForSend")
+
+BENCHMARK_PROXY = "benchmark"
+BENCHMARK_SHAPE = "synthetic"
+
+SHAPE_POINT = 1
+SHAPE_POLYGON = 5
+
+# dbf fields of the synthetic attributes, in rotation: (type, length, decimals)
+ATTRIBUTE_FIELDS = (
+	("C", 32, 0),
+	("N", 10, 0),
+	("N", 18, 6)
+)
+
+
+def getPeakRss ():
+	"""
+	Peak resident set size of the process
+	:return: kilobytes, None where the resource module is not available
+	"""
+
+	if resource is None:
+		return None
+	peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+	# bytes on mac os, kilobytes elsewhere
+	if sys.platform == "darwin":
+		peak = peak // 1024
+	return peak
+
+
+def getFeatureVersion (seed, fid, run, changed):
+	"""
+	Last run in which a feature has been changed, so the archives of the runs differ only in the changed features
+	:param seed:
+	:param fid:
+	:param run:
+	:param changed: fraction of the features changed at each run
+	:return: int
+	"""
+
+	for version in range (run, 0, -1):
+		if random.Random("%s-%s-%s" % (seed, fid, version)).random() < changed:
+			return version
+	return 0
+
+
+def createFeature (seed, fid, version, vertices, attributes):
+	"""
+	Generates the geometry and the attributes of a synthetic feature
+	:param seed:
+	:param fid:
+	:param version: see getFeatureVersion, changes the attributes and moves the geometry
+	:param vertices: vertices of the polygon, 0 for points
+	:param attributes: number of attributes besides the date
+	:return: tuple (list of (x, y) points, list of attribute values)
+	"""
+
+	rng = random.Random("%s-%s-%s" % (seed, fid, version))
+
+	x = rng.uniform(-170.0, 170.0)
+	y = rng.uniform(-80.0, 80.0)
+	if vertices == 0:
+		points = [(x, y)]
+	else:
+		radius = rng.uniform(0.001, 0.1)
+		# outer rings are clockwise in shapefiles
+		points = []
+		for i in range (0, vertices):
+			angle = -2.0 * math.pi * i / vertices
+			points.append((x + radius * math.cos(angle), y + radius * math.sin(angle)))
+		points.append(points[0])
+
+	values = [(datetime.date(2012, 1, 1) + datetime.timedelta(days=rng.randint(0, 3650))).strftime("%Y%m%d")]
+	for i in range (0, attributes):
+		fieldtype, length, decimals = ATTRIBUTE_FIELDS[i % len(ATTRIBUTE_FIELDS)]
+		if fieldtype == "C":
+			value = "value %d of feature %d" % (rng.randint(0, 999), fid)
+			values.append(value.ljust(length)[:length])
+		elif decimals == 0:
+			values.append(("%d" % rng.randint(-99999, 999999)).rjust(length))
+		else:
+			values.append(("%.*f" % (decimals, rng.uniform(-1000.0, 1000.0))).rjust(length))
+
+	return points, values
+
+
+def getDbfFields (attributes):
+	"""
+	Field descriptors of the synthetic attributes, with a date field first so the features are indexed by time
+	:param attributes:
+	:return: list of (name, type, length, decimals)
+	"""
+
+	fields = [("date", "D", 8, 0)]
+	for i in range (0, attributes):
+		fieldtype, length, decimals = ATTRIBUTE_FIELDS[i % len(ATTRIBUTE_FIELDS)]
+		fields.append(("attr%d" % i, fieldtype, length, decimals))
+	return fields
+
+
+def packShpHeader (shapetype, filelength, bounds):
+
+	header = struct.pack(">7i", 9994, 0, 0, 0, 0, 0, filelength // 2)
+	header += struct.pack("<2i", 1000, shapetype)
+	header += struct.pack("<8d", bounds[0], bounds[1], bounds[2], bounds[3], 0.0, 0.0, 0.0, 0.0)
+	return header
+
+
+def packShape (shapetype, points):
+
+	if shapetype == SHAPE_POINT:
+		return struct.pack("<i2d", SHAPE_POINT, points[0][0], points[0][1])
+
+	xs = [point[0] for point in points]
+	ys = [point[1] for point in points]
+	content = struct.pack("<i4d2i", SHAPE_POLYGON, min(xs), min(ys), max(xs), max(ys), 1, len(points))
+	content += struct.pack("<i", 0)
+	for point in points:
+		content += struct.pack("<2d", point[0], point[1])
+	return content
+
+
+def writeShapefile (path_base, features, seed, run, changed, vertices, attributes):
+	"""
+	Writes a synthetic shapefile (.shp, .shx and .dbf). The features are generated one at a time, so the size of the shapefile is not bound by memory
+	:param path_base: path of the shapefile without extension
+	:param features: number of features
+	:param seed:
+	:param run: benchmark run, see getFeatureVersion
+	:param changed: fraction of the features changed at each run
+	:param vertices: vertices of each polygon, 0 for points
+	:param attributes:
+	:return:
+	"""
+
+	shapetype = SHAPE_POINT if vertices == 0 else SHAPE_POLYGON
+	fields = getDbfFields(attributes)
+	recordlength = 1 + sum(field[2] for field in fields)
+
+	shp_fp = open(path_base + ".shp", 'wb')
+	shx_fp = open(path_base + ".shx", 'wb')
+	dbf_fp = open(path_base + ".dbf", 'wb')
+	try:
+		# the headers are rewritten with the sizes and bounds at the end
+		shp_fp.write(b"\x00" * 100)
+		shx_fp.write(b"\x00" * 100)
+
+		today = datetime.date.today()
+		dbf_fp.write(struct.pack("<4BIHH20x", 3, today.year - 1900, today.month, today.day, features, 32 * len(fields) + 33, recordlength))
+		for name, fieldtype, length, decimals in fields:
+			dbf_fp.write(struct.pack("<11sc4xBB14x", name.encode('ascii'), fieldtype.encode('ascii'), length, decimals))
+		dbf_fp.write(b"\x0d")
+
+		offset = 100
+		bounds = [float("inf"), float("inf"), float("-inf"), float("-inf")]
+		for fid in range (0, features):
+			points, values = createFeature(seed, fid, getFeatureVersion(seed, fid, run, changed), vertices, attributes)
+			for x, y in points:
+				bounds = [min(bounds[0], x), min(bounds[1], y), max(bounds[2], x), max(bounds[3], y)]
+
+			content = packShape(shapetype, points)
+			shp_fp.write(struct.pack(">2i", fid + 1, len(content) // 2))
+			shp_fp.write(content)
+			shx_fp.write(struct.pack(">2i", offset // 2, len(content) // 2))
+			offset += 8 + len(content)
+
+			dbf_fp.write(b" " + "".join(values).encode('ascii'))
+
+		dbf_fp.write(b"\x1a")
+
+		if features == 0:
+			bounds = [0.0, 0.0, 0.0, 0.0]
+		shp_fp.seek(0)
+		shp_fp.write(packShpHeader(shapetype, offset, bounds))
+		shx_fp.seek(0)
+		shx_fp.write(packShpHeader(shapetype, 100 + 8 * features, bounds))
+	finally:
+		for fp in (shp_fp, shx_fp, dbf_fp):
+			fp.close()
+
+
+def createArchive (path_zip, shape_id, features, seed=0, run=0, changed=0.1, vertices=16, attributes=8, path_temp=None):
+	"""
+	Creates a synthetic shapefile archive, as uploaded to the proxy
+	:param path_zip: path of the archive
+	:param shape_id: name of the shapefile in the archive
+	:param features: number of features
+	:param seed:
+	:param run: benchmark run, see getFeatureVersion
+	:param changed: fraction of the features changed at each run
+	:param vertices: vertices of each polygon, 0 for points
+	:param attributes: number of attributes besides the date
+	:param path_temp: where the shapefile is written before being archived, defaults to the system temporary directory
+	:return: size of the archive in bytes
+	"""
+
+	path_work = tempfile.mkdtemp(prefix="shape", dir=path_temp)
+	try:
+		writeShapefile(os.path.join(path_work, shape_id), features, seed, run, changed, vertices, attributes)
+		path_new = path_zip + ".tmp"
+		zipfp = zipfile.ZipFile(path_new, 'w', zipfile.ZIP_DEFLATED, allowZip64=True)
+		try:
+			for extension in (".shp", ".shx", ".dbf"):
+				zipfp.write(os.path.join(path_work, shape_id + extension), shape_id + extension)
+		finally:
+			zipfp.close()
+		# the upload appears complete, as for a real upload
+		os.rename(path_new, path_zip)
+	finally:
+		shutil.rmtree(path_work)
+
+	return os.path.getsize(path_zip)
+
+
+def setupInstance (path_root, proxy_id, meta_id):
+	"""
+	Creates a throwaway hpinstance/uploads tree with a single proxy, and points the configuration to it
+	:param path_root: base directory of the tree
+	:param proxy_id:
+	:param meta_id:
+	:return: upload directory of the meta
+	"""
+
+	conf.baseproxypath = os.path.join(path_root, "hpinstance")
+	conf.baseuploadpath = os.path.join(path_root, "uploads")
+	conf.log_folder = os.path.join(path_root, "logs")
+	conf.conversion_cache_folder = os.path.join(path_root, "convcache")
+	# the convert stage is read from the aggregates of the instrumentation, no trace is exported
+	conf.metrics_enabled = True
+	conf.metrics_exporters = []
+
+	path_proxy = os.path.join(conf.baseproxypath, proxy_id)
+	for path in (
+		os.path.join(path_proxy, os.path.dirname(conf.path_manifest)),
+		os.path.join(path_proxy, conf.path_mirror, meta_id),
+		os.path.join(path_proxy, conf.path_geojson, meta_id),
+		os.path.join(conf.baseuploadpath, proxy_id, meta_id),
+		conf.log_folder
+	):
+		os.makedirs(path)
+
+	manifest = dict(config_testing.MANIFEST_PRE)
+	manifest['metadata'] = [dict(config_testing.METADATA_FAKE, name=meta_id)]
+	manifest_fp = open(os.path.join(path_proxy, conf.path_manifest), 'w')
+	try:
+		json.dump(manifest, manifest_fp)
+	finally:
+		manifest_fp.close()
+
+	return os.path.join(conf.baseuploadpath, proxy_id, meta_id)
+
+
+def timeStage (timings, stage, function, *args, **kwargs):
+
+	started = time.time()
+	result = function(*args, **kwargs)
+	timings[stage] = {
+		"seconds": time.time() - started,
+		"peak_rss_kb": getPeakRss()
+	}
+	return result
+
+
+def getConvertSeconds ():
+	"""
+	Total time spent so far producing the features of the replicated shapes, as timed by replicateShapeData
+	:return: seconds
+	"""
+
+	stages, counters = proxy_metrics.registry.getSnapshot()
+	return stages.get("convert", (0, 0.0, 0.0))[1]
+
+
+def runEvent (eventpath):
+	"""
+	Handles the upload of a shape archive as ProxyFS.handleFileEvent does, timing each stage
+	:param eventpath: path of the uploaded archive
+	:return: tuple (dict of stage timings, replication stats, None if the upload has been skipped as unchanged)
+	"""
+
+	timings = {}
+	locker = proxy_lock.ProxyLocker (retries=3, wait=5)
+
+	proxy_id, meta_id, shape_id = timeStage(timings, "verifyUpdateStructure", proxy_core.verifyUpdateStructure, eventpath)
+	archivehash = timeStage(timings, "handleUpsert", locker.performLocked, proxy_core.handleUpsert, proxy_id, meta_id, shape_id)
+	if archivehash is None:
+		# the later stages are skipped, as in handleFileEvent
+		for stage in STAGES[2:]:
+			timings[stage] = {
+				"seconds": 0.0,
+				"peak_rss_kb": getPeakRss()
+			}
+		return timings, None
+
+	shapedata = timeStage(timings, "rebuildShape", proxy_core.rebuildShape, proxy_id, meta_id, shape_id, modified=True, archivehash=archivehash)
+	converted = getConvertSeconds()
+	diffstats = timeStage(timings, "replicateShapeData", locker.performLocked, proxy_core.replicateShapeData, shapedata, proxy_id, meta_id, shape_id, modified=True, archivehash=archivehash)
+	# the features are produced while replicateShapeData consumes them
+	timings["convert"] = {
+		"seconds": getConvertSeconds() - converted,
+		"peak_rss_kb": timings["replicateShapeData"]["peak_rss_kb"]
+	}
+	timings["replicateShapeData"]["seconds"] -= timings["convert"]["seconds"]
+	timeStage(timings, "queueForSend", proxy_core.queueForSend, proxy_id, meta_id)
+
+	return timings, diffstats
+
+
+def summarizeRuns (runs):
+	"""
+	Min, median and max of the time of each stage over the runs after the first one (the first run creates the shape, see runBenchmark)
+	:param runs: list of run results
+	:return: dict stage -> dict
+	"""
+
+	summary = {}
+	updates = runs[1:] or runs
+	for stage in STAGES + ("total",):
+		values = sorted(run['stages'][stage]['seconds'] if stage != "total" else run['total_seconds'] for run in updates)
+		middle = len(values) // 2
+		median = values[middle] if len(values) % 2 == 1 else (values[middle-1] + values[middle]) / 2.0
+		summary[stage] = {
+			"min": values[0],
+			"median": median,
+			"max": values[-1]
+		}
+	return summary
+
+
+def runBenchmark (features=10000, vertices=16, attributes=8, runs=3, changed=0.1, seed=0, path_root=None, keep=False):
+	"""
+	Runs the benchmark in a throwaway tree. The first run uploads a new shape, each following run uploads it again with a fraction of its features changed
+	:param features: number of features of the shape
+	:param vertices: vertices of each polygon, 0 for points
+	:param attributes: number of attributes besides the date
+	:param runs: number of uploads
+	:param changed: fraction of the features changed at each run after the first
+	:param seed: seed of the synthetic data
+	:param path_root: directory where the throwaway tree is created, defaults to the system temporary directory
+	:param keep: if True the tree is not removed at the end
+	:return: dict with the parameters and the results, json serializable
+	"""
+
+	path_tree = tempfile.mkdtemp(prefix="proxybenchmark", dir=path_root)
+	meta_id = config_testing.METADATA_FAKE['name']
+
+	results = {
+		"parameters": {
+			"features": features,
+			"vertices": vertices,
+			"attributes": attributes,
+			"runs": runs,
+			"changed": changed,
+			"seed": seed
+		},
+		"environment": {
+			"python": sys.version.split()[0],
+			"platform": sys.platform,
+			"json_backend": proxy_json.backend,
+			"upsert_from_archive": conf.upsert_from_archive
+		},
+		"runs": []
+	}
+
+	try:
+		path_upload = setupInstance(path_tree, BENCHMARK_PROXY, meta_id)
+		eventpath = os.path.join(path_upload, BENCHMARK_SHAPE + ".zip")
+
+		for run in range (0, runs):
+			# generating the archive is not part of the timings
+			started = time.time()
+			archivesize = createArchive(eventpath, BENCHMARK_SHAPE, features, seed, run, changed, vertices, attributes, path_tree)
+			generated = time.time() - started
+
+			started = time.time()
+			timings, diffstats = runEvent(eventpath)
+			total = time.time() - started
+
+			path_gj = os.path.join(conf.baseproxypath, BENCHMARK_PROXY, conf.path_geojson, meta_id, BENCHMARK_SHAPE)
+			results['runs'].append({
+				"run": run,
+				"archive_bytes": archivesize,
+				"geojson_bytes": os.path.getsize(path_gj),
+				"generation_seconds": generated,
+				"stages": timings,
+				"total_seconds": total,
+				"features_per_second": features / total if total > 0 else None,
+				"diff": diffstats
+			})
+
+		results['summary'] = summarizeRuns(results['runs'])
+		results['peak_rss_kb'] = getPeakRss()
+	finally:
+		if keep:
+			results['path'] = path_tree
+		else:
+			shutil.rmtree(path_tree, ignore_errors=True)
+
+	return results
+
+
+def main (argv=None):
+
+	parser = argparse.ArgumentParser(description="Benchmark of the upload-to-replicate pipeline on synthetic shapefiles")
+	parser.add_argument("--features", type=int, default=10000, help="features of the synthetic shape")
+	parser.add_argument("--vertices", type=int, default=16, help="vertices of each polygon, 0 for points")
+	parser.add_argument("--attributes", type=int, default=8, help="attributes of each feature besides the date")
+	parser.add_argument("--runs", type=int, default=3, help="uploads of the shape, the first creates it")
+	parser.add_argument("--changed", type=float, default=0.1, help="fraction of the features changed at each run after the first")
+	parser.add_argument("--seed", type=int, default=0)
+	parser.add_argument("--tmpdir", default=None, help="where the throwaway tree is created")
+	parser.add_argument("--keep", action="store_true", help="keep the throwaway tree")
+	parser.add_argument("--output", default=None, help="json file for the results, stdout if missing")
+	args = parser.parse_args(argv)
+
+	if args.runs < 1:
+		parser.error("at least one run is needed")
+	if args.vertices != 0 and args.vertices < 3:
+		parser.error("polygons need at least 3 vertices")
+
+	results = runBenchmark(args.features, args.vertices, args.attributes, args.runs, args.changed, args.seed, args.tmpdir, args.keep)
+
+	if args.output is None:
+		json.dump(results, sys.stdout, indent=2, sort_keys=True)
+		sys.stdout.write("\n")
+	else:
+		output_fp = open(args.output, 'w')
+		try:
+			json.dump(results, output_fp, indent=2, sort_keys=True)
+		finally:
+			output_fp.close()
+
+
+if __name__ == "__main__":
+	main()
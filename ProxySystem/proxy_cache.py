@@ -0,0 +1,291 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+__author__ = 'Antonio Vaccarino'
+__docformat__ = 'restructuredtext en'
+
+import os
+import time
+import json
+import sqlite3
+import hashlib
+import tempfile
+import threading
+
+from errors import *
+import proxy_config_core as conf
+import proxy_json
+import proxy_publish
+
+"""
+Persistent cache of the shape conversions, shared by all the proxies of the hard proxy ($conversion_cache_folder).
+An entry holds the converted features of a shape ("fid<TAB>geojson" lines, as the part files of proxy_convert) and is keyed by the content hash of the shape files, so a shape is converted by OGR only once for each content. The uploads are keyed by the hash of their archive, computed anyway to skip unchanged uploads (see proxy_core.rebuildShape), so the hits come from contents uploaded before: an archive uploaded again after another version, or the same data uploaded to several metas or proxies. Shape directories are hashed as proxy_core.hashArchive does for the archives, and the hashes remembered with the size and mtime of the files they come from: a directory is hashed again only when one of its files changes.
+The entries are written while the features of a conversion are consumed (see ConversionCache.storeFeatures) and listed in an SQLite index with their size and last use; when the cache exceeds conf.conversion_cache_bytes the least recently used entries are removed.
+"""
+
+# part of the entry keys: changes of the conversion output must not reuse older entries
+CACHE_FORMAT = 3
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (
+	key TEXT PRIMARY KEY,
+	bytes INTEGER NOT NULL,
+	lastused REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS entries_lastused ON entries (lastused);
+CREATE TABLE IF NOT EXISTS sources (
+	path TEXT PRIMARY KEY,
+	signature TEXT NOT NULL,
+	hash TEXT NOT NULL
+);
+"""
+
+
+def listShapeFiles (path_dir):
+	return sorted(filename for filename in os.listdir(path_dir) if os.path.isfile(os.path.join(path_dir, filename)))
+
+
+def getFilesSignature (path_dir):
+	"""
+	Name, size and mtime of the files of a shape directory
+	:param path_dir:
+	:return: string
+	"""
+
+	signature = []
+	for filename in listShapeFiles(path_dir):
+		stat = os.stat(os.path.join(path_dir, filename))
+		signature.append((filename, stat.st_size, stat.st_mtime))
+	return json.dumps(signature)
+
+
+def hashShapeFiles (path_dir):
+	"""
+	Content hash of the files of a shape directory, same as the hash of an archive holding the same files (see proxy_core.hashArchive)
+	:param path_dir:
+	:return: hex string
+	"""
+
+	digest = hashlib.sha1()
+	for filename in listShapeFiles(path_dir):
+		path_file = os.path.join(path_dir, filename)
+		header = "%s\0%d\0" % (filename, os.path.getsize(path_file))
+		if not isinstance(header, bytes):
+			header = header.encode('utf-8')
+		digest.update(header)
+		fp = open(path_file, 'rb')
+		try:
+			while True:
+				chunk = fp.read(1024*1024)
+				if not chunk:
+					break
+				digest.update(chunk)
+		finally:
+			fp.close()
+
+	return digest.hexdigest()
+
+
+class ConversionCache ():
+	"""
+	Conversion cache of the process. Safe to share between threads, and between processes through SQLite locking and the atomic publishing of the entries
+	"""
+
+	def __init__ (self, path=None, maxbytes=None):
+
+		if path is None:
+			path = conf.conversion_cache_folder
+		if maxbytes is None:
+			maxbytes = conf.conversion_cache_bytes
+
+		self.path = path
+		self.maxbytes = maxbytes
+		if not os.path.exists(path):
+			os.makedirs(path)
+
+		self.lock = threading.Lock()
+		self.connection = sqlite3.connect(os.path.join(path, "index.sqlite"), timeout=conf.journal_busy_timeout, isolation_level=None, check_same_thread=False)
+		self.connection.execute("PRAGMA journal_mode=WAL")
+		self.connection.execute("PRAGMA synchronous=NORMAL")
+		self.connection.executescript(SCHEMA)
+
+	def getEntryPath (self, key):
+		return os.path.join(self.path, key[:2], key)
+
+	def getContentKey (self, contenthash):
+		"""
+		Returns the cache key of shape files with a known content hash
+		:param contenthash: hash of the shape files, or of an archive holding them (see proxy_core.hashArchive)
+		:return: key
+		"""
+
+		# the features depend on the json backend and on the feature keys too (see proxy_json, proxy_diff.getFeatureKey)
+		return hashlib.sha1(("%s-%s-%s-%s" % (contenthash, CACHE_FORMAT, proxy_json.backend, conf.feature_id_attribute)).encode('utf-8')).hexdigest()
+
+	def getShapeKey (self, path_shape):
+		"""
+		Returns the cache key of the shape files in a directory, hashing them only if they changed since the last time
+		:param path_shape: directory of the shape files
+		:return: key, None if the shape cannot be cached (not a directory)
+		"""
+
+		if not os.path.isdir(path_shape):
+			return None
+
+		path_shape = os.path.realpath(path_shape)
+		signature = getFilesSignature(path_shape)
+
+		with self.lock:
+			row = self.connection.execute("SELECT signature, hash FROM sources WHERE path = ?", (path_shape,)).fetchone()
+		if row is not None and row[0] == signature:
+			contenthash = row[1]
+		else:
+			contenthash = hashShapeFiles(path_shape)
+			# files changed while hashed are hashed again next time
+			if getFilesSignature(path_shape) == signature:
+				with self.lock:
+					self.connection.execute("INSERT OR REPLACE INTO sources (path, signature, hash) VALUES (?, ?, ?)", (path_shape, signature, contenthash))
+
+		return self.getContentKey(contenthash)
+
+	def getFeatures (self, key, fallback=None):
+		"""
+		Returns the cached features of a shape. The entry file is opened only when the first feature is read, so no file is held by the collections waiting to be consumed
+		:param key: see getContentKey, getShapeKey
+		:param fallback: callable returning the features of the shape (e.g. converting it), used if the entry is evicted before it is read
+		:return: generator of (fid, geojson string) pairs, None if not in cache
+		"""
+
+		with self.lock:
+			row = self.connection.execute("SELECT bytes FROM entries WHERE key = ?", (key,)).fetchone()
+			if row is None:
+				return None
+			self.connection.execute("UPDATE entries SET lastused = ? WHERE key = ?", (time.time(), key))
+
+		if not os.path.exists(self.getEntryPath(key)):
+			with self.lock:
+				self.connection.execute("DELETE FROM entries WHERE key = ?", (key,))
+			return None
+
+		return self.readEntry(key, fallback)
+
+	def readEntry (self, key, fallback=None):
+
+		# once open, an eviction does not affect the reader
+		try:
+			entry_fp = proxy_json.openText(self.getEntryPath(key), 'r')
+		except IOError:
+			if fallback is None:
+				raise InternalProxyException ("Conversion cache entry %s evicted before it was read" % key)
+			for item in fallback():
+				yield item
+			return
+
+		try:
+			for line in entry_fp:
+				fid, featurejson = line.rstrip("\n").split("\t", 1)
+				yield fid, featurejson
+		finally:
+			entry_fp.close()
+
+	def storeFeatures (self, key, features):
+		"""
+		Generator that passes the features of a conversion through unchanged while writing them to a new entry, added to the cache only if all the features are consumed
+		:param key: see getContentKey, getShapeKey
+		:param features: iterable of (fid, geojson string) pairs or (fid, geojson string, geojson dict) triples, see proxy_core.writeFeatureCollection
+		:return: generator of the same items
+		"""
+
+		path_entry = self.getEntryPath(key)
+		if not os.path.exists(os.path.dirname(path_entry)):
+			try:
+				os.makedirs(os.path.dirname(path_entry))
+			except OSError:
+				# created in the meantime by another process
+				pass
+
+		# unique for each writer: threads and processes may convert the same content at the same time, for different metas or proxies
+		fd, path_new = tempfile.mkstemp(prefix="."+key+".", suffix=".tmp", dir=os.path.dirname(path_entry))
+		os.close(fd)
+		entry_fp = proxy_json.openText(path_new, 'w')
+		size = 0
+		complete = False
+		try:
+			for item in features:
+				fid, featurejson = item[0], item[1]
+				if entry_fp is not None:
+					line = "%s\t%s\n" % (fid, featurejson)
+					entry_fp.write(line)
+					# bytes in the file, as the cache size
+					size += len(line) if isinstance(line, bytes) else len(line.encode('utf-8'))
+					if size > self.maxbytes:
+						# larger than the whole cache, the rest of the features are only passed through
+						entry_fp.close()
+						entry_fp = None
+				yield item
+			complete = True
+		finally:
+			if entry_fp is not None:
+				entry_fp.close()
+			if complete and size <= self.maxbytes:
+				proxy_publish.publishFile(path_new, path_entry)
+				self.addEntry(key, os.path.getsize(path_entry))
+			elif os.path.exists(path_new):
+				os.remove(path_new)
+
+	def addEntry (self, key, size):
+
+		with self.lock:
+			self.connection.execute("INSERT OR REPLACE INTO entries (key, bytes, lastused) VALUES (?, ?, ?)", (key, size, time.time()))
+		self.evict()
+
+	def evict (self):
+		"""
+		Removes the least recently used entries until the cache fits in its max size
+		:return: number of entries removed
+		"""
+
+		removed = 0
+		with self.lock:
+			total = self.connection.execute("SELECT COALESCE(SUM(bytes), 0) FROM entries").fetchone()[0]
+			if total <= self.maxbytes:
+				return removed
+			rows = self.connection.execute("SELECT key, bytes FROM entries ORDER BY lastused").fetchall()
+			for key, size in rows:
+				if total <= self.maxbytes:
+					break
+				self.connection.execute("DELETE FROM entries WHERE key = ?", (key,))
+				try:
+					os.remove(self.getEntryPath(key))
+				except OSError:
+					pass
+				total -= size
+				removed += 1
+
+		return removed
+
+	def close (self):
+
+		with self.lock:
+			self.connection.close()
+
+
+conversioncache = None
+conversioncachelock = threading.Lock()
+
+
+def getConversionCache ():
+	"""
+	Returns the (shared) conversion cache, opening it if needed
+	:return: ConversionCache, None if disabled (conf.conversion_cache_bytes is 0)
+	"""
+
+	global conversioncache
+
+	if not conf.conversion_cache_bytes:
+		return None
+
+	with conversioncachelock:
+		if conversioncache is None:
+			conversioncache = ConversionCache()
+		return conversioncache
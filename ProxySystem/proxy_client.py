@@ -0,0 +1,284 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+__author__ = 'Antonio Vaccarino'
+__docformat__ = 'restructuredtext en'
+
+import json
+import time
+import random
+import socket
+import threading
+
+try:
+	import httplib
+	from urlparse import urlparse
+except ImportError:
+	import http.client as httplib
+	from urllib.parse import urlparse
+
+try:
+	import Queue as queue
+except ImportError:
+	import queue
+
+from errors import *
+import proxy_config_core as conf
+
+"""
+HTTP client for the link with the main server.
+Connections are kept alive and reused from a pool shared by all the soft proxies of this hard proxy; the pool size is also the max number of requests in flight at the same time. Failed requests (connection errors and 5xx responses) are retried up to conf.tries_for_connection times, waiting with exponential backoff and full jitter based on conf.wait_for_connection. A request failing on a pooled connection is first repeated at once on a new connection, as the server may have closed the idle one.
+Bodies are streamed: each attempt calls the body factory again and sends the chunks as they are produced, nothing is kept for the retries.
+"""
+
+
+def loadMainServerUrl (path_ref=None):
+	"""
+	Reads the url of the main server from the reference file (first non empty line)
+	:param path_ref: defaults to conf.mainserver_ref_location
+	:return: url string
+	"""
+
+	if path_ref is None:
+		path_ref = conf.mainserver_ref_location
+
+	try:
+		ref_fp = open(path_ref, 'r')
+	except IOError:
+		raise InternalProxyException ("Could not read the main server reference %s" % path_ref)
+	try:
+		for line in ref_fp:
+			if line.strip() != "":
+				return line.strip()
+	finally:
+		ref_fp.close()
+
+	raise InternalProxyException ("No main server url in %s" % path_ref)
+
+
+class RetryableError (Exception):
+	pass
+
+
+class StaleConnectionError (RetryableError):
+	pass
+
+
+class MainServerClient ():
+	"""
+	Pooled keep-alive client for the main server
+	"""
+
+	def __init__ (self, url=None, maxinflight=None, tries=None, wait=None, timeout=None):
+
+		if url is None:
+			url = loadMainServerUrl()
+		if maxinflight is None:
+			maxinflight = conf.max_inflight_requests
+		if tries is None:
+			tries = conf.tries_for_connection
+		if wait is None:
+			wait = conf.wait_for_connection
+		if timeout is None:
+			timeout = conf.connection_timeout
+
+		parsed = urlparse(url)
+		if parsed.scheme not in ("http", "https"):
+			raise InternalProxyException ("Unsupported main server url %s" % url)
+
+		self.scheme = parsed.scheme
+		self.host = parsed.hostname
+		self.port = parsed.port
+		self.basepath = parsed.path or "/"
+
+		self.tries = max(1, tries)
+		self.wait = wait
+		self.timeout = timeout
+
+		self.slots = threading.BoundedSemaphore(maxinflight)
+		self.idle = queue.LifoQueue()
+
+		self.statslock = threading.Lock()
+		self.stats = {
+			"requests": 0,
+			"succeeded": 0,
+			"failed": 0,
+			"retries": 0,
+			"stale_connections": 0,
+			"connections_opened": 0,
+			"latency_total": 0.0,
+			"latency_max": 0.0
+		}
+
+	def countStat (self, name, amount=1):
+		with self.statslock:
+			self.stats[name] += amount
+
+	def getStats (self):
+		"""
+		Returns the counters of the client: requests, results, retries, pooled connections found closed, connections opened and latency (seconds, including retries)
+		:return: dict
+		"""
+		with self.statslock:
+			return dict(self.stats)
+
+	def getConnection (self, fresh=False):
+		"""
+		Takes an idle connection from the pool, or opens a new one
+		:param fresh: if True a new connection is opened even if there are idle ones
+		:return: tuple (connection, True if it comes from the pool)
+		"""
+
+		if not fresh:
+			try:
+				return self.idle.get_nowait(), True
+			except queue.Empty:
+				pass
+
+		self.countStat("connections_opened")
+		if self.scheme == "https":
+			return httplib.HTTPSConnection(self.host, self.port, timeout=self.timeout), False
+		return httplib.HTTPConnection(self.host, self.port, timeout=self.timeout), False
+
+	def releaseConnection (self, connection, reusable):
+
+		if reusable:
+			self.idle.put(connection)
+		else:
+			connection.close()
+
+	def postOnce (self, path, body, headers, fresh=False):
+		"""
+		Sends a single POST with a chunked body on a pooled connection
+		:param path:
+		:param body: iterable of byte strings
+		:param headers:
+		:param fresh: if True the request is sent on a new connection
+		:return: tuple (status, response body)
+		"""
+
+		connection, pooled = self.getConnection(fresh)
+		reusable = False
+		try:
+			connection.putrequest("POST", path, skip_accept_encoding=True)
+			for name, value in headers.items():
+				connection.putheader(name, value)
+			connection.putheader("Transfer-Encoding", "chunked")
+			connection.endheaders()
+
+			for chunk in body:
+				if len(chunk) == 0:
+					continue
+				connection.send(("%x\r\n" % len(chunk)).encode('ascii'))
+				connection.send(chunk)
+				connection.send(b"\r\n")
+			connection.send(b"0\r\n\r\n")
+
+			response = connection.getresponse()
+			data = response.read()
+			reusable = not response.will_close
+			return response.status, data
+		except (socket.error, httplib.HTTPException) as ex:
+			if pooled:
+				raise StaleConnectionError (ex)
+			raise RetryableError (ex)
+		finally:
+			self.releaseConnection(connection, reusable)
+
+	def post (self, bodyfactory, path=None, headers=None):
+		"""
+		POSTs a body to the main server, retrying with backoff on connection errors and server errors
+		:param bodyfactory: callable returning the body as a new iterable of byte strings, called again for each attempt
+		:param path: request path, defaults to the path of the main server url
+		:param headers: dict of additional headers
+		:return: tuple (status, response body) of the last attempt
+		"""
+
+		if path is None:
+			path = self.basepath
+		if headers is None:
+			headers = {}
+
+		self.slots.acquire()
+		started = time.time()
+		self.countStat("requests")
+		try:
+			attempt = 0
+			while True:
+				attempt += 1
+				try:
+					try:
+						status, data = self.postOnce(path, bodyfactory(), headers)
+					except StaleConnectionError:
+						# an idle connection closed by the server is not a failure of the server: repeated at once, without backoff
+						self.countStat("stale_connections")
+						status, data = self.postOnce(path, bodyfactory(), headers, fresh=True)
+					if status < 500:
+						break
+					issue = "HTTP status %s" % status
+				except RetryableError as ex:
+					status, data = None, None
+					issue = ex
+
+				if attempt >= self.tries:
+					break
+
+				# exponential backoff with full jitter
+				self.countStat("retries")
+				time.sleep(random.uniform(0, self.wait * (2 ** (attempt - 1))))
+		finally:
+			self.slots.release()
+			latency = time.time() - started
+			with self.statslock:
+				self.stats["latency_total"] += latency
+				self.stats["latency_max"] = max(self.stats["latency_max"], latency)
+
+		if status == 200:
+			self.countStat("succeeded")
+		else:
+			self.countStat("failed")
+
+		if status is None:
+			raise RuntimeProxyException ("Could not reach the main server after %s attempts: %s" % (attempt, issue))
+
+		return status, data
+
+	def sendMessage (self, messagefactory, compressed=True):
+		"""
+		Sends a json message and returns the json response
+		:param messagefactory: callable returning the (gzip compressed) json message as a new iterable of byte strings, called for each attempt
+		:param compressed: True if the chunks are gzip compressed
+		:return: dict, None if the server did not answer with 200 and valid json
+		"""
+
+		headers = {
+			"Content-Type": "application/json",
+			"Accept": "application/json"
+		}
+		if compressed:
+			headers["Content-Encoding"] = "gzip"
+
+		status, data = self.post(messagefactory, headers=headers)
+
+		if status != 200:
+			return None
+
+		try:
+			return json.loads(data.decode('utf-8'))
+		except ValueError:
+			return None
+
+
+# client shared by all the proxies in this process, so the in-flight limit is global
+sharedclient = None
+sharedclientlock = threading.Lock()
+
+
+def getClient ():
+
+	global sharedclient
+
+	with sharedclientlock:
+		if sharedclient is None:
+			sharedclient = MainServerClient()
+		return sharedclient
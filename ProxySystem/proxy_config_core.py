@@ -20,6 +20,28 @@ mail_admin = config_testing.PROXYADMIN_MAIL
 # location of the logging file
 log_folder = "./tests/logs/"
 
+# log lines are queued and written by a background thread (see proxy_log); lines beyond the queue size are dropped, not waited for
+log_queue_size = 10000
+# max lines written (and fsynced) together
+log_batch_size = 500
+log_fsync = True
+# log files are rotated when larger than this (bytes) and at the start of each interval (seconds, None to rotate on size only)
+log_max_bytes = 10*1024*1024
+log_rotate_interval = 24*60*60
+# rotated files kept for each log
+log_backups = 7
+# max seconds the process waits at exit for the queued lines to be written
+log_stop_timeout = 10
+
+# SMTP server for the error mails, None to disable them
+mail_smtp_host = config_testing.SMTP_HOST
+mail_smtp_port = config_testing.SMTP_PORT
+mail_sender = "proxy@localhost"
+# min seconds between two error mails, the errors raised in the meantime are sent together
+mail_min_interval = 300
+# max errors listed in a mail, the others are only counted
+mail_max_errors = 50
+
 # general data path for the HARD proxy
 baseproxypath = config_testing.HARDPROXY_DATAPATH
 baseuploadpath = config_testing.UPLOADPATH
@@ -32,6 +54,94 @@ mainserver_ref_location = config_testing.MAINSERVER_CONF_FILE
 path_mirror = 'maps/mirror/'
 path_geojson = 'maps/geojson/'
 path_manifest = 'conf/manifest.json'
+path_hashes = 'maps/hashes/'
+path_diff = 'maps/diff/'
+path_locks = 'locks/'
+path_spatial = 'maps/spatial/'
+path_summary = 'maps/summary/'
+path_timeindex = 'maps/time/'
+path_archives = 'maps/archives/'
+# links to the geojson files of the metas being read (see proxy_core.MetaSnapshot), must be on the same filesystem as path_geojson
+path_snapshots = 'maps/snapshots/'
+path_journal = 'conf/journal.sqlite'
+
+# seconds a journal operation waits for another process holding the journal database
+journal_busy_timeout = 30
+
+# unix socket where the persistent ProxyFS daemon receives the filesystem events
+daemon_socket = "./tests/proxyfs.sock"
+# max time (seconds) a client waits for the daemon before falling back to handling the event in its own process
+daemon_client_timeout = 5
+# if True the daemon watches conf.baseuploadpath itself with inotify instead of waiting for an external FS monitor
+watch_uploads = False
+# seconds without events on a shape archive before it is handled, merges the bursts of events of a single upload
+watch_quiet_period = 2.0
+# number of shapes handled concurrently by the daemon
+event_workers = 4
+
+# if True upserts are converted straight from the uploaded zip through the GDAL /vsizip/ driver, and the archive is copied (streaming) to the mirror only when publishing; if False it is extracted to the mirror staging area first
+upsert_from_archive = True
+
+# number of worker processes used to convert the shapes of a meta, 1 converts sequentially in the calling process
+conversion_workers = 4
+# layers with more features than this are split in ranges converted by different workers
+conversion_split_features = 50000
+# cache of the converted features of the shapes, keyed by the content of the shape files (see proxy_cache)
+conversion_cache_folder = "./tests/convcache/"
+# max size of the conversion cache, least recently used entries are removed beyond it; 0 disables the cache
+conversion_cache_bytes = 1024*1024*1024
+
+# feature attribute holding a stable id of the features, used as their id and to match them in the feature diffs (see proxy_diff.getFeatureKey)
+# None uses the layer name and the OGR FID, i.e. the record number: removing a record shifts the ids of all the following ones, which are then sent again as deleted and upserted; set it for every shape with a unique id field
+feature_id_attribute = None
+
+# max number of entries in a node of the spatial indexes of the shapes (see proxy_spatial)
+spatial_node_size = 16
+# max number of distinct values counted for each attribute in the inventory summaries of the shapes (see proxy_summary); queries on the values beyond it read the geojson files
+inventory_max_values = 1000
+# names (lowercase) of the feature attributes holding the time of a feature, in order of preference
+time_attributes = ['time', 'datetime', 'date', 'timestamp']
+
+# json backend used for the geojson files and the messages (see proxy_json): "auto" for the fastest installed, "orjson" or "json"
+json_backend = 'auto'
+
+# if True the messages are validated on their templates without walking the features of data.upsert, only their feature collections are checked (see ProxyFS.createMessageFromTemplate)
+validate_envelope_only = True
+
+# approximate max size (bytes of uncompressed feature data) of each request_write sent to the main server, the diffs of a larger meta are split across several requests
+send_batch_bytes = 16*1024*1024
+# gzip level of the messages sent to the main server
+send_compression_level = 6
+
+# structured instrumentation of the events and sends (see proxy_metrics), costs a function call per instrumentation point when off
+metrics_enabled = False
+# exporters of the traces of the events and sends: "jsonlines" appends them to metrics_jsonl_file
+metrics_exporters = ['jsonlines']
+metrics_jsonl_file = "./tests/logs/metrics.jsonl"
+# port of the Prometheus text endpoint (/metrics) served by the daemon, None to disable it
+metrics_http_port = None
+metrics_http_address = '127.0.0.1'
+
+# if True the daemon also schedules the sends to the main server for all the proxies (see proxy_sender)
+send_scheduler = False
+# seconds between two scans of the pending updates of all the proxies
+send_scan_interval = 5
+# seconds without updates on a meta before it is sent, merges bursts of updates in a single send
+send_window = 10
+# max seconds an update can wait because of further updates on the same meta
+send_max_delay = 120
+# max number of proxies sending at the same time
+send_workers = 4
+# seconds before a meta whose send failed is sent again, doubled at each further failure up to send_retry_max_wait
+send_retry_wait = 30
+send_retry_max_wait = 3600
+# failed sends after which a meta is no longer sent automatically (until it is updated again), its updates stay in the journal; None retries forever
+send_max_attempts = 10
+
+# max number of requests to the main server in flight at the same time (shared by all the proxies of the process), also the size of the connection pool
+max_inflight_requests = 8
+# socket timeout (seconds) for the main server connections
+connection_timeout = 60
 
 tries_for_connection = 3
 tries_for_lock = 5
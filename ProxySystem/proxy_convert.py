@@ -0,0 +1,272 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+__author__ = 'Antonio Vaccarino'
+__docformat__ = 'restructuredtext en'
+
+import os
+import atexit
+import shutil
+import tempfile
+import threading
+import multiprocessing
+from osgeo import ogr
+
+from errors import *
+import proxy_config_core as conf
+import proxy_json
+import proxy_diff
+
+"""
+Parallel conversion engine for multi-shape rebuilds.
+The shapes to convert are split in tasks (one per layer, or one per range of conf.conversion_split_features features for large layers) that are converted by a pool of conf.conversion_workers processes. Each task writes its features to a part file ("fid<TAB>geojson" lines); the parts are then read back in task order, so the features of each shape come out in the same order as a sequential conversion.
+The pool is shared by the whole process and its workers are started with forkserver or spawn: the daemon runs the events, the sends and the log writer in threads, and a worker forked while one of them holds a lock could deadlock. Where only fork is available (python 2) the pool is created only while the process has a single thread, otherwise the shapes are converted in the calling process.
+"""
+
+
+def convertRange (task):
+	"""
+	Worker function: converts a range of features of a layer to a part file
+	:param task: tuple (path_shape, layer index, first feature, number of features, path of the part file)
+	:return: tuple (path of the part file, number of features written)
+	"""
+
+	path_shape, layer_index, start, count, path_part = task
+
+	datasource = ogr.Open(path_shape)
+	if datasource is None:
+		raise RuntimeProxyException ("Could not open shape data %s" % path_shape)
+
+	layer = datasource.GetLayer(layer_index)
+	layername = layer.GetName()
+	layer.SetNextByIndex(start)
+
+	written = 0
+	part_fp = proxy_json.openText(path_part, 'w')
+	try:
+		while written < count:
+			feature = layer.GetNextFeature()
+			if feature is None:
+				break
+			featuredict = feature.ExportToJson(as_object=True)
+			fid = proxy_diff.getFeatureKey(feature, layername, featuredict)
+			part_fp.write("%s\t%s\n" % (fid, proxy_json.dumps(featuredict)))
+			written += 1
+	finally:
+		part_fp.close()
+
+	return path_part, written
+
+
+def planShapeTasks (path_shape, path_parts, splitsize=None):
+	"""
+	Splits the conversion of a shapefile in tasks for convertRange
+	:param path_shape: path of the shape data
+	:param path_parts: directory for the part files of this shape
+	:param splitsize: max number of features per task
+	:return: list of tasks, None if the shape data cannot be opened
+	"""
+
+	if splitsize is None:
+		splitsize = conf.conversion_split_features
+
+	try:
+		datasource = ogr.Open(path_shape)
+	except:
+		return None
+	if datasource is None:
+		return None
+
+	tasks = []
+	for layer_index in range (0, datasource.GetLayerCount()):
+		featurecount = datasource.GetLayer(layer_index).GetFeatureCount()
+		for start in range (0, featurecount, splitsize):
+			path_part = os.path.join(path_parts, "%06d" % len(tasks))
+			tasks.append((path_shape, layer_index, start, min(splitsize, featurecount - start), path_part))
+
+	return tasks
+
+
+class ShapeParts ():
+	"""
+	Features of a converted shape, read lazily from its part files in order. The parts are removed once read, or when the features are abandoned: on close() or when the object is garbage collected, whichever comes first
+	"""
+
+	def __init__ (self, partpaths, path_parts):
+		"""
+		:param partpaths: list of part files
+		:param path_parts: directory of the parts
+		"""
+		self.partpaths = partpaths
+		self.path_parts = path_parts
+
+	def __iter__ (self):
+		"""
+		:return: generator of (fid, geojson string) pairs
+		"""
+
+		try:
+			for path_part in self.partpaths:
+				part_fp = proxy_json.openText(path_part, 'r')
+				try:
+					for line in part_fp:
+						fid, featurejson = line.rstrip("\n").split("\t", 1)
+						yield fid, featurejson
+				finally:
+					part_fp.close()
+				os.remove(path_part)
+		finally:
+			self.close()
+
+	def close (self):
+
+		if self.path_parts is None:
+			return
+		shutil.rmtree(self.path_parts, ignore_errors=True)
+		# the last shape of a run also removes the run directory
+		try:
+			os.rmdir(os.path.dirname(self.path_parts))
+		except OSError:
+			pass
+		self.path_parts = None
+
+	def __del__ (self):
+		self.close()
+
+
+def getPoolContext ():
+	"""
+	Returns the multiprocessing context used to start the conversion workers
+	:return: forkserver or spawn context, None where only fork is available (python 2)
+	"""
+
+	if not hasattr(multiprocessing, 'get_context'):
+		return None
+
+	methods = multiprocessing.get_all_start_methods()
+	for method in ("forkserver", "spawn"):
+		if method in methods:
+			return multiprocessing.get_context(method)
+	return None
+
+
+def createPool (workers):
+	"""
+	Starts a pool of conversion workers
+	:param workers: number of processes
+	:return: pool, None if the workers could only be forked from a process already running other threads
+	"""
+
+	context = getPoolContext()
+	if context is not None:
+		return context.Pool(workers)
+	if threading.active_count() == 1:
+		return multiprocessing.Pool(workers)
+	return None
+
+
+conversionpool = None
+conversionpoollock = threading.Lock()
+
+
+def getConversionPool ():
+	"""
+	Returns the shared pool of conversion workers of the process, creating it if needed. It is closed when the process exits
+	:return: pool of conf.conversion_workers processes, None if conf.conversion_workers is 1 or less or if the workers could only be forked from a process already running other threads
+	"""
+
+	global conversionpool
+
+	if conf.conversion_workers <= 1:
+		return None
+
+	with conversionpoollock:
+		if conversionpool is None:
+			conversionpool = createPool(conf.conversion_workers)
+			if conversionpool is not None:
+				atexit.register(stopConversionPool)
+		return conversionpool
+
+
+def stopConversionPool ():
+
+	global conversionpool
+
+	with conversionpoollock:
+		pool = conversionpool
+		conversionpool = None
+	if pool is not None:
+		pool.close()
+		pool.join()
+
+
+def convertShapes (shapes, workers=None, path_work=None):
+	"""
+	Converts a list of shapes in parallel
+	:param shapes: list of (shape_id, path_shape) tuples
+	:param workers: number of worker processes of a pool created for this call, defaults to the shared pool (see getConversionPool); 1 or less converts in this process
+	:param path_work: directory where the part files are created, defaults to the system temp dir
+	:return: dict of geojson feature collections with shape_ids as keys, as convertShapefileToJson (False for shapes that could not be opened); features are read lazily from the part files, see ShapeParts
+	"""
+
+	rundir = tempfile.mkdtemp(prefix="convert", dir=path_work)
+
+	# planning: every shape gets its own parts directory and a sequence of tasks
+	shapetasks = []
+	alltasks = []
+	try:
+		for i in range (0, len(shapes)):
+			shape_id, path_shape = shapes[i]
+			path_parts = os.path.join(rundir, "%04d" % i)
+			os.makedirs(path_parts)
+			tasks = planShapeTasks(path_shape, path_parts)
+			shapetasks.append((shape_id, path_parts, tasks))
+			if tasks is not None:
+				alltasks.extend(tasks)
+
+		pool = None
+		if len(alltasks) > 1:
+			if workers is None:
+				pool = getConversionPool()
+			elif workers > 1:
+				pool = createPool(min(workers, len(alltasks)))
+
+		if pool is None:
+			results = [convertRange(task) for task in alltasks]
+		else:
+			try:
+				results = pool.map(convertRange, alltasks, 1)
+			finally:
+				# a pool created for this call only
+				if workers is not None:
+					pool.close()
+					pool.join()
+	except Exception as ex:
+		shutil.rmtree(rundir, ignore_errors=True)
+		raise RuntimeProxyException ("Failed conversion of shapes %s: %s" % ([shape[0] for shape in shapes], ex))
+
+	# merging: results come back in task order, so each shape reads its parts in sequence
+	shapes_gj = {}
+	offset = 0
+	for shape_id, path_parts, tasks in shapetasks:
+		if tasks is None:
+			shapes_gj[shape_id] = False
+			shutil.rmtree(path_parts, ignore_errors=True)
+			continue
+
+		partpaths = [result[0] for result in results[offset:offset+len(tasks)]]
+		offset += len(tasks)
+
+		shapes_gj[shape_id] = {
+			'id' : shape_id,
+			'type': 'FeatureCollection',
+			'features' : ShapeParts(partpaths, path_parts)
+		}
+
+	# the parts of each shape (and at the end the run directory) go away when its features are consumed or abandoned
+	try:
+		os.rmdir(rundir)
+	except OSError:
+		pass
+
+	return shapes_gj
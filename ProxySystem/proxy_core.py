@@ -1,9 +1,10 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
-import json
 from osgeo import ogr
 import shutil
 import zipfile
+import hashlib
+import tempfile
 
 __author__ = 'Antonio Vaccarino'
 __docformat__ = 'restructuredtext en'
@@ -12,6 +13,17 @@ import os.path
 import os
 
 import proxy_config_core as conf
+import proxy_diff
+import proxy_convert
+import proxy_manifest
+import proxy_lock
+import proxy_publish
+import proxy_journal
+import proxy_spatial
+import proxy_summary
+import proxy_json
+import proxy_metrics
+import proxy_cache
 from errors import *
 
 
@@ -27,9 +39,9 @@ def verifyUpdateStructure (eventpath):
 	"""
 
 
-	fullpath = eventpath.split("/")
-
-	basepath, proxy_id, meta_id, zipfilename = eventpath.split()
+	basepath, zipfilename = os.path.split(eventpath)
+	basepath, meta_id = os.path.split(basepath)
+	basepath, proxy_id = os.path.split(basepath)
 
 	if os.path.realpath(basepath) != os.path.realpath(conf.baseuploadpath):
 		raise InvalidDirException ("Upload path structure %s is not matched by event path %s" % (conf.baseuploadpath, eventpath))
@@ -40,29 +52,14 @@ def verifyUpdateStructure (eventpath):
 	except:
 		raise InvalidShapeIdException ("Could not extract a valid shapeid from the shape file archive name" % zipfilename)
 
-	# getting manifest data for verification
-
-	try:
-		manifest_fp = open(os.path.join(conf.baseproxypath, proxy_id, conf.path_manifest))
-	except:
-		raise InvalidProxyException ("Proxy instance %s does not exist" % proxy_id)
-	else:
-		manifest = json.load(manifest_fp)
-		manifest_fp.close()
-
-	# checking the meta_id against the list
-	meta_in_manifest = False
-	for currentmeta in manifest['metadata']:
-		if currentmeta['name'] == meta_id:
-			meta_in_manifest = True
-			break
-
-	if not meta_in_manifest:
+	# checking the meta_id against the manifest (parsed once and cached, see proxy_manifest)
+	if not proxy_manifest.hasMeta(proxy_id, meta_id):
 		raise InvalidMetaException ("Could not find meta_id %s in proxy %s" % (meta_id, proxy_id))
 
 	return proxy_id, meta_id, shape_id
 
 
+@proxy_lock.lockable
 def handleDelete (proxy_id, meta_id, shape_id):
 	"""
 	Removes the shapefile data from the $mirror directory
@@ -74,12 +71,17 @@ def handleDelete (proxy_id, meta_id, shape_id):
 
 	path_mirror = os.path.join(conf.baseproxypath, proxy_id, conf.path_mirror, meta_id, shape_id)
 
+	path_pinned = getPinnedArchivePath(proxy_id, meta_id, shape_id)
+	if os.path.exists(path_pinned):
+		os.remove(path_pinned)
+
 	if not os.path.exists(path_mirror):
 		raise Exception ("Data for %s/%s already deleted in the mirror section of proxy %s" % (meta_id, shape_id, proxy_id))
 	else:
 		#TODO: add specific handling of further exceptions or just push it up the ladder
 		shutil.rmtree(path_mirror)
 
+@proxy_lock.lockable
 def replicateDelete (proxy_id, meta_id, shape_id):
 	"""
 	Removes the shapefile data from the gjs directory
@@ -95,22 +97,31 @@ def replicateDelete (proxy_id, meta_id, shape_id):
 		raise Exception ("Data for %s/%s already deleted in the geojson section of proxy %s" % (meta_id, shape_id, proxy_id))
 	else:
 		#TODO: add specific handling of further exceptions or just push it up the ladder
-		shutil.rmtree(path_gj)
+		os.remove(path_gj)
+
+	# all the features of the shape go to the pending diff as deletes
+	proxy_diff.recordShapeDelete(proxy_id, meta_id, shape_id)
+	proxy_spatial.removeShapeIndex(proxy_id, meta_id, shape_id)
+	proxy_summary.removeShapeSummary(proxy_id, meta_id, shape_id)
+	removeArchiveHash(proxy_id, meta_id, shape_id)
 
+@proxy_lock.lockable
 def handleUpsert (proxy_id, meta_id, shape_id):
 	"""
-	This function adds or modifies the shapefile data to the $mirror directory
+	This function validates the uploaded archive and adds or modifies the shapefile data to the staging area of the $mirror directory (see proxy_publish)
+	The archive is first pinned in the staging area (see pinArchive) and only the pinned copy is validated, hashed and read afterwards, so an upload replacing it while the event is handled cannot change the data of this event
+	With conf.upsert_from_archive the archive is only validated: the conversion reads it through /vsizip/ and it is copied to the mirror by replicateShapeData
 	:param proxy_id:
 	:param meta_id:
 	:param shape_id:
-	:return:
+	:return: content hash of the archive (see hashArchive), None if the archive has the same content as the one the current mirror data comes from
 	"""
 
 	# first we check if the directory already exists
 	# in case we remove it and write the new data so we ensure we use a clean environment
 
 	try:
-		zipfilename = os.path.join(conf.baseuploadpath, proxy_id, meta_id, shape_id, ".zip")
+		zipfilename = pinArchive(proxy_id, meta_id, shape_id)
 		zipfp = zipfile.ZipFile(zipfilename, mode='r')
 	except:
 		#leaving as placeholder in case we want to add a more specific handling
@@ -130,7 +141,7 @@ def handleUpsert (proxy_id, meta_id, shape_id):
 
 	for candidatepath in zipfp.namelist():
 		#checking that no file unpacks to a different directory
-		if "/" in candidatepath:
+		if not isSafeMemberName(candidatepath):
 			raise InvalidShapeArchiveException ("Shapefile archives should not contain names with path data")
 		else:
 			#checking that the names of the file are correct
@@ -144,171 +155,843 @@ def handleUpsert (proxy_id, meta_id, shape_id):
 			if cext is None:
 				raise InvalidShapeArchiveException ("Shape archive %s contains unrelated data in file %s " % (shape_id, candidatepath))
 
-	if not all(ext_mandatory.values):
+	if not all(ext_mandatory.values()):
 		raise InvalidShapeArchiveException ("Mandatory file missing in shape archive %s (should contain .shp, .shx and .dbf)" % shape_id)
 
+	# sync tools upload the same archive again and again: if nothing changed there is nothing to extract, convert or send
+	archivehash = hashArchive(zipfp)
+	if archivehash == loadArchiveHash(proxy_id, meta_id, shape_id):
+		zipfp.close()
+		os.remove(zipfilename)
+		return None
+
+	if conf.upsert_from_archive:
+		zipfp.close()
+		return archivehash
+
 	#creating the path after opening the zip so there is a smaller risk of leaving trash behind if we get an error
-	path_mirror = os.path.join(conf.baseproxypath, proxy_id, conf.path_mirror, meta_id, shape_id, ".tmp")
+	#the data is extracted in the staging area of the meta and published by replicateShapeData
+	path_mirror = proxy_publish.getStagingPath(proxy_id, meta_id, shape_id)
 	if os.path.exists(path_mirror):
 		shutil.rmtree(path_mirror)
 	os.makedirs(path_mirror)
 
 	#TODO: ensure that we remove any read-only flags and set the correct permissions if needed
 	zipfp.extractall(path_mirror)
+	zipfp.close()
+	os.remove(zipfilename)
+
+	return archivehash
+
+
+def getArchivePath (proxy_id, meta_id, shape_id):
+	return os.path.join(conf.baseuploadpath, proxy_id, meta_id, shape_id+".zip")
+
+
+def getPinnedArchivePath (proxy_id, meta_id, shape_id):
+	return proxy_publish.getStagingPath(proxy_id, meta_id, shape_id) + ".zip"
+
+
+def pinArchive (proxy_id, meta_id, shape_id):
+	"""
+	Links the uploaded archive in the staging area of the mirror, or copies it if it cannot be linked (e.g. uploads on a different filesystem). An upload replacing the archive creates a new file, so the pinned one keeps the content that is validated and hashed
+	:param proxy_id:
+	:param meta_id:
+	:param shape_id:
+	:return: path of the pinned archive
+	"""
+
+	path_pinned = getPinnedArchivePath(proxy_id, meta_id, shape_id)
+	if not os.path.exists(os.path.dirname(path_pinned)):
+		os.makedirs(os.path.dirname(path_pinned))
+
+	# left by a failed event; removed rather than replaced, as a rename over another link to the same file does nothing
+	if os.path.exists(path_pinned):
+		os.remove(path_pinned)
+	try:
+		os.link(getArchivePath(proxy_id, meta_id, shape_id), path_pinned)
+	except OSError:
+		shutil.copyfile(getArchivePath(proxy_id, meta_id, shape_id), path_pinned)
+
+	return path_pinned
+
+
+def isSafeMemberName (membername):
+	"""
+	Checks that an archive member is a plain file name, that cannot be extracted outside of the destination directory
+	:param membername:
+	:return: boolean
+	"""
+
+	if membername in ("", os.curdir, os.pardir) or os.path.isabs(membername):
+		return False
+	return "/" not in membername and "\\" not in membername
+
+
+def getArchiveHashPath (proxy_id, meta_id, shape_id):
+	return os.path.join(conf.baseproxypath, proxy_id, conf.path_archives, meta_id, shape_id)
+
+
+def hashArchive (zipfp):
+	"""
+	Computes the content hash of a shape archive from the names and data of its members, read in streaming. Zip metadata (timestamps, compression, member order) is not included, so the same files archived again have the same hash
+	:param zipfp: open ZipFile
+	:return: hex string
+	"""
+
+	digest = hashlib.sha1()
+	for info in sorted(zipfp.infolist(), key=lambda member: member.filename):
+		header = "%s\0%d\0" % (info.filename, info.file_size)
+		if not isinstance(header, bytes):
+			header = header.encode('utf-8')
+		digest.update(header)
+		member_fp = zipfp.open(info)
+		try:
+			while True:
+				chunk = member_fp.read(1024*1024)
+				if not chunk:
+					break
+				digest.update(chunk)
+		finally:
+			member_fp.close()
+
+	return digest.hexdigest()
+
+
+def loadArchiveHash (proxy_id, meta_id, shape_id):
+	"""
+	Returns the content hash of the archive the mirror data of a shape comes from
+	:param proxy_id:
+	:param meta_id:
+	:param shape_id:
+	:return: hex string, None if not recorded
+	"""
 
+	try:
+		fp = open(getArchiveHashPath(proxy_id, meta_id, shape_id), 'r')
+	except IOError:
+		return None
+	try:
+		return fp.read().strip()
+	finally:
+		fp.close()
+
+
+def recordArchiveHash (proxy_id, meta_id, shape_id, archivehash):
+
+	path_hash = getArchiveHashPath(proxy_id, meta_id, shape_id)
+	if not os.path.exists(os.path.dirname(path_hash)):
+		os.makedirs(os.path.dirname(path_hash))
+
+	path_new = proxy_publish.getTempFilePath(path_hash)
+	fp = open(path_new, 'w')
+	try:
+		fp.write(archivehash)
+	finally:
+		fp.close()
+	proxy_publish.publishFile(path_new, path_hash)
+
+
+def removeArchiveHash (proxy_id, meta_id, shape_id):
+
+	path_hash = getArchiveHashPath(proxy_id, meta_id, shape_id)
+	if os.path.exists(path_hash):
+		os.remove(path_hash)
+
+
+def getUpsertSourcePath (proxy_id, meta_id, shape_id):
+	"""
+	Returns the path OGR must open to read the data of an upserted shape: the staging directory, or the .shp member of the pinned archive (see pinArchive) through /vsizip/ if conf.upsert_from_archive is set
+	:param proxy_id:
+	:param meta_id:
+	:param shape_id:
+	:return: path
+	"""
+
+	if not conf.upsert_from_archive:
+		return proxy_publish.getStagingPath(proxy_id, meta_id, shape_id)
+
+	zipfilename = os.path.abspath(getPinnedArchivePath(proxy_id, meta_id, shape_id))
+	zipfp = zipfile.ZipFile(zipfilename, mode='r')
+	try:
+		shapemembers = [name for name in zipfp.namelist() if name.endswith(".shp")]
+	finally:
+		zipfp.close()
 
-def convertShapefileToJson (path_shape):
+	if len(shapemembers) != 1:
+		raise InvalidShapeArchiveException ("Shape archive %s should contain exactly one .shp file" % shape_id)
+
+	return "/vsizip/" + zipfilename + "/" + shapemembers[0]
+
+
+def stageArchive (proxy_id, meta_id, shape_id, archivehash=None):
 	"""
-	Converts a shapefile to GeoJSON data and returns it.
+	Copies the members of the pinned archive (see pinArchive) to the staging area of the mirror, streaming each file so it is written to disk only once, then removes the pinned archive
+	The member names are checked again, and the content is hashed while it is copied: a linked upload rewritten in place after handleUpsert does not match its hash and is not published
+	:param proxy_id:
+	:param meta_id:
+	:param shape_id:
+	:param archivehash: content hash of the archive computed by handleUpsert, None to skip the check
+	:return: path of the staging directory
+	"""
+
+	path_staging = proxy_publish.getStagingPath(proxy_id, meta_id, shape_id)
+	if os.path.exists(path_staging):
+		shutil.rmtree(path_staging)
+	os.makedirs(path_staging)
+
+	path_pinned = getPinnedArchivePath(proxy_id, meta_id, shape_id)
+	digest = hashlib.sha1()
+	zipfp = zipfile.ZipFile(path_pinned, mode='r')
+	try:
+		# same order and scheme as hashArchive
+		for info in sorted(zipfp.infolist(), key=lambda member: member.filename):
+			if not isSafeMemberName(info.filename):
+				raise InvalidShapeArchiveException ("Shapefile archives should not contain names with path data")
+			header = "%s\0%d\0" % (info.filename, info.file_size)
+			if not isinstance(header, bytes):
+				header = header.encode('utf-8')
+			digest.update(header)
+			member_fp = zipfp.open(info)
+			try:
+				dest_fp = open(os.path.join(path_staging, info.filename), 'wb')
+				try:
+					while True:
+						chunk = member_fp.read(1024*1024)
+						if not chunk:
+							break
+						digest.update(chunk)
+						dest_fp.write(chunk)
+				finally:
+					dest_fp.close()
+			finally:
+				member_fp.close()
+	except:
+		shutil.rmtree(path_staging, ignore_errors=True)
+		raise
+	finally:
+		zipfp.close()
+
+	if archivehash is not None and digest.hexdigest() != archivehash:
+		shutil.rmtree(path_staging, ignore_errors=True)
+		raise InvalidShapeArchiveException ("Shape archive %s changed while it was handled" % shape_id)
+
+	os.remove(path_pinned)
+
+	return path_staging
+
+
+def iterShapefileFeatures (datasource):
+	"""
+	Generator over the features of every layer of an OGR datasource, in layer order. Features are read sequentially with GetNextFeature and yielded with their GeoJSON strings, so at most one feature is held in memory at any time
+	Each feature is exported by OGR as a dict and serialized once by proxy_json; the dict is passed along so the indexes do not parse the string again
+	:param datasource: open OGR datasource, must stay referenced until the generator is exhausted
+	:return: generator of (fid, geojson string, geojson dict) triples, fid being the feature key of proxy_diff.getFeatureKey
+	"""
+
+	for i in range (0, datasource.GetLayerCount()):
+		layer = datasource.GetLayer(i)
+		layername = layer.GetName()
+		layer.ResetReading()
+		feature = layer.GetNextFeature()
+		while feature is not None:
+			featuredict = feature.ExportToJson(as_object=True)
+			fid = proxy_diff.getFeatureKey(feature, layername, featuredict)
+			yield fid, proxy_json.dumps(featuredict), featuredict
+			feature = layer.GetNextFeature()
+
+
+def convertShapefileToJson (path_shape, shape_id=None):
+	"""
+	Converts a shapefile to GeoJSON data and returns it. The features are NOT read here: the 'features' element of the collection is a generator that reads them from the datasource when consumed (see writeFeatureCollection)
 	:param path_shape: path of the shape file to be converted
-	:return: geojson feature data
+	:param shape_id: id of the collection, defaults to the last element of path_shape
+	:return: geojson feature collection dict with lazy features, False if the shapefile cannot be opened
 	"""
 
-	shape_id = os.path.split(path_shape)
+	if shape_id is None:
+		shape_id = os.path.basename(os.path.normpath(path_shape))
 
 	#TODO: verify key name for shape id information
 
+	try:
+		datasource = ogr.Open(path_shape)
+	except:
+		return False
+
+	# ogr.Open returns None rather than raising on most failures
+	if datasource is None:
+		return False
+
 	collection = {
 		'id' : shape_id,
 		'type': 'FeatureCollection',
-		'features' : []
+		'features' : iterShapefileFeatures(datasource)
 	}
 
+	return collection
+
+def byteLength (text):
+	if isinstance(text, bytes):
+		return len(text)
+	return len(text.encode('utf-8'))
+
+def writeFeatureCollection (collection, fp, onwrite=None):
+	"""
+	Writes a feature collection to an open file as GeoJSON, consuming its features one at a time. Features are written one per line and already serialized features (strings) are copied as they are, so the output is valid json that can also be read back line by line
+	:param collection: feature collection dict, features can be any iterable of (fid, geojson string or dict) pairs or of (fid, geojson string, geojson dict) triples
+	:param fp: file object open for writing (see proxy_json.openText)
+	:param onwrite: optional callback, called for each feature with fid, geojson string, byte offset and byte length of the feature in the file, and the geojson dict if known or None (see proxy_spatial)
+	:return: number of features written
+	"""
+
+	header = {}
+	for key, value in collection.items():
+		if key != 'features':
+			header[key] = value
+
+	headertext = '{'
+	for key in sorted(header.keys()):
+		headertext += '%s: %s, ' % (proxy_json.dumps(key), proxy_json.dumps(header[key]))
+	headertext += '"features": ['
+	fp.write(headertext)
+	position = byteLength(headertext)
+
+	count = 0
+	for item in collection['features']:
+		fid, feature = item[0], item[1]
+		parsed = item[2] if len(item) > 2 else None
+		if isinstance(feature, dict):
+			parsed = feature
+			feature = proxy_json.dumps(feature)
+		if count > 0:
+			fp.write(',')
+			position += 1
+		fp.write('\n')
+		position += 1
+		fp.write(feature)
+		length = byteLength(feature)
+		if onwrite is not None:
+			onwrite(fid, feature, position, length, parsed)
+		position += length
+		count += 1
+
+	fp.write('\n]}\n')
+
+	return count
+
+@proxy_lock.lockable
+def iterMetaJson (proxy_id, meta_id):
+	"""
+	Streams the feature collections in the gjs section of the soft proxy. The geojson files are linked here in a snapshot directory (see MetaSnapshot), so a caller holding the lock on the meta gets a consistent snapshot even if the lock is released before the data is read, without keeping the files open; the features of each collection are then read one at a time while consumed
+	:param proxy_id:
+	:param meta_id:
+	:return: MetaSnapshot, iterable once over the feature collections (dicts), with an ArrayStream of geojson strings as features; the features of a collection must be consumed before moving to the next one
+	"""
+
+	path_gj_meta = os.path.join (conf.baseproxypath, proxy_id, conf.path_geojson, meta_id)
+	filelist = sorted(os.listdir(path_gj_meta))
+
+	path_snapshots = os.path.join(conf.baseproxypath, proxy_id, conf.path_snapshots)
+	if not os.path.exists(path_snapshots):
+		os.makedirs(path_snapshots)
 
+	snapshot = MetaSnapshot(proxy_id, meta_id, tempfile.mkdtemp(prefix=meta_id + ".", dir=path_snapshots))
 	try:
-		datasource = ogr.Open(path_shape)
+		for filename in filelist:
+			# hidden files are versions still being written
+			if filename.startswith("."):
+				continue
+			try:
+				os.link(os.path.join(path_gj_meta, filename), os.path.join(snapshot.path, filename))
+			except OSError:
+				try:
+					shutil.copyfile(os.path.join(path_gj_meta, filename), os.path.join(snapshot.path, filename))
+				except IOError:
+					raise RuntimeProxyException ("Could not access map data %s for meta %s on proxy %s" % (filename, meta_id, proxy_id))
+			snapshot.filenames.append(filename)
 	except:
-		return False
+		snapshot.close()
+		raise
 
-	jsonlist = []
+	return snapshot
 
-	for i in range (0, datasource.GetLayerCount()):
-		layer = datasource.GetLayer(i)
-		for f in range (0, layer.GetFeatureCount()):
-			feature = layer.GetFeature(f)
-			jsondata = feature.ExportToJson()
+class MetaSnapshot ():
+	"""
+	Geojson files of a meta as they were when the snapshot was taken: links to them in a directory of conf.path_snapshots (copies where they cannot be linked), so the shapes republished or removed in the meantime do not affect it. Each file is opened only when its collection is read, and unlinked right away, so at most one file is open at a time. The remaining links are removed by close, which is also called when an unfinished snapshot is discarded
+	"""
 
-			collection['features'].append(jsondata)
+	def __init__ (self, proxy_id, meta_id, path_snapshot):
+		self.proxy_id = proxy_id
+		self.meta_id = meta_id
+		self.path = path_snapshot
+		self.filenames = []
 
+	def __iter__ (self):
 
+		try:
+			while len(self.filenames) > 0:
+				filename = self.filenames.pop(0)
+				path_gj = os.path.join(self.path, filename)
+				fp = proxy_json.openText(path_gj, 'r')
+				os.remove(path_gj)
+				try:
+					collection = readCollectionHeader(fp)
+				except ValueError:
+					fp.close()
+					raise RuntimeProxyException ("Non valid json data in file %s for meta %s on proxy %s" % (filename, self.meta_id, self.proxy_id))
+				yield collection
+		finally:
+			self.close()
+
+	def close (self):
+
+		while len(self.filenames) > 0:
+			path_gj = os.path.join(self.path, self.filenames.pop())
+			if os.path.exists(path_gj):
+				os.remove(path_gj)
+		if os.path.isdir(self.path):
+			os.rmdir(self.path)
+
+	def __del__ (self):
+		self.close()
+
+def readCollectionHeader (fp):
+	"""
+	Reads the members of a feature collection written by writeFeatureCollection, leaving the features to be read from the file while consumed. Files in any other layout are parsed whole
+	:param fp: geojson file open for reading, closed when the features have been read
+	:return: feature collection dict, features as an ArrayStream of geojson strings
+	"""
 
+	headerline = fp.readline()
+	if not headerline.rstrip().endswith('"features": ['):
+		fp.seek(0)
+		try:
+			collection = proxy_json.loads(fp.read())
+		finally:
+			fp.close()
+		collection['features'] = proxy_json.ArrayStream(proxy_json.dumps(feature) for feature in collection.get('features', []))
+		return collection
+
+	collection = proxy_json.loads(headerline.rstrip() + ']}')
+	collection['features'] = proxy_json.ArrayStream(readFeatureLines(fp))
 	return collection
 
+def readFeatureLines (fp):
+	"""
+	Generator over the features of a geojson file written by writeFeatureCollection, positioned after the header line; closes the file at the end
+	:param fp:
+	:return: generator of geojson strings
+	"""
+
+	try:
+		for line in fp:
+			line = line.rstrip()
+			if line.startswith(']'):
+				break
+			if line.endswith(','):
+				line = line[:-1]
+			yield line
+	finally:
+		fp.close()
+
+@proxy_lock.lockable
 def assembleMetaJson (proxy_id, meta_id):
 	"""
-	Creates a list of (dict)json objects from the files in the gjs section of the soft proxy and returns it
+	Creates a list of (dict)json objects from the files in the gjs section of the soft proxy and returns it. Holds the whole meta in memory: use iterMetaJson to stream it
 	:param proxy_id:
 	:param meta_id:
 	:return: list of dicts (from json)
 	"""
 
 	meta_json = []
+	for collection in iterMetaJson(proxy_id, meta_id):
+		collection['features'] = [proxy_json.loads(feature) for feature in collection['features']]
+		meta_json.append(collection)
+
+	return meta_json
+
+@proxy_lock.lockable
+def queryMetaBB (proxy_id, meta_id, bb):
+	"""
+	Answers a BB query on a meta: returns the features of its shapes whose envelope intersects the bounding box, read through the spatial indexes of the shapes (see proxy_spatial)
+	:param proxy_id:
+	:param meta_id:
+	:param bb: list [minx, miny, maxx, maxy], as in the query section of a request_query
+	:return: list of feature collections (dicts from json) with the matching features, shapes without matches are left out
+	"""
+
+	bb = proxy_spatial.parseBB(bb)
 
-	filelist = os.listdir(os.path.join (conf.baseproxypath, proxy_id, conf.path_geojson, meta_id))
+	path_gj_meta = os.path.join (conf.baseproxypath, proxy_id, conf.path_geojson, meta_id)
+	if not os.path.exists(path_gj_meta):
+		return []
 
-	for filename in filelist:
+	meta_json = []
+	for shape_id in sorted(os.listdir(path_gj_meta)):
+		# hidden files are versions still being written
+		if shape_id.startswith("."):
+			continue
 		try:
-			fp = open(filename, 'r')
+			features = proxy_spatial.searchShape(proxy_id, meta_id, shape_id, bb)
+		except (IOError, OSError, ValueError):
+			raise RuntimeProxyException ("Could not query map data %s for meta %s on proxy %s" % (shape_id, meta_id, proxy_id))
+
+		if len(features) == 0:
+			continue
+
+		meta_json.append({
+			'id': shape_id,
+			'type': 'FeatureCollection',
+			'features': features
+		})
+
+	return meta_json
+
+def queryProxyBB (proxy_id, bb):
+	"""
+	Answers a BB query on all the metas of a soft proxy
+	:param proxy_id:
+	:param bb: list [minx, miny, maxx, maxy]
+	:return: dict with meta_ids as keys and lists of feature collections as values (as the upsert section of a response_read), metas without matches are left out
+	"""
+
+	locker = proxy_lock.ProxyLocker (retries=3, wait=5)
+
+	results = {}
+	for currentmeta in proxy_manifest.getManifest(proxy_id)['metadata']:
+		meta_json = locker.performLocked(queryMetaBB, proxy_id, currentmeta['name'], bb)
+		if len(meta_json) > 0:
+			results[currentmeta['name']] = meta_json
+
+	return results
+
+@proxy_lock.lockable
+def queryMetaInventory (proxy_id, meta_id, inventory):
+	"""
+	Answers an inventory query on a meta from the inventory summaries of its shapes (see proxy_summary); shapes without a usable summary are summarized from their geojson file, and the values a summary cannot count exactly (beyond conf.inventory_max_values) are counted by reading the geojson file of the shape
+	:param proxy_id:
+	:param meta_id:
+	:param inventory: dict, as in the query section of a request_query (see proxy_summary.countInventory)
+	:return: dict with the feature counts, see proxy_summary.countInventory
+	"""
+
+	path_gj_meta = os.path.join (conf.baseproxypath, proxy_id, conf.path_geojson, meta_id)
+
+	summaries = []
+	if os.path.exists(path_gj_meta):
+		for shape_id in sorted(os.listdir(path_gj_meta)):
+			# hidden files are versions still being written
+			if shape_id.startswith("."):
+				continue
 			try:
-				meta_json.append(json.load(fp))
-			except:
-				raise RuntimeProxyException ("Non valid json data in file %s for meta %s on proxy %s" % (filename, meta_id, proxy_id))
-			finally:
-				fp.close()
-		except:
-			raise RuntimeProxyException ("Could not access map data %s for meta %s on proxy %s" % (filename, meta_id, proxy_id))
+				summary = proxy_summary.loadShapeSummary(proxy_id, meta_id, shape_id)
+				if summary is None:
+					summary = proxy_summary.summarizeShape(proxy_id, meta_id, shape_id)
+				overflow = proxy_summary.getOverflowKeys(summary, inventory)
+				if len(overflow) > 0:
+					gj_fp = proxy_json.openText(os.path.join(path_gj_meta, shape_id), 'r')
+					try:
+						summary = proxy_summary.completeSummary(summary, overflow, readCollectionHeader(gj_fp)['features'])
+					finally:
+						gj_fp.close()
+			except (IOError, OSError, ValueError):
+				raise RuntimeProxyException ("Could not query map data %s for meta %s on proxy %s" % (shape_id, meta_id, proxy_id))
+			summaries.append(summary)
+
+	return proxy_summary.countInventory(summaries, inventory)
+
+def queryProxyInventory (proxy_id, inventory):
+	"""
+	Answers an inventory query on all the metas of a soft proxy
+	:param proxy_id:
+	:param inventory: dict, see proxy_summary.countInventory
+	:return: dict with meta_ids as keys and the feature counts of each meta as values
+	"""
+
+	locker = proxy_lock.ProxyLocker (retries=3, wait=5)
+
+	results = {}
+	for currentmeta in proxy_manifest.getManifest(proxy_id)['metadata']:
+		results[currentmeta['name']] = locker.performLocked(queryMetaInventory, proxy_id, currentmeta['name'], inventory)
+
+	return results
+
+@proxy_lock.lockable
+def queryMetaTime (proxy_id, meta_id, timefilter):
+	"""
+	Answers a time query on a meta: returns the features of its shapes with a time in the requested range, read through the time indexes of the shapes (see proxy_summary). Features without a time match if the time range of the meta in the manifest does
+	:param proxy_id:
+	:param meta_id:
+	:param timefilter: string, ISO 8601 interval as in the query section of a request_query
+	:return: list of feature collections (dicts from json) with the matching features, shapes without matches are left out
+	"""
+
+	timerange = proxy_summary.parseTimeFilter(timefilter)
+
+	metainfo = proxy_manifest.getMeta(proxy_id, meta_id)
+	if metainfo is None:
+		raise InvalidMetaException ("Could not find meta_id %s in proxy %s" % (meta_id, proxy_id))
+	includeuntimed = proxy_summary.isMetaInTimeRange(metainfo, timerange)
+
+	path_gj_meta = os.path.join (conf.baseproxypath, proxy_id, conf.path_geojson, meta_id)
+	if not os.path.exists(path_gj_meta):
+		return []
+
+	meta_json = []
+	for shape_id in sorted(os.listdir(path_gj_meta)):
+		# hidden files are versions still being written
+		if shape_id.startswith("."):
+			continue
+		try:
+			features = proxy_summary.searchShapeTime(proxy_id, meta_id, shape_id, timerange, includeuntimed)
+		except (IOError, OSError, ValueError):
+			raise RuntimeProxyException ("Could not query map data %s for meta %s on proxy %s" % (shape_id, meta_id, proxy_id))
 
+		if len(features) == 0:
+			continue
+
+		meta_json.append({
+			'id': shape_id,
+			'type': 'FeatureCollection',
+			'features': features
+		})
 
 	return meta_json
 
-def rebuildShape (proxy_id, meta_id, shape_id, modified=True):
+def queryProxyTime (proxy_id, timefilter):
 	"""
-	Rebuilds the GeoJSON data for the specified shape file, from the .tmp subdir if the file is marked as modified. Returns the geojson dict
+	Answers a time query on all the metas of a soft proxy
+	:param proxy_id:
+	:param timefilter: string, ISO 8601 interval
+	:return: dict with meta_ids as keys and lists of feature collections as values, metas without matches are left out
+	"""
+
+	locker = proxy_lock.ProxyLocker (retries=3, wait=5)
+
+	results = {}
+	for currentmeta in proxy_manifest.getManifest(proxy_id)['metadata']:
+		meta_json = locker.performLocked(queryMetaTime, proxy_id, currentmeta['name'], timefilter)
+		if len(meta_json) > 0:
+			results[currentmeta['name']] = meta_json
+
+	return results
+
+@proxy_lock.lockable
+def rebuildShape (proxy_id, meta_id, shape_id, modified=True, archivehash=None):
+	"""
+	Rebuilds the GeoJSON data for the specified shape file, from the staging area if the file is marked as modified. Returns the geojson dict
+	Shapes whose content has been converted before are read from the conversion cache instead (see proxy_cache): an upload is keyed by the hash of its archive, the mirror data by the hash of its files. The converted shapes are added to the cache as their features are consumed
 	:param proxy_id:
 	:param meta_id:
 	:param shape_id:
 	:param modified:
-	:return: dict, geojson data
+	:param archivehash: content hash of the uploaded archive, as returned by handleUpsert
+	:return: dict, geojson data (features are read lazily from the shapefile or from the cache, see convertShapefileToJson)
 	"""
 
 
-	path_shape = os.path.join(conf.baseproxypath, proxy_id, conf.path_mirror, meta_id, shape_id)
 	if modified:
-		path_shape = os.path.join(path_shape, ".tmp")
+		path_shape = getUpsertSourcePath(proxy_id, meta_id, shape_id)
+	else:
+		path_shape = os.path.join(conf.baseproxypath, proxy_id, conf.path_mirror, meta_id, shape_id)
 
-	shape_gj = convertShapefileToJson (path_shape)
+	cache = proxy_cache.getConversionCache()
+	cachekey = None
+	if cache is not None:
+		if modified and archivehash is not None:
+			cachekey = cache.getContentKey(archivehash)
+		else:
+			cachekey = cache.getShapeKey(path_shape)
+
+	if cachekey is None:
+		return convertShapefileToJson (path_shape, shape_id)
+
+	def convertShape ():
+		# for an entry evicted before it is read
+		shape_gj = convertShapefileToJson (path_shape, shape_id)
+		if shape_gj is False:
+			raise RuntimeProxyException ("Could not read shape data for %s/%s on proxy %s" % (meta_id, shape_id, proxy_id))
+		return cache.storeFeatures(cachekey, shape_gj['features'])
+
+	features = cache.getFeatures(cachekey, convertShape)
+	if features is not None:
+		proxy_metrics.count("conversion_cache", op="hit")
+		return {
+			'id' : shape_id,
+			'type': 'FeatureCollection',
+			'features' : features
+		}
+
+	proxy_metrics.count("conversion_cache", op="miss")
+	shape_gj = convertShapefileToJson (path_shape, shape_id)
+	if shape_gj is not False:
+		shape_gj['features'] = cache.storeFeatures(cachekey, shape_gj['features'])
 
 	return shape_gj
 
-def replicateShapeData (shapedata, proxy_id, meta_id, shape_id, modified=True):
+@proxy_lock.lockable
+def replicateShapeData (shapedata, proxy_id, meta_id, shape_id, modified=True, archivehash=None):
 	"""
-	Saves the current geojson data for a specific shape to the geojson directory. If modified is true, the .tmp directory in the mirror section replaces the old data
-	:param shapedata:
+	Saves the current geojson data for a specific shape to the geojson directory. If modified is true, the staging directory in the mirror section replaces the old data
+	Both the geojson file and the mirror directory are written aside and swapped in with a rename, so they are never seen partially written
+	:param shapedata: feature collection as returned by rebuildShape
 	:param proxy_id:
 	:param meta_id:
 	:param shape_id:
-	:return:
+	:param archivehash: content hash of the uploaded archive, as returned by handleUpsert; recorded with the new mirror data so an identical upload is skipped
+	:return: dict with the number of added, changed and deleted features
 	"""
 
+	if shapedata is False:
+		raise RuntimeProxyException ("Could not read shape data for %s/%s on proxy %s" % (meta_id, shape_id, proxy_id))
+
+	path_gj_meta = os.path.join(conf.baseproxypath, proxy_id, conf.path_geojson, meta_id)
+	if not os.path.exists(path_gj_meta):
+		os.makedirs(path_gj_meta)
+
+	# features are streamed from the shapefile straight into the geojson file, so memory use does not depend on the size of the shape
+	# while they pass we compare them with the stored feature hashes to build the diff that will be sent to the main server
+	# the envelopes, attributes and times of the features go, with their position in the file, to the indexes of the shape used by the queries
+	tracker = proxy_diff.FeatureDiffTracker(proxy_id, meta_id, shape_id)
+	spatialindex = proxy_spatial.SpatialIndexBuilder(proxy_id, meta_id, shape_id)
+	summaryindex = proxy_summary.SummaryIndexBuilder(proxy_id, meta_id, shape_id)
+	collection = dict(shapedata)
+	collection['features'] = tracker.track(proxy_metrics.timeIterator("convert", shapedata['features']))
+
+	def indexFeature (fid, featurejson, offset, length, feature):
+		# parsed at most once for all the indexes, features read from the shapefiles come already parsed
+		if feature is None:
+			feature = proxy_json.loads(featurejson)
+		spatialindex.add(fid, feature, offset, length)
+		summaryindex.add(fid, feature, offset, length)
+
+	path_gj = os.path.join(path_gj_meta, shape_id)
+	path_gj_new = proxy_publish.getTempFilePath(path_gj)
 	try:
-		shape_fp = open (os.path.join(conf.baseproxypath, proxy_id, conf.path_geojson, meta_id, shape_id))
-		json.dump(shapedata, shape_fp)
-		shape_fp.close()
+		shape_fp = proxy_json.openText(path_gj_new, 'w')
+		try:
+			written = writeFeatureCollection(collection, shape_fp, indexFeature)
+		finally:
+			shape_fp.close()
+		spatialindex.commit(path_gj_new)
+		summaryindex.commit(path_gj_new)
+		if modified and conf.upsert_from_archive:
+			# the conversion read the archive directly, this is the only time its content is written out; done before publishing anything, as it fails if the archive has changed meanwhile
+			stageArchive(proxy_id, meta_id, shape_id, archivehash)
 	except:
 		#TODO: add more complex exception handling
+		tracker.discard()
+		spatialindex.discard()
+		summaryindex.discard()
+		if os.path.exists(path_gj_new):
+			os.remove(path_gj_new)
 		raise
 
+	diffstats = tracker.commit()
+	proxy_metrics.count("features", written, op="written")
+	for op in ('added', 'changed', 'deleted'):
+		proxy_metrics.count("features", diffstats[op], op=op)
+	if conf.metrics_enabled:
+		proxy_metrics.count("bytes", os.path.getsize(path_gj_new), kind="geojson")
+	proxy_publish.publishFile(path_gj_new, path_gj)
+	# an index that does not match the published geojson file is ignored by the queries, so these further renames are safe
+	spatialindex.publish()
+	summaryindex.publish()
+
 	if modified:
-		# we replace the mirror directory contents with the .tmp directory
+		# the staging directory replaces the mirror directory in a single rename, no file is copied
 		path_mirror = os.path.join(conf.baseproxypath, proxy_id, conf.path_mirror, meta_id, shape_id)
-		path_mirror_tmp = os.path.join(path_mirror, ".tmp")
-
-
-		# TODO: add handling for remove errors, should we have any "strays"
-		for filename in os.listdir(path_mirror):
-			if filename != ".tmp":
-				os.remove(os.path.join(path_mirror, filename))
-
-		# TODO: add handling for remove errors to avoid data losses
-		for filename in os.listdir(path_mirror_tmp):
-			shutil.copy(os.path.join(path_mirror_tmp, filename), path_mirror)
+		proxy_publish.publishDirectory(proxy_publish.getStagingPath(proxy_id, meta_id, shape_id), path_mirror)
+		# without a hash the content of the new mirror data is unknown, the next upload is never skipped
+		if archivehash is None:
+			removeArchiveHash(proxy_id, meta_id, shape_id)
+		else:
+			recordArchiveHash(proxy_id, meta_id, shape_id, archivehash)
 
-		shutil.rmtree (path_mirror_tmp)
+	return diffstats
 
+@proxy_lock.lockable
 def rebuildMeta (proxy_id, meta_id, upserts=None):
 	"""
-	Rebuilds the GeoJSON data for the specified meta, taking the requested upserts from their .tmp dirs instead. Note that the data has been already partially validated and extracted
+	Rebuilds the GeoJSON data for the specified meta, taking the requested upserts from their staging dirs instead. Note that the data has been already partially validated and extracted
+	The shapes (and the large layers, split in ranges) are converted in parallel by the worker processes of proxy_convert, see conf.conversion_workers. Shapes whose files are unchanged since a previous conversion are read from the conversion cache instead (see proxy_cache); the converted ones are added to it as their features are consumed
 	:param proxy_id:
 	:param meta_id:
-	:param upserts: list with the elements in the meta that must be taken from their own .tmp dir rather than from the main $mirror branch
+	:param upserts: list with the elements in the meta that must be taken from their staging dir rather than from the main $mirror branch
 	:return: dict of geojson elements, with shape_ids as key
 	"""
 
+	if upserts is None:
+		upserts = []
+
 	path_meta = os.path.join(conf.baseproxypath, proxy_id, conf.path_mirror, meta_id)
 
-	shapelist = os.listdir(path_meta)
+	shapelist = sorted(os.listdir(path_meta))
 
-	shapes_gj = {}
+	shapes = []
 	for shape_id in shapelist:
+		# hidden entries are the staging area, not shapes
+		if shape_id.startswith("."):
+			continue
 		if shape_id in upserts:
-			modified = True
+			path_shape = getUpsertSourcePath(proxy_id, meta_id, shape_id)
 		else:
-			modified = False
-		shapes_gj [shape_id] = rebuildShape(proxy_id, meta_id, shape_id, modified)
+			path_shape = os.path.join(path_meta, shape_id)
+		shapes.append((shape_id, path_shape))
+
+	cache = proxy_cache.getConversionCache()
+
+	def getConverter (shape_id, path_shape, cachekey):
+		# for an entry evicted before it is read, the shape is converted in this process
+		def convertShape ():
+			shape_gj = convertShapefileToJson (path_shape, shape_id)
+			if shape_gj is False:
+				raise RuntimeProxyException ("Could not read shape data for %s/%s on proxy %s" % (meta_id, shape_id, proxy_id))
+			return cache.storeFeatures(cachekey, shape_gj['features'])
+		return convertShape
+
+	shapes_gj = {}
+	cachekeys = {}
+	if cache is not None:
+		toconvert = []
+		for shape_id, path_shape in shapes:
+			cachekey = cache.getShapeKey(path_shape)
+			features = None
+			if cachekey is not None:
+				features = cache.getFeatures(cachekey, getConverter(shape_id, path_shape, cachekey))
+			if features is None:
+				toconvert.append((shape_id, path_shape))
+				cachekeys[shape_id] = cachekey
+				proxy_metrics.count("conversion_cache", op="miss")
+			else:
+				shapes_gj[shape_id] = {
+					'id' : shape_id,
+					'type': 'FeatureCollection',
+					'features' : features
+				}
+				proxy_metrics.count("conversion_cache", op="hit")
+		shapes = toconvert
+
+	if len(shapes) > 0:
+		converted = proxy_convert.convertShapes(shapes)
+		for shape_id, shape_gj in converted.items():
+			if shape_gj is not False and cachekeys.get(shape_id) is not None:
+				shape_gj['features'] = cache.storeFeatures(cachekeys[shape_id], shape_gj['features'])
+		shapes_gj.update(converted)
 
 	return shapes_gj
 
+@proxy_lock.lockable
 def queueForSend (proxy_id, meta_id):
 	"""
-	Adds a metadata to the list of updated files for this proxy
+	Adds a metadata to the list of updated files for this proxy (see proxy_journal)
 	:param proxy_id:
 	:param meta_id:
-	:return:
+	:return: sequence number of the update in the journal
 	"""
 
-	nextfilepath = os.path.join (conf.baseproxypath, proxy_id, "next", meta_id)
-
-	open(nextfilepath, 'w').close()
+	return proxy_journal.getJournal(proxy_id).append(meta_id)
 
 
 
@@ -0,0 +1,289 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+__author__ = 'Antonio Vaccarino'
+__docformat__ = 'restructuredtext en'
+
+import os
+import sys
+import socket
+import signal
+import threading
+
+try:
+	import SocketServer as socketserver
+except ImportError:
+	import socketserver
+
+from errors import *
+import proxy_config_core as conf
+import proxy_watch
+import proxy_sender
+
+"""
+Persistent ProxyFS service. Instead of starting a new interpreter (with the ogr and ArDiVa imports and the manifest parsing) for every filesystem event, the FS monitor launches this module as a light client that passes the event path to a long-running daemon over a local unix socket. The daemon handles the events in a single warm process through ProxyFS.handleFSChange, so the handling semantics are the same as the one-shot entry point.
+Events are merged per shape archive and handled concurrently for different shapes (see proxy_watch.EventCoalescer). With conf.watch_uploads the daemon also watches the upload tree by itself and no external FS monitor is needed; with conf.send_scheduler it also sends the updates of all the proxies to the main server.
+
+Usage:
+	proxy_daemon.py serve			starts the daemon
+	proxy_daemon.py $eventpath		sends the event to the daemon, falls back to ProxyFS in-process if no daemon is listening
+"""
+
+USAGE = """Usage:
+	%(prog)s serve			starts the daemon
+	%(prog)s $eventpath		sends the event to the daemon, falls back to ProxyFS in-process if no daemon is listening
+"""
+
+
+class EventRequestHandler (socketserver.StreamRequestHandler):
+	"""
+	Reads newline terminated event paths from a client connection and queues them for the daemon worker. Each path is acknowledged with OK once queued; relative paths are refused with ERR, as the working directory of the client is unknown here
+	"""
+
+	def handle (self):
+
+		for line in self.rfile:
+			eventpath = line.decode('utf-8').strip()
+			if eventpath == "":
+				continue
+			if eventpath == "PING":
+				self.wfile.write(b"PONG\n")
+				continue
+			if not os.path.isabs(eventpath):
+				self.wfile.write(b"ERR relative path\n")
+				continue
+
+			self.server.daemon_ref.queueEvent(eventpath)
+			try:
+				self.wfile.write(b"OK\n")
+				self.wfile.flush()
+			except socket.error:
+				# the client stopped waiting, the event stays queued
+				return
+
+	def finish (self):
+
+		try:
+			socketserver.StreamRequestHandler.finish(self)
+		except socket.error:
+			# an acknowledgement the client stopped waiting for, still buffered
+			pass
+
+
+class EventServer (socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+	daemon_threads = True
+
+
+class ProxyDaemon ():
+	"""
+	Long running ProxyFS process. Receives event paths on a unix socket (and optionally from an inotify watch on the upload tree) and hands them to ProxyFS.handleFSChange once each shape archive is quiet
+	"""
+
+	def __init__ (self, socketpath=None, handler=None, watch=None, scheduler=None):
+
+		if socketpath is None:
+			socketpath = conf.daemon_socket
+		self.socketpath = socketpath
+
+		# the handler defaults to the standard ProxyFS entry point; imported here so the client side of this module stays light
+		if handler is None:
+			import ProxyFS
+			handler = ProxyFS.handleFSChange
+		self.handler = handler
+
+		if watch is None:
+			watch = conf.watch_uploads
+		self.watch = watch
+
+		if scheduler is None:
+			scheduler = conf.send_scheduler
+		self.scheduler = None
+		if scheduler:
+			self.scheduler = proxy_sender.SendScheduler()
+
+		self.events = proxy_watch.EventCoalescer(self.handler)
+		self.watcher = None
+		self.server = None
+		self.metricsserver = None
+
+	def queueEvent (self, eventpath):
+		"""
+		Adds an event path to the processing queue, repeated events on the same path are merged
+		:param eventpath:
+		:return:
+		"""
+		self.events.addEvent(os.path.realpath(eventpath))
+
+	def start (self):
+		"""
+		Opens the socket and starts the workers and, if required, the upload watcher
+		:return:
+		"""
+
+		if os.path.exists(self.socketpath):
+			if isDaemonRunning(self.socketpath):
+				raise InternalProxyException ("A ProxyFS daemon is already listening on %s" % self.socketpath)
+			# stale socket left by a crashed daemon
+			os.remove(self.socketpath)
+
+		self.server = EventServer(self.socketpath, EventRequestHandler)
+		self.server.daemon_ref = self
+
+		self.events.start()
+
+		if self.watch:
+			self.watcher = proxy_watch.UploadWatcher(self.queueEvent)
+			self.watcher.start()
+
+		if self.scheduler is not None:
+			self.scheduler.start()
+
+		if conf.metrics_http_port is not None:
+			# imported here, as ProxyFS, to keep the client side of this module light
+			import proxy_metrics
+			self.metricsserver = proxy_metrics.startMetricsServer()
+
+	def serveForever (self):
+		"""
+		Runs the daemon until stop() is called (SIGTERM and SIGINT call it too)
+		:return:
+		"""
+
+		self.start()
+		try:
+			self.server.serve_forever()
+		finally:
+			self.drain()
+
+	def stop (self):
+		"""
+		Stops accepting connections, serveForever then completes the events already queued
+		:return:
+		"""
+		# shutdown blocks until the serve loop exits, so it must not run in the serving thread (signal handlers do)
+		stopper = threading.Thread(target=self.server.shutdown)
+		stopper.daemon = True
+		stopper.start()
+
+	def drain (self):
+		"""
+		Processes the remaining events and releases the socket
+		:return:
+		"""
+
+		if self.watcher is not None:
+			self.watcher.stop()
+
+		self.server.server_close()
+		try:
+			os.remove(self.socketpath)
+		except OSError:
+			pass
+
+		self.events.stop()
+
+		if self.scheduler is not None:
+			self.scheduler.stop()
+
+		if self.metricsserver is not None:
+			self.metricsserver.shutdown()
+			self.metricsserver.server_close()
+
+
+def isDaemonRunning (socketpath=None):
+	"""
+	Checks if a daemon is answering on the socket
+	:param socketpath:
+	:return: boolean
+	"""
+
+	if socketpath is None:
+		socketpath = conf.daemon_socket
+
+	try:
+		return sendToDaemon("PING", socketpath) == "PONG"
+	except (socket.error, OSError):
+		return False
+
+
+def sendToDaemon (eventpath, socketpath=None):
+	"""
+	Passes an event path to the daemon and returns its answer. Errors connecting or sending are raised, while once the path has been sent a late answer is not an error: the daemon may have queued the event already
+	:param eventpath: absolute path
+	:param socketpath:
+	:return: string, the daemon reply (OK once the event has been queued, empty if the daemon closed the connection without answering), None if no reply came within conf.daemon_client_timeout
+	"""
+
+	if socketpath is None:
+		socketpath = conf.daemon_socket
+
+	client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+	client.settimeout(conf.daemon_client_timeout)
+	try:
+		client.connect(socketpath)
+		client.sendall(eventpath.encode('utf-8') + b"\n")
+		client.shutdown(socket.SHUT_WR)
+		reply = b""
+		try:
+			while not reply.endswith(b"\n"):
+				chunk = client.recv(64)
+				if not chunk:
+					break
+				reply += chunk
+		except (socket.timeout, socket.error):
+			return None
+	finally:
+		client.close()
+
+	return reply.decode('utf-8').strip()
+
+
+def runDaemon ():
+	"""
+	Starts the daemon in the current process, SIGTERM and SIGINT stop it after the queued events are processed
+	:return:
+	"""
+
+	proxydaemon = ProxyDaemon()
+
+	def onSignal (signum, frame):
+		proxydaemon.stop()
+
+	signal.signal(signal.SIGTERM, onSignal)
+	signal.signal(signal.SIGINT, onSignal)
+
+	proxydaemon.serveForever()
+
+
+def notifyEvent (eventpath):
+	"""
+	Client side entry point for the FS monitor. The event is sent to the daemon; if it cannot be delivered (no daemon listening) or the daemon refuses it, the event is handled in this process as the old one-shot ProxyFS did. A delivered event whose acknowledgement is late is left to the daemon, handling it here too would process the upload twice
+	:param eventpath: path of the event, relative paths are resolved here against the working directory of the client
+	:return:
+	"""
+
+	eventpath = os.path.realpath(eventpath)
+
+	try:
+		reply = sendToDaemon(eventpath)
+	except (socket.error, OSError):
+		reply = ""
+
+	if reply == "OK":
+		return
+	if reply is None:
+		sys.stderr.write("No acknowledgement from the ProxyFS daemon within %s s for %s, the event is left to the daemon\n" % (conf.daemon_client_timeout, eventpath))
+		return
+
+	import ProxyFS
+	ProxyFS.handleFSChange(eventpath)
+
+
+if __name__ == "__main__":
+	if len(sys.argv) != 2:
+		sys.stderr.write(USAGE % {"prog": os.path.basename(sys.argv[0])})
+		sys.exit(2)
+	if sys.argv[1] == "serve":
+		runDaemon()
+	else:
+		notifyEvent(sys.argv[1])
@@ -0,0 +1,553 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+__author__ = 'Antonio Vaccarino'
+__docformat__ = 'restructuredtext en'
+
+import os
+import sys
+import json
+import shutil
+import hashlib
+import collections
+
+from errors import *
+import proxy_config_core as conf
+import proxy_lock
+import proxy_json
+
+"""
+Feature level diffs of the replicated shapes.
+For every shape the proxy keeps the content hash of each feature ($proxy/maps/hashes/$meta/$shape, one "fid<TAB>hash" line per feature after a "backend<TAB>$name" line with the json backend that wrote the features), where fid is the identity given by getFeatureKey, also written as the id of the feature. When a shape is replicated the new features are compared against these hashes and only the added, changed and deleted features are appended to the pending diff of the shape ($proxy/maps/diff/$meta/$shape).
+Pending diffs are line based: "U<TAB>fid<TAB>geojson" for upserts and "D<TAB>fid" for deletes, a later line on the same fid replaces the earlier ones. When updates are sent the diffs of a meta are claimed (moved to maps/diff/.sending/$meta) and removed only after the main server has received them, so a failed send is merged into the next one. Claimed diffs larger than a request are split in parts sent in separate requests (see splitMetaDiff).
+"""
+
+SENDING_DIR = ".sending"
+
+
+def getHashesPath (proxy_id, meta_id, shape_id):
+	return os.path.join(conf.baseproxypath, proxy_id, conf.path_hashes, meta_id, shape_id)
+
+def getDiffPath (proxy_id, meta_id, shape_id=None):
+	if shape_id is None:
+		return os.path.join(conf.baseproxypath, proxy_id, conf.path_diff, meta_id)
+	return os.path.join(conf.baseproxypath, proxy_id, conf.path_diff, meta_id, shape_id)
+
+def getSendingPath (proxy_id, meta_id):
+	return os.path.join(conf.baseproxypath, proxy_id, conf.path_diff, SENDING_DIR, meta_id)
+
+def getFeatureKey (feature, layername, featuredict=None):
+	"""
+	Returns the identity of a feature in the diffs of its shape: the value of its conf.feature_id_attribute field if set, else the layer name and the OGR FID ("$layer:$fid")
+	The key is also the id of the feature sent to the main server, so the upserts and the deletes of a feature ("$meta/$shape/$key", see assembleMetaDiff) refer to the same id
+	The fallback is based on record numbers: for shapefiles the FID is the position of the record, so removing or reordering records shifts the keys of all the following ones and the diff reports them as deleted and upserted again. Set conf.feature_id_attribute to keep the diffs limited to the features actually changed. The id attribute must be unique across all the layers of a shape; features without a value for it fall back to the layer name and FID
+	:param feature: OGR feature
+	:param layername: name of the layer of the feature
+	:param featuredict: geojson dict of the feature, its id (the OGR FID) is replaced by the id attribute value or by the fallback key
+	:return: string
+	"""
+
+	if conf.feature_id_attribute is not None:
+		fieldindex = feature.GetFieldIndex(conf.feature_id_attribute)
+		if fieldindex >= 0 and feature.IsFieldSet(fieldindex):
+			value = feature.GetField(fieldindex)
+			if featuredict is not None:
+				featuredict['id'] = value
+			return getIdKey(value)
+
+	key = "%s:%s" % (layername, feature.GetFID())
+	if featuredict is not None:
+		featuredict['id'] = key
+	return key
+
+def getIdKey (value):
+	"""
+	Returns the feature key of a feature id, i.e. of the value of its id attribute or of the fallback key (see getFeatureKey)
+	:param value:
+	:return: string
+	"""
+
+	if sys.version_info[0] < 3 and isinstance(value, unicode):
+		value = value.encode('utf-8')
+	# the keys are written in tab separated lines
+	return ("%s" % value).replace("\t", " ").replace("\n", " ")
+
+def hashFeature (featurejson):
+	if not isinstance(featurejson, bytes):
+		featurejson = featurejson.encode('utf-8')
+	return hashlib.sha1(featurejson).hexdigest()
+
+def isFeatureHash (value):
+	return len(value) == 40 and all(c in "0123456789abcdef" for c in value)
+
+def loadFeatureHashes (proxy_id, meta_id, shape_id, rehash=True):
+	"""
+	Reads the stored feature hashes of a shape.
+	The hashes are of the feature text written by the json backend recorded in the first line of the file (see proxy_json, backends differ in the text of some values). If another backend is in use the stored features are hashed again as the current backend writes them (see rehashFeatures), so that changing the backend does not make every feature look changed
+	:param proxy_id:
+	:param meta_id:
+	:param shape_id:
+	:param rehash: if False the hashes are returned as stored, whatever the backend
+	:return: dict fid -> hash, empty if the shape has never been replicated
+	"""
+
+	hashes = {}
+	fids = []
+	hashesbackend = None
+	path_hashes = getHashesPath(proxy_id, meta_id, shape_id)
+	if not os.path.exists(path_hashes):
+		return hashes
+
+	fp = proxy_json.openText(path_hashes, 'r')
+	try:
+		for line in fp:
+			fid, fhash = line.rstrip("\n").rsplit("\t", 1)
+			# hashes files written before the backend was recorded have no header
+			if len(fids) == 0 and hashesbackend is None and not isFeatureHash(fhash):
+				hashesbackend = fhash
+				continue
+			hashes[fid] = fhash
+			fids.append(fid)
+	finally:
+		fp.close()
+
+	if rehash and hashesbackend != proxy_json.backend and len(fids) > 0:
+		rehashed = rehashFeatures(proxy_id, meta_id, shape_id, fids)
+		if rehashed is not None:
+			return rehashed
+
+	return hashes
+
+def rehashFeatures (proxy_id, meta_id, shape_id, fids):
+	"""
+	Hashes the features in the geojson file of a shape as the current json backend writes them. The features are in the file in the same order as in the hashes file, each one is checked against its fid
+	:param proxy_id:
+	:param meta_id:
+	:param shape_id:
+	:param fids: fids of the stored hashes, in file order
+	:return: dict fid -> hash, None if the geojson file does not match the fids
+	"""
+
+	path_gj = os.path.join(conf.baseproxypath, proxy_id, conf.path_geojson, meta_id, shape_id)
+	try:
+		gj_fp = proxy_json.openText(path_gj, 'r')
+	except IOError:
+		return None
+
+	hashes = {}
+	try:
+		# one feature per line, see proxy_core.writeFeatureCollection
+		if not gj_fp.readline().rstrip().endswith('"features": ['):
+			return None
+		for fid in fids:
+			line = gj_fp.readline().rstrip()
+			if line.endswith(','):
+				line = line[:-1]
+			if line == '' or line.startswith(']'):
+				return None
+			# parsed by json, which keeps every value as it was (orjson reads integers beyond 64 bits as floats), and with the members in their order in the file
+			feature = json.loads(line, object_pairs_hook=collections.OrderedDict)
+			if feature.get('id') is None or getIdKey(feature['id']) != fid:
+				return None
+			hashes[fid] = hashFeature(proxy_json.dumps(feature))
+	finally:
+		gj_fp.close()
+
+	return hashes
+
+
+class FeatureDiffTracker ():
+	"""
+	Computes the diff of a shape while its new features are streamed to the geojson file. Wrap the features iterator with track(), consume it, then call commit() to store the new hashes and append the diff to the pending one (or discard() on failure)
+	"""
+
+	def __init__ (self, proxy_id, meta_id, shape_id):
+
+		self.proxy_id = proxy_id
+		self.meta_id = meta_id
+		self.shape_id = shape_id
+
+		self.oldhashes = loadFeatureHashes(proxy_id, meta_id, shape_id)
+
+		self.path_hashes = getHashesPath(proxy_id, meta_id, shape_id)
+		self.path_diff = getDiffPath(proxy_id, meta_id, shape_id)
+		for path in (self.path_hashes, self.path_diff):
+			if not os.path.exists(os.path.dirname(path)):
+				os.makedirs(os.path.dirname(path))
+
+		self.hashes_fp = proxy_json.openText(self.path_hashes+".tmp", 'w')
+		self.hashes_fp.write("backend\t%s\n" % proxy_json.backend)
+		self.diff_fp = proxy_json.openText(self.path_diff+".tmp", 'w')
+
+		self.added = 0
+		self.changed = 0
+		self.deleted = 0
+
+	def track (self, features):
+		"""
+		Generator that passes the features through unchanged (with the fid as string) while recording their hashes and diff entries
+		:param features: iterable of (fid, geojson string) pairs or (fid, geojson string, geojson dict) triples, see proxy_core.writeFeatureCollection; fids are the keys of getFeatureKey
+		:return:
+		"""
+
+		for item in features:
+			fid = str(item[0])
+			featurejson = item[1]
+			fhash = hashFeature(featurejson)
+			oldhash = self.oldhashes.pop(fid, None)
+
+			if oldhash != fhash:
+				if oldhash is None:
+					self.added += 1
+				else:
+					self.changed += 1
+				self.diff_fp.write("U\t%s\t%s\n" % (fid, featurejson))
+
+			self.hashes_fp.write("%s\t%s\n" % (fid, fhash))
+
+			yield (fid,) + tuple(item[1:])
+
+	def commit (self):
+		"""
+		Completes the diff with the features that were not in the new data, stores the new hashes and appends the diff to the pending one
+		:return: dict with the count of added, changed and deleted features
+		"""
+
+		# whatever is left from the old hashes is not in the shape any more
+		for fid in self.oldhashes:
+			self.diff_fp.write("D\t%s\n" % fid)
+			self.deleted += 1
+		self.oldhashes = {}
+
+		self.hashes_fp.close()
+		self.diff_fp.close()
+
+		appendDiff(self.path_diff+".tmp", self.path_diff)
+		os.remove(self.path_diff+".tmp")
+		os.rename(self.path_hashes+".tmp", self.path_hashes)
+
+		return {
+			'added': self.added,
+			'changed': self.changed,
+			'deleted': self.deleted
+		}
+
+	def discard (self):
+
+		self.hashes_fp.close()
+		self.diff_fp.close()
+		for path in (self.path_hashes+".tmp", self.path_diff+".tmp"):
+			if os.path.exists(path):
+				os.remove(path)
+
+
+def appendDiff (path_source, path_dest):
+	"""
+	Appends the diff lines of a file to another diff file
+	:param path_source:
+	:param path_dest:
+	:return:
+	"""
+
+	source_fp = proxy_json.openText(path_source, 'r')
+	try:
+		dest_fp = proxy_json.openText(path_dest, 'a')
+		try:
+			shutil.copyfileobj(source_fp, dest_fp)
+		finally:
+			dest_fp.close()
+	finally:
+		source_fp.close()
+
+
+def recordShapeDelete (proxy_id, meta_id, shape_id):
+	"""
+	Marks every feature of a removed shape as deleted in the pending diff and drops its hashes
+	:param proxy_id:
+	:param meta_id:
+	:param shape_id:
+	:return: number of deleted features
+	"""
+
+	oldhashes = loadFeatureHashes(proxy_id, meta_id, shape_id, rehash=False)
+	if len(oldhashes) == 0:
+		return 0
+
+	path_diff = getDiffPath(proxy_id, meta_id, shape_id)
+	if not os.path.exists(os.path.dirname(path_diff)):
+		os.makedirs(os.path.dirname(path_diff))
+
+	diff_fp = proxy_json.openText(path_diff, 'a')
+	try:
+		for fid in oldhashes:
+			diff_fp.write("D\t%s\n" % fid)
+	finally:
+		diff_fp.close()
+
+	os.remove(getHashesPath(proxy_id, meta_id, shape_id))
+
+	return len(oldhashes)
+
+
+@proxy_lock.lockable
+def claimMetaDiff (proxy_id, meta_id):
+	"""
+	Moves the pending diffs of a meta to its sending area, merging them with any diff left there by a failed send. Must run with a lock on the whole meta
+	:param proxy_id:
+	:param meta_id:
+	:return: list of shape_ids with claimed diffs
+	"""
+
+	path_pending = getDiffPath(proxy_id, meta_id)
+	path_sending = getSendingPath(proxy_id, meta_id)
+
+	if not os.path.exists(path_sending):
+		os.makedirs(path_sending)
+
+	if os.path.exists(path_pending):
+		for shape_id in os.listdir(path_pending):
+			if shape_id.endswith(".tmp"):
+				continue
+			path_shape = os.path.join(path_pending, shape_id)
+			path_claimed = os.path.join(path_sending, shape_id)
+			if os.path.exists(path_claimed):
+				appendDiff(path_shape, path_claimed)
+				os.remove(path_shape)
+			else:
+				os.rename(path_shape, path_claimed)
+
+	return sorted(os.listdir(path_sending))
+
+
+@proxy_lock.lockable
+def clearMetaDiff (proxy_id, meta_id):
+	"""
+	Removes the claimed diffs of a meta once they have been received by the main server
+	:param proxy_id:
+	:param meta_id:
+	:return:
+	"""
+
+	path_sending = getSendingPath(proxy_id, meta_id)
+	if os.path.exists(path_sending):
+		shutil.rmtree(path_sending)
+
+
+def iterDiffLines (path_diff, start=0, end=None):
+	"""
+	Generator over the lines of a diff file, or of the lines between two byte offsets
+	:param path_diff:
+	:param start: byte offset of the first line
+	:param end: byte offset where the lines end, None for the end of the file
+	:return: generator of native strings
+	"""
+
+	fp = open(path_diff, 'rb')
+	try:
+		fp.seek(start)
+		position = start
+		for line in fp:
+			if end is not None and position >= end:
+				break
+			position += len(line)
+			if sys.version_info[0] >= 3:
+				line = line.decode('utf-8')
+			yield line
+	finally:
+		fp.close()
+
+
+def indexShapeDiff (path_diff, start=0, end=None):
+	"""
+	First pass on a diff file: finds the latest entry of each feature
+	:param path_diff:
+	:param start: byte offset where the lines to read start, see iterDiffLines
+	:param end: byte offset where the lines to read end
+	:return: dict fid -> tuple (line number, operation) of its latest entry, line numbers counted from start
+	"""
+
+	latest = {}
+	for lineno, line in enumerate(iterDiffLines(path_diff, start, end)):
+		operation, fid = line.rstrip("\n").split("\t", 2)[:2]
+		latest[fid] = (lineno, operation)
+
+	return latest
+
+
+def readShapeDiff (path_diff, latest=None, start=0, end=None):
+	"""
+	Collapses a diff file so that only the latest entry of each feature is kept. The file is read twice so that memory holds only the feature ids and one feature at a time
+	:param path_diff:
+	:param latest: result of indexShapeDiff on the same lines, if already computed
+	:param start: byte offset where the lines to read start, see iterDiffLines
+	:param end: byte offset where the lines to read end
+	:return: generator of (operation, fid, geojson string or None), with operation U or D
+	"""
+
+	if latest is None:
+		latest = indexShapeDiff(path_diff, start, end)
+
+	for lineno, line in enumerate(iterDiffLines(path_diff, start, end)):
+		parts = line.rstrip("\n").split("\t", 2)
+		if latest.get(parts[1], (None,))[0] != lineno:
+			continue
+		if parts[0] == "U":
+			yield "U", parts[1], parts[2]
+		else:
+			yield "D", parts[1], None
+
+
+def compactShapeDiff (path_diff):
+	"""
+	Rewrites a diff file with only the latest entry of each feature, so that every feature appears in a single line
+	:param path_diff:
+	:return: size of the compacted file in bytes
+	"""
+
+	path_new = path_diff + ".tmp"
+	fp = proxy_json.openText(path_new, 'w')
+	try:
+		for operation, fid, featurejson in readShapeDiff(path_diff):
+			if operation == "U":
+				fp.write("U\t%s\t%s\n" % (fid, featurejson))
+			else:
+				fp.write("D\t%s\n" % fid)
+	finally:
+		fp.close()
+	os.rename(path_new, path_diff)
+
+	return os.path.getsize(path_diff)
+
+
+def splitMetaDiff (proxy_id, meta_id, maxbytes):
+	"""
+	Splits the claimed diffs of a meta (see claimMetaDiff) in parts of about maxbytes each, sent in separate requests. Small shape diffs are kept whole; a shape diff larger than a part is first compacted (see compactShapeDiff) and then cut at line boundaries, each range holding the complete entries of its features
+	The sizes are those of the diff files, so the bound applies to the feature data before compression; a single feature larger than maxbytes makes a part of its own
+	:param proxy_id:
+	:param meta_id:
+	:param maxbytes:
+	:return: list of parts, each a tuple (size in bytes, list of (shape_id, start offset, end offset or None) ranges for assembleMetaDiff)
+	"""
+
+	path_sending = getSendingPath(proxy_id, meta_id)
+	parts = []
+	if not os.path.exists(path_sending):
+		return parts
+
+	ranges = []
+	partsize = 0
+	for shape_id in sorted(os.listdir(path_sending)):
+		path_diff = os.path.join(path_sending, shape_id)
+		size = os.path.getsize(path_diff)
+		if size > maxbytes:
+			size = compactShapeDiff(path_diff)
+
+		if partsize + size <= maxbytes:
+			ranges.append((shape_id, 0, None))
+			partsize += size
+			continue
+
+		if size <= maxbytes:
+			parts.append((partsize, ranges))
+			ranges = [(shape_id, 0, None)]
+			partsize = size
+			continue
+
+		# cut at the line boundaries, each part is filled up before starting the next one
+		start = 0
+		position = 0
+		fp = open(path_diff, 'rb')
+		try:
+			for line in fp:
+				if partsize + len(line) > maxbytes and partsize > 0:
+					if position > start:
+						ranges.append((shape_id, start, position))
+					parts.append((partsize, ranges))
+					ranges = []
+					partsize = 0
+					start = position
+				position += len(line)
+				partsize += len(line)
+		finally:
+			fp.close()
+		if position > start:
+			ranges.append((shape_id, start, None))
+
+	if len(ranges) > 0:
+		parts.append((partsize, ranges))
+
+	return parts
+
+
+def iterShapeUpserts (path_diff, latest, start=0, end=None):
+	"""
+	Generator over the upserted features of a diff file
+	:param path_diff:
+	:param latest: result of indexShapeDiff
+	:param start: byte offset where the lines to read start, see iterDiffLines
+	:param end: byte offset where the lines to read end
+	:return: generator of geojson strings
+	"""
+
+	for operation, fid, featurejson in readShapeDiff(path_diff, latest, start, end):
+		if operation == "U":
+			yield featurejson
+
+
+class ShapeUpserts ():
+	"""
+	Upserted features of a diff file, for an ArrayStream: each iteration reads them again from the file, so a message holding them can be serialized again when its send is retried
+	"""
+
+	def __init__ (self, path_diff, latest, start=0, end=None):
+		self.path_diff = path_diff
+		self.latest = latest
+		self.start = start
+		self.end = end
+
+	def __iter__ (self):
+		return iterShapeUpserts(self.path_diff, self.latest, self.start, self.end)
+
+
+def assembleMetaDiff (proxy_id, meta_id, ranges=None):
+	"""
+	Creates the diff of a meta for the data section of a request_write/response_read (diff) message, from its claimed diffs (see claimMetaDiff)
+	Upserted features are not read here: each feature collection streams them from the diff file while the message is serialized (see proxy_json), so memory holds one feature at a time
+	Deleted features are identified as $meta_id/$shape_id/$fid
+	:param proxy_id:
+	:param meta_id:
+	:param ranges: part of the diff to assemble, as returned by splitMetaDiff; None for all the claimed diffs
+	:return: tuple (list of feature collections with the upserted features, list of deleted feature ids)
+	"""
+
+	path_sending = getSendingPath(proxy_id, meta_id)
+
+	upserts = []
+	deletes = []
+
+	if not os.path.exists(path_sending):
+		return upserts, deletes
+
+	if ranges is None:
+		ranges = [(shape_id, 0, None) for shape_id in sorted(os.listdir(path_sending))]
+
+	for shape_id, start, end in ranges:
+		path_diff = os.path.join(path_sending, shape_id)
+		latest = indexShapeDiff(path_diff, start, end)
+
+		upserted = False
+		# deletes in file order
+		for fid, (lineno, operation) in sorted(latest.items(), key=lambda item: item[1][0]):
+			if operation == "U":
+				upserted = True
+			else:
+				deletes.append("%s/%s/%s" % (meta_id, shape_id, fid))
+
+		if upserted:
+			upserts.append({
+				'id': shape_id,
+				'type': 'FeatureCollection',
+				'features': proxy_json.ArrayStream(ShapeUpserts(path_diff, latest, start, end))
+			})
+
+	return upserts, deletes
@@ -0,0 +1,259 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+__author__ = 'Antonio Vaccarino'
+__docformat__ = 'restructuredtext en'
+
+import os
+import time
+import sqlite3
+import threading
+
+from errors import *
+import proxy_config_core as conf
+
+"""
+Per-proxy journal of the updates waiting to be sent to the main server, replacing the marker files of $proxy/next/.
+The journal is an SQLite database in WAL mode ($proxy/conf/journal.sqlite) with one row per update and a monotonic sequence number (never reused, also after deletions). A send claims the updates up to the current sequence number and, once the main server has acknowledged some metas, deletes their rows up to that number in a single transaction: updates added during the send have higher numbers and stay pending.
+The failed sends of each meta are counted too, for the backoff of the scheduler (see proxy_sender); after conf.send_max_attempts failures a meta is no longer claimed by the sends of all the metas, until it is updated again or sent explicitly.
+"""
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS updates (
+	seq INTEGER PRIMARY KEY AUTOINCREMENT,
+	meta_id TEXT NOT NULL,
+	created REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS updates_meta ON updates (meta_id, seq);
+CREATE TABLE IF NOT EXISTS failures (
+	meta_id TEXT PRIMARY KEY,
+	attempts INTEGER NOT NULL,
+	lastfailed REAL NOT NULL
+);
+"""
+
+
+class UpdateJournal ():
+	"""
+	Update journal of a single soft proxy. Safe to share between threads, and between processes through SQLite locking
+	"""
+
+	def __init__ (self, proxy_id):
+
+		self.proxy_id = proxy_id
+		self.path = getJournalPath(proxy_id)
+
+		if not os.path.isdir(os.path.dirname(self.path)):
+			raise InvalidProxyException ("Proxy instance %s does not exist" % proxy_id)
+
+		self.lock = threading.Lock()
+		self.connection = sqlite3.connect(self.path, timeout=conf.journal_busy_timeout, isolation_level=None, check_same_thread=False)
+		self.connection.execute("PRAGMA journal_mode=WAL")
+		self.connection.execute("PRAGMA synchronous=NORMAL")
+		self.connection.executescript(SCHEMA)
+
+		self.importMarkers()
+
+	def importMarkers (self):
+		"""
+		Moves the updates still recorded as marker files in the old $proxy/next/ directory into the journal
+		:return:
+		"""
+
+		updatespath = os.path.join(conf.baseproxypath, self.proxy_id, "next")
+		if not os.path.isdir(updatespath):
+			return
+
+		for meta_id in sorted(os.listdir(updatespath)):
+			markerpath = os.path.join(updatespath, meta_id)
+			try:
+				created = os.path.getmtime(markerpath)
+			except OSError:
+				continue
+			self.append(meta_id, created)
+			os.remove(markerpath)
+
+	def append (self, meta_id, created=None):
+		"""
+		Records an update of a meta
+		:param meta_id:
+		:param created: time of the update, defaults to now
+		:return: sequence number of the update
+		"""
+
+		if created is None:
+			created = time.time()
+
+		with self.lock:
+			cursor = self.connection.execute("INSERT INTO updates (meta_id, created) VALUES (?, ?)", (meta_id, created))
+			# new data gets a new chance
+			self.connection.execute("DELETE FROM failures WHERE meta_id = ?", (meta_id,))
+			return cursor.lastrowid
+
+	def pending (self):
+		"""
+		Lists the metas with updates not yet acknowledged
+		:return: dict meta_id -> tuple (latest sequence number, time of the first update, time of the latest update)
+		"""
+
+		with self.lock:
+			rows = self.connection.execute("SELECT meta_id, MAX(seq), MIN(created), MAX(created) FROM updates GROUP BY meta_id").fetchall()
+
+		metas = {}
+		for meta_id, seq, first, latest in rows:
+			metas[meta_id] = (seq, first, latest)
+		return metas
+
+	def claim (self, metas=None):
+		"""
+		Takes a snapshot of the pending updates for a send
+		:param metas: list of meta_ids to consider, None for all but the ones that have failed conf.send_max_attempts times
+		:return: tuple (sequence number of the claim, sorted list of the claimed meta_ids)
+		"""
+
+		with self.lock:
+			upto = self.connection.execute("SELECT COALESCE(MAX(seq), 0) FROM updates").fetchone()[0]
+			rows = self.connection.execute("SELECT DISTINCT meta_id FROM updates WHERE seq <= ?", (upto,)).fetchall()
+
+		failed = []
+		if metas is None:
+			failed = [meta_id for meta_id, (attempts, lastfailed) in self.failures().items() if isGivenUp(attempts)]
+
+		claimed = []
+		for (meta_id,) in rows:
+			if (metas is None and meta_id not in failed) or (metas is not None and meta_id in metas):
+				claimed.append(meta_id)
+
+		return upto, sorted(claimed)
+
+	def acknowledge (self, meta_ids, upto):
+		"""
+		Removes, atomically, the updates of the given metas up to the sequence number of their claim
+		:param meta_ids: list of acknowledged meta_ids
+		:param upto: sequence number returned by claim
+		:return: number of updates removed
+		"""
+
+		if len(meta_ids) == 0:
+			return 0
+
+		with self.lock:
+			self.connection.execute("BEGIN IMMEDIATE")
+			try:
+				removed = 0
+				for meta_id in meta_ids:
+					cursor = self.connection.execute("DELETE FROM updates WHERE meta_id = ? AND seq <= ?", (meta_id, upto))
+					removed += cursor.rowcount
+					self.connection.execute("DELETE FROM failures WHERE meta_id = ?", (meta_id,))
+				self.connection.execute("COMMIT")
+			except:
+				self.connection.execute("ROLLBACK")
+				raise
+
+		return removed
+
+	def recordFailure (self, meta_id, failed=None):
+		"""
+		Counts a failed send of a meta, its updates stay pending
+		:param meta_id:
+		:param failed: time of the failure, defaults to now
+		:return: number of consecutive failed sends of the meta
+		"""
+
+		if failed is None:
+			failed = time.time()
+
+		with self.lock:
+			self.connection.execute("BEGIN IMMEDIATE")
+			try:
+				row = self.connection.execute("SELECT attempts FROM failures WHERE meta_id = ?", (meta_id,)).fetchone()
+				attempts = 1 if row is None else row[0] + 1
+				self.connection.execute("INSERT OR REPLACE INTO failures (meta_id, attempts, lastfailed) VALUES (?, ?, ?)", (meta_id, attempts, failed))
+				self.connection.execute("COMMIT")
+			except:
+				self.connection.execute("ROLLBACK")
+				raise
+
+		return attempts
+
+	def failures (self):
+		"""
+		Lists the metas whose latest sends failed
+		:return: dict meta_id -> tuple (number of consecutive failed sends, time of the latest)
+		"""
+
+		with self.lock:
+			rows = self.connection.execute("SELECT meta_id, attempts, lastfailed FROM failures").fetchall()
+
+		return dict((meta_id, (attempts, lastfailed)) for meta_id, attempts, lastfailed in rows)
+
+	def compact (self):
+		"""
+		Keeps only the first and the latest row of each pending meta (enough for pending() and claims) and checkpoints the WAL into the database file
+		:return: number of rows removed
+		"""
+
+		with self.lock:
+			cursor = self.connection.execute("DELETE FROM updates WHERE seq NOT IN (SELECT MAX(seq) FROM updates GROUP BY meta_id) AND seq NOT IN (SELECT MIN(seq) FROM updates GROUP BY meta_id)")
+			removed = cursor.rowcount
+			self.connection.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+
+		return removed
+
+	def close (self):
+
+		with self.lock:
+			self.connection.close()
+
+
+def isGivenUp (attempts):
+	"""
+	Checks if a meta has failed too many sends to be retried automatically (see conf.send_max_attempts)
+	:param attempts: number of consecutive failed sends
+	:return: boolean
+	"""
+	return conf.send_max_attempts is not None and attempts >= conf.send_max_attempts
+
+
+def getRetryDelay (attempts):
+	"""
+	Seconds to wait before sending again a meta whose latest sends failed: conf.send_retry_wait, doubled at each further failure up to conf.send_retry_max_wait
+	:param attempts: number of consecutive failed sends
+	:return: seconds
+	"""
+	if attempts <= 0:
+		return 0
+	return min(conf.send_retry_max_wait, conf.send_retry_wait * 2 ** min(attempts - 1, 32))
+
+
+def getJournalPath (proxy_id):
+	return os.path.join(conf.baseproxypath, proxy_id, conf.path_journal)
+
+
+# open journals, one per proxy for the whole process
+journals = {}
+journalslock = threading.Lock()
+
+
+def getJournal (proxy_id):
+	"""
+	Returns the (shared) update journal of a proxy, opening or creating it if needed
+	:param proxy_id:
+	:return: UpdateJournal
+	"""
+
+	with journalslock:
+		journal = journals.get(proxy_id)
+		if journal is None:
+			journal = UpdateJournal(proxy_id)
+			journals[proxy_id] = journal
+		return journal
+
+
+def hasJournal (proxy_id):
+	"""
+	Checks if a proxy has a journal (or old style /next markers that will be imported in it), without creating it
+	:param proxy_id:
+	:return: boolean
+	"""
+	return proxy_id in journals or os.path.exists(getJournalPath(proxy_id)) or os.path.isdir(os.path.join(conf.baseproxypath, proxy_id, "next"))
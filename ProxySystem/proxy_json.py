@@ -0,0 +1,218 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+__author__ = 'Antonio Vaccarino'
+__docformat__ = 'restructuredtext en'
+
+import io
+import sys
+import json
+
+try:
+	import orjson
+except ImportError:
+	orjson = None
+
+import proxy_config_core as conf
+
+"""
+Json serialization of the features and messages.
+dumps and loads use the backend chosen by conf.json_backend: "orjson" (when installed), the standard "json" module, or any backend added with registerBackend; "auto" takes the fastest available. Features are serialized in compact form (no spaces) and with the non-ascii characters written as utf-8 rather than escaped, as orjson does. Their text can still differ between backends (orjson writes 1e16 where json writes 1e+16, NaN and infinities as null), so the feature hashes of proxy_diff record the backend that wrote them and are recomputed from the geojson files when it changes (see proxy_diff.loadFeatureHashes): installing orjson does not make the next replications send every feature again.
+Messages are serialized in streaming: they can hold ArrayStream objects in place of lists, serialized as json arrays by consuming their items one at a time, so a message with all the features of a meta can be written (or compressed and sent) while the features are still being read from disk. Strings inside an ArrayStream are taken as already serialized json and spliced in as they are, never parsed again.
+"""
+
+
+def stdlibDumps (value):
+	text = json.dumps(value, separators=(',', ':'), ensure_ascii=False)
+	if sys.version_info[0] < 3 and isinstance(text, unicode):
+		# native strings, as the other backends
+		text = text.encode('utf-8')
+	return text
+
+def stdlibLoads (text):
+	return json.loads(text)
+
+def orjsonDumps (value):
+	try:
+		return orjson.dumps(value).decode('utf-8')
+	except TypeError:
+		# values orjson does not handle (integers beyond 64 bits, non string keys): the whole value is written by json, always for the same value, so the text of a feature does not depend on the others
+		return stdlibDumps(value)
+
+def orjsonLoads (text):
+	return orjson.loads(text)
+
+
+# backend name -> (dumps, loads)
+backends = {
+	"json": (stdlibDumps, stdlibLoads)
+}
+if orjson is not None:
+	backends["orjson"] = (orjsonDumps, orjsonLoads)
+
+# in order of preference for "auto"
+BACKEND_PREFERENCE = ("orjson", "json")
+
+# current backend, set by setBackend
+dumps = stdlibDumps
+loads = stdlibLoads
+backend = "json"
+
+
+def registerBackend (name, dumpsfunction, loadsfunction):
+	"""
+	Adds a json backend; dumpsfunction must return compact json as a native string
+	:param name:
+	:param dumpsfunction:
+	:param loadsfunction:
+	:return:
+	"""
+	backends[name] = (dumpsfunction, loadsfunction)
+
+
+def setBackend (name="auto"):
+	"""
+	Selects the backend used by dumps and loads
+	:param name: backend name, "auto" for the fastest available
+	:return: name of the selected backend
+	"""
+
+	global dumps, loads, backend
+
+	if name == "auto":
+		name = [candidate for candidate in BACKEND_PREFERENCE if candidate in backends][0]
+
+	try:
+		dumps, loads = backends[name]
+	except KeyError:
+		raise ValueError ("Unknown json backend %s (available: %s)" % (name, sorted(backends.keys())))
+	backend = name
+
+	return name
+
+
+def openText (path, mode='r'):
+	"""
+	Opens a text file holding json data as utf-8, whatever the locale, with native strings (bytes on python 2)
+	:param path:
+	:param mode:
+	:return: file object
+	"""
+
+	if sys.version_info[0] >= 3:
+		return io.open(path, mode, encoding='utf-8')
+	return open(path, mode)
+
+
+class ArrayStream ():
+	"""
+	Iterable serialized as a json array by iterEncode, its items are read each time the stream is serialized: a stream over a generator can be serialized once, one over a re-iterable source (e.g. proxy_diff.ShapeUpserts) again for each retry of a send. Items can be json-serializable values or strings of already serialized json
+	"""
+
+	def __init__ (self, items):
+		self.items = items
+
+	def __iter__ (self):
+		return iter(self.items)
+
+	# messages are copied by the validation (see ProxyFS.createMessageFromTemplate), the stream is shared rather than consumed
+	def __copy__ (self):
+		return self
+
+	def __deepcopy__ (self, memo):
+		return self
+
+
+def isRawJson (item):
+	if isinstance(item, (str, bytes)):
+		return True
+	try:
+		return isinstance(item, unicode)
+	except NameError:
+		return False
+
+
+def hasStreams (value):
+
+	if isinstance(value, ArrayStream):
+		return True
+	if isinstance(value, dict):
+		return any(hasStreams(item) for item in value.values())
+	if isinstance(value, (list, tuple)):
+		return any(hasStreams(item) for item in value)
+	return False
+
+
+def iterEncode (value):
+	"""
+	Serializes a value to json as a sequence of text fragments, consuming the ArrayStreams it contains. The parts without streams are serialized in one go by the backend
+	:param value: json-serializable value, possibly holding ArrayStreams
+	:return: generator of strings
+	"""
+
+	if not isinstance(value, ArrayStream) and not hasStreams(value):
+		yield dumps(value)
+	elif isinstance(value, dict):
+		yield '{'
+		first = True
+		for key, item in value.items():
+			if not first:
+				yield ','
+			first = False
+			yield dumps(key)
+			yield ':'
+			for fragment in iterEncode(item):
+				yield fragment
+		yield '}'
+	elif isinstance(value, ArrayStream):
+		yield '['
+		first = True
+		for item in value:
+			if not first:
+				yield ','
+			first = False
+			if isRawJson(item):
+				if isinstance(item, bytes) and not isinstance(item, str):
+					item = item.decode('utf-8')
+				yield item
+			else:
+				for fragment in iterEncode(item):
+					yield fragment
+		yield ']'
+	elif isinstance(value, (list, tuple)):
+		yield '['
+		first = True
+		for item in value:
+			if not first:
+				yield ','
+			first = False
+			for fragment in iterEncode(item):
+				yield fragment
+		yield ']'
+	else:
+		yield dumps(value)
+
+
+def iterChunks (fragments, chunksize=64*1024):
+	"""
+	Groups small text fragments in chunks of about chunksize characters
+	:param fragments: iterable of strings
+	:param chunksize:
+	:return: generator of strings
+	"""
+
+	pending = []
+	pendingsize = 0
+	for fragment in fragments:
+		pending.append(fragment)
+		pendingsize += len(fragment)
+		if pendingsize >= chunksize:
+			yield ''.join(pending)
+			pending = []
+			pendingsize = 0
+
+	if pendingsize > 0:
+		yield ''.join(pending)
+
+
+setBackend(conf.json_backend)
@@ -2,123 +2,417 @@
 # -*- coding: utf-8 -*-
 import inspect
 import os.path
+import os
+import time
+import fcntl
+import threading
 
 from errors import *
 import proxy_config_core as conf
+import proxy_metrics
 
 __author__ = 'Antonio Vaccarino'
 __docformat__ = 'restructuredtext en'
 
+"""
+Locks on the proxy resources. A lock is taken either on a whole meta or on a single shape of a meta: a meta lock excludes every other lock on the meta, shape locks exclude only the locks on the same shape and on the whole meta.
+Locks are held at two levels: an in-process lock table, so that threads of the same process (the daemon workers) wait on a condition and wake as soon as the resource is released, and flock()ed per-resource lock files in $proxy/locks/ that exclude other processes. The lock files are never removed, so taking a lock does not depend on the number of entries in the proxy directories.
+"""
 
-def fuseParams (source_function, source_frame, names=None):
+
+# names of the parameters that identify the resource to lock
+LOCK_PARAMS = ('proxy_id', 'meta_id', 'shape_id')
+
+# function -> lock signature, for the actions that have not been marked as lockable
+signaturecache = {}
+
+try:
+	getargspec = inspect.getfullargspec
+except AttributeError:
+	getargspec = inspect.getargspec
+
+
+def buildLockSignature (function):
 	"""
-	Returns a dict with all the values indicated in list names passed as parameters to the source_f by the current frame. If names is None, then all key/values are returned
-	:param names: list of strings
-	:param source_function: function
-	:param source_frame: frame in the python stack
-	:return: dict
+	Finds where a function takes the lock parameters (proxy_id, meta_id, shape_id). Computed once per function, see lockable and getLockSignature
+	:param function:
+	:return: dict with parameter name as key and tuple (position, has default, default value) as value, only for the lock parameters in the function signature
 	"""
 
-	spec = inspect.getargspec(source_function)
-	vals = inspect.getargvalues(source_frame)
+	spec = getargspec(function)
+	defaults = spec.defaults or ()
+	firstdefault = len(spec.args) - len(defaults)
+
+	signature = {}
+	for position in range (0, len(spec.args)):
+		name = spec.args[position]
+		if name in LOCK_PARAMS:
+			if position >= firstdefault:
+				signature[name] = (position, True, defaults[position - firstdefault])
+			else:
+				signature[name] = (position, False, None)
 
-	fusion = {}
+	return signature
 
-	for i in range (0, len(spec.args)):
-		#we iterate in the list of arguments used by source_function
 
-		kwoffset = -1
-		# first we look if the arg we are checking is handled positionally
-		try:
-			fusion[spec.args[i]] = vals.locals['args'][i]
-		except:
-			kwoffset += 1
-			#otherwise the arg is either passed as a keyword argument OR has a default value from source_function
-			if spec.args[i] in vals.locals['kwargs']:
-				#if the arg is passed as a keyword
-				fusion[spec.args[i]] = vals.locals['kwargs'][spec.args[i]]
+def lockable (function):
+	"""
+	Decorator for the operations that are performed under lock (see ProxyLocker.performLocked): the position of their lock parameters is computed once, at definition time
+	:param function:
+	:return: the same function
+	"""
+
+	function.lock_signature = buildLockSignature(function)
+	return function
+
+
+def getLockSignature (function):
+
+	try:
+		return function.lock_signature
+	except AttributeError:
+		pass
+
+	signature = signaturecache.get(function)
+	if signature is None:
+		signature = buildLockSignature(function)
+		signaturecache[function] = signature
+
+	return signature
+
+
+def resolveLockParams (function, args, kwargs):
+	"""
+	Returns the values of the lock parameters a function would receive with the given arguments
+	:param function:
+	:param args: positional arguments of the call
+	:param kwargs: keyword arguments of the call
+	:return: dict with the lock parameters that are in the function signature
+	"""
+
+	values = {}
+	for name, (position, hasdefault, default) in getLockSignature(function).items():
+		if name in kwargs:
+			values[name] = kwargs[name]
+		elif position < len(args):
+			values[name] = args[position]
+		elif hasdefault:
+			values[name] = default
+
+	return values
+
+
+# polling interval bounds (seconds) when waiting with a timeout on a lock file held by another process
+LOCK_POLL_MIN = 0.01
+LOCK_POLL_MAX = 0.2
+
+
+class LockStats ():
+	"""
+	Counters on the locks taken by this process, by kind of lock (meta or shape)
+	"""
+
+	def __init__ (self):
+		self.lock = threading.Lock()
+		self.reset()
+
+	def reset (self):
+		self.counters = {}
+		for kind in ("meta", "shape"):
+			self.counters[kind] = {
+				"acquired": 0,
+				"contended": 0,
+				"timeouts": 0,
+				"wait_total": 0.0,
+				"wait_max": 0.0,
+				"hold_total": 0.0,
+				"hold_max": 0.0
+			}
+
+	def recordAcquire (self, kind, waited, contended):
+		with self.lock:
+			counters = self.counters[kind]
+			counters["acquired"] += 1
+			if contended:
+				counters["contended"] += 1
+			counters["wait_total"] += waited
+			counters["wait_max"] = max(counters["wait_max"], waited)
+
+	def recordTimeout (self, kind, waited):
+		with self.lock:
+			counters = self.counters[kind]
+			counters["timeouts"] += 1
+			counters["wait_total"] += waited
+			counters["wait_max"] = max(counters["wait_max"], waited)
+
+	def recordRelease (self, kind, held):
+		with self.lock:
+			counters = self.counters[kind]
+			counters["hold_total"] += held
+			counters["hold_max"] = max(counters["hold_max"], held)
+
+	def getStats (self):
+		with self.lock:
+			stats = {}
+			for kind, counters in self.counters.items():
+				stats[kind] = dict(counters)
+			return stats
+
+
+class LockTable ():
+	"""
+	In-process table of the held locks. For each (proxy_id, meta_id) it records if the whole meta is locked and which shapes are
+	"""
+
+	def __init__ (self):
+		self.condition = threading.Condition()
+		# (proxy_id, meta_id) -> [meta locked, set of locked shape_ids]
+		self.metas = {}
+
+	def isFree (self, state, shape_id):
+
+		if state[0]:
+			return False
+		if shape_id is None:
+			return len(state[1]) == 0
+		return shape_id not in state[1]
+
+	def acquire (self, proxy_id, meta_id, shape_id, deadline):
+		"""
+		Waits until the resource is free and marks it as locked
+		:param deadline: time.time() limit for the wait, None to wait indefinitely
+		:return: True if the lock was contended
+		"""
+
+		key = (proxy_id, meta_id)
+		contended = False
+
+		with self.condition:
+			while True:
+				state = self.metas.setdefault(key, [False, set()])
+				if self.isFree(state, shape_id):
+					if shape_id is None:
+						state[0] = True
+					else:
+						state[1].add(shape_id)
+					return contended
+
+				contended = True
+				if deadline is None:
+					self.condition.wait()
+				else:
+					remaining = deadline - time.time()
+					if remaining <= 0:
+						raise ResourceLockedException ("Resource %s/%s.%s is currently locked" % (proxy_id, meta_id, shape_id))
+					self.condition.wait(remaining)
+
+	def release (self, proxy_id, meta_id, shape_id):
+
+		key = (proxy_id, meta_id)
+
+		with self.condition:
+			state = self.metas.get(key)
+			if state is None or (shape_id is None and not state[0]) or (shape_id is not None and shape_id not in state[1]):
+				raise LockReleasedException ("Lock on %s/%s.%s has been already released" % (proxy_id, meta_id, shape_id))
+
+			if shape_id is None:
+				state[0] = False
 			else:
-				#otherwise we fallback to the default value found in the function declaration
-				fusion[spec.args[i]] = spec.defaults[kwoffset]
+				state[1].discard(shape_id)
 
-	return fusion
+			if not state[0] and len(state[1]) == 0:
+				del self.metas[key]
 
+			self.condition.notify_all()
 
-def setFSLock (proxy_id, meta_id, shape_id = None):
 
-	if shape_id is not None:
-		lockname = meta_id+"."+shape_id
-	else:
-		lockname = meta_id
+locktable = LockTable()
+lockstats = LockStats()
 
-	lockdir = os.path.join (conf.baseproxypath, proxy_id)
-	lockpath = os.path.join (lockdir, lockname)
 
-	locklist = os.listdir(lockdir)
+def getLockStats ():
+	"""
+	Returns the wait and hold statistics of the locks taken by this process
+	:return: dict with the counters by kind of lock (meta/shape), times in seconds
+	"""
+	return lockstats.getStats()
 
-	#first we check to see if there is a lock on the whole meta
-	if (lockfile.startswith(meta_id) for lockfile in locklist):
-		raise ResourceLockedException ("Meta %s is currently locked" % meta_id)
 
-	#if not, we check to see if there is a lock on the specific shape file, or on ANY file in case we are locking the whole meta
-	if shape_id is not None:
-		# searching for a specific lock file on shape data
-		if lockname in locklist:
-			raise ResourceLockedException ("Resource %s is currently locked" % lockname)
-	else:
-		# searching for ANY lock file on the meta
-		if any (lockfile.startswith(lockname+".") for lockfile in locklist):
-			raise ResourceLockedException ("At least one resource of meta %s is currently locked" % meta_id)
+def getLockDir (proxy_id):
+	return os.path.join (conf.baseproxypath, proxy_id, conf.path_locks)
+
+
+def flockFile (lockpath, operation, deadline):
+	"""
+	Opens (creating it if needed) a lock file and flocks it
+	:param lockpath:
+	:param operation: fcntl.LOCK_SH or fcntl.LOCK_EX
+	:param deadline: time.time() limit for the wait, None to block until the lock is available
+	:return: file descriptor holding the lock
+	"""
 
 	try:
-		os.open(lockpath, 'w').close()
-	except:
+		fd = os.open(lockpath, os.O_RDWR | os.O_CREAT, 0o644)
+	except OSError:
 		raise InternalProxyException ("Could not create lockfile %s" % lockpath)
 
+	try:
+		if deadline is None:
+			fcntl.flock(fd, operation)
+			return fd
 
-	return True
+		# flock cannot time out, so with a deadline we poll with a growing interval
+		pause = LOCK_POLL_MIN
+		while True:
+			try:
+				fcntl.flock(fd, operation | fcntl.LOCK_NB)
+				return fd
+			except (IOError, OSError):
+				remaining = deadline - time.time()
+				if remaining <= 0:
+					raise ResourceLockedException ("Resource %s is currently locked by another process" % lockpath)
+				time.sleep(min(pause, remaining))
+				pause = min(pause * 2, LOCK_POLL_MAX)
+	except:
+		os.close(fd)
+		raise
 
 
+class ResourceLock ():
+	"""
+	A lock held on a meta or shape, returned by acquireLock and released with releaseLock
+	"""
 
-def releaseFSLock (proxy_id, meta_id, shape_id = None):
+	def __init__ (self, proxy_id, meta_id, shape_id):
+
+		self.proxy_id = proxy_id
+		self.meta_id = meta_id
+		self.shape_id = shape_id
+		self.kind = "meta" if shape_id is None else "shape"
+		self.fds = []
+		self.acquired = None
 
-	if shape_id is not None:
-		lockname = meta_id+"."+shape_id
-	else:
-		lockname = meta_id
 
-	lockdir = os.path.join (conf.baseproxypath, proxy_id)
-	lockpath = os.path.join (lockdir, lockname)
+def acquireLock (proxy_id, meta_id, shape_id=None, timeout=None):
+	"""
+	Locks a whole meta (shape_id None) or a single shape, waiting for the resource to be available
+	:param proxy_id:
+	:param meta_id:
+	:param shape_id:
+	:param timeout: max seconds of wait, None to wait indefinitely, 0 to fail immediately
+	:return: ResourceLock, ResourceLockedException if the timeout expires
+	"""
 
-	locklist = os.listdir(lockdir)
+	resourcelock = ResourceLock(proxy_id, meta_id, shape_id)
 
-	# NOTE: Currently we do not check if sub-locks have been made for a meta-level lock
+	started = time.time()
+	if timeout is None:
+		deadline = None
+	else:
+		deadline = started + timeout
 
 	try:
-		os.remove(lockpath)
-	except:
-		if os.path.exists(lockpath):
-			# lock exists but we cannot remove it
-			raise InternalProxyException ("Could not delete existing file %s" % lockpath)
-		elif os.path.exists(lockdir):
-			# lock does not exist but its directory does
-			raise LockReleasedException ("Lockfile %s has been already deleted" % lockpath)
+		contended = locktable.acquire(proxy_id, meta_id, shape_id, deadline)
+	except ResourceLockedException:
+		lockstats.recordTimeout(resourcelock.kind, time.time() - started)
+		proxy_metrics.observe("lock_wait", time.time() - started)
+		proxy_metrics.count("lock_retries", kind=resourcelock.kind, result="timeout")
+		raise
+
+	lockdir = getLockDir(proxy_id)
+	try:
+		if not os.path.exists(lockdir):
+			try:
+				os.makedirs(lockdir)
+			except OSError:
+				# created in the meantime by another process
+				if not os.path.isdir(lockdir):
+					raise InternalProxyException ("Could not create lock directory for proxy %s" % proxy_id)
+
+		metalockpath = os.path.join(lockdir, meta_id+".lock")
+		if shape_id is None:
+			resourcelock.fds.append(flockFile(metalockpath, fcntl.LOCK_EX, deadline))
 		else:
-			# the lock directory itself does not exist any more
-			raise InternalProxyException ("Could not find lock directory for %s/%s" % (proxy_id, meta_id))
+			# shape locks share the meta lock file, so they exclude only the whole meta lock
+			resourcelock.fds.append(flockFile(metalockpath, fcntl.LOCK_SH, deadline))
+			shapelockdir = os.path.join(lockdir, meta_id)
+			if not os.path.exists(shapelockdir):
+				try:
+					os.makedirs(shapelockdir)
+				except OSError:
+					if not os.path.isdir(shapelockdir):
+						raise InternalProxyException ("Could not create lock directory for %s/%s" % (proxy_id, meta_id))
+			resourcelock.fds.append(flockFile(os.path.join(shapelockdir, shape_id+".lock"), fcntl.LOCK_EX, deadline))
+	except Exception as ex:
+		for fd in resourcelock.fds:
+			os.close(fd)
+		locktable.release(proxy_id, meta_id, shape_id)
+		if isinstance(ex, ResourceLockedException):
+			lockstats.recordTimeout(resourcelock.kind, time.time() - started)
+			proxy_metrics.observe("lock_wait", time.time() - started)
+			proxy_metrics.count("lock_retries", kind=resourcelock.kind, result="timeout")
+		raise
+
+	resourcelock.acquired = time.time()
+	lockstats.recordAcquire(resourcelock.kind, resourcelock.acquired - started, contended)
+	proxy_metrics.observe("lock_wait", resourcelock.acquired - started)
+	if contended:
+		# the lock was held by someone else, the wait was retried until it was released
+		proxy_metrics.count("lock_retries", kind=resourcelock.kind, result="acquired")
+
+	return resourcelock
+
+
+def releaseLock (resourcelock):
+	"""
+	Releases a lock taken with acquireLock
+	:param resourcelock: ResourceLock
+	:return: True
+	"""
+
+	if resourcelock.acquired is None:
+		raise LockReleasedException ("Lock on %s/%s.%s has been already released" % (resourcelock.proxy_id, resourcelock.meta_id, resourcelock.shape_id))
 
+	# closing the descriptors releases the flocks
+	issue = None
+	for fd in reversed(resourcelock.fds):
+		try:
+			os.close(fd)
+		except OSError as ex:
+			issue = ex
+	resourcelock.fds = []
+
+	lockstats.recordRelease(resourcelock.kind, time.time() - resourcelock.acquired)
+	resourcelock.acquired = None
+
+	locktable.release(resourcelock.proxy_id, resourcelock.meta_id, resourcelock.shape_id)
+
+	if issue is not None:
+		raise InternalProxyException ("Could not release lockfile for %s/%s.%s (%s)" % (resourcelock.proxy_id, resourcelock.meta_id, resourcelock.shape_id, issue))
 
 	return True
 
 
+def setFSLock (proxy_id, meta_id, shape_id = None):
+	"""
+	Takes a lock without waiting
+	:return: ResourceLock, ResourceLockedException if the resource is already locked
+	"""
+	return acquireLock(proxy_id, meta_id, shape_id, timeout=0)
+
+
+def releaseFSLock (resourcelock):
+	return releaseLock(resourcelock)
+
+
 
 
 class ProxyLocker ():
 	"""
-	Creates a locker object that builds and removes lockfiles around specific action contexts as required. Can have a default selection of proxy, meta and shape in case the functions don't pass them explicitly
+	Creates a locker object that takes and releases locks around specific action contexts as required. Can have a default selection of proxy, meta and shape in case the functions don't pass them explicitly
 	"""
 
-	def __init__ (self, proxy_id=None, meta_id=None, shape_id=None, retries=0, wait=0):
+	def __init__ (self, proxy_id=None, meta_id=None, shape_id=None, retries=0, wait=0, timeout=None):
 
 		self.proxy_id = proxy_id
 		self.meta_id = meta_id
@@ -127,13 +421,18 @@ class ProxyLocker ():
 		if not isinstance(retries, int) or retries < 0:
 			retries = 0
 
-		if not isinstance(wait, int):
+		if not isinstance(wait, (int, float)) or wait < 0:
 			wait = 0
 
-		#Note that the tries mechanism applies only to setting the lockfile, after that we expect to have full control on the areas we are writing on
+		#Note that the timeout applies only to acquiring the lock, after that we expect to have full control on the areas we are writing on
+		#Waiters are woken as soon as the lock is released: retries and wait only determine the max time spent waiting, (retries+1)*wait seconds unless an explicit timeout is given
+
+		if timeout is None:
+			timeout = (retries+1) * wait
 
 		self.tries = retries+1
 		self.wait = wait
+		self.timeout = timeout
 
 
 
@@ -147,12 +446,11 @@ class ProxyLocker ():
 		:return: whatever returns the original function
 		"""
 
-		# we get the custom information on what really needs to be locked
-		# first we extract everything with inspection
+		# we get the custom information on what really needs to be locked from the call arguments, using the signature of the action (computed once per function)
 
 		# 0. PREPARATION
 
-		args_vals = fuseParams (action, inspect.currentframe())
+		args_vals = resolveLockParams (action, args, kwargs)
 
 		try:
 			shape_id = args_vals['shape_id']
@@ -173,20 +471,9 @@ class ProxyLocker ():
 			raise RuntimeProxyException ("Cannot create lock file for unknown proxy or  meta")
 
 
-		# 1. CREATING THE LOCK FILE
-
-		attempt = 0
-		issue = None
-		success = False
-		while attempt < self.tries:
-			try:
-				success = setFSLock (proxy_id, meta_id, shape_id)
-			except Exception as ex:
-				issue = ex
+		# 1. TAKING THE LOCK (ResourceLockedException if we wait longer than the timeout)
 
-		if success is not True:
-			#NOTE: check Python docs, a generic raise may be enough
-			raise issue
+		resourcelock = acquireLock (proxy_id, meta_id, shape_id, self.timeout)
 
 		# 2. Perform the required operation
 
@@ -195,30 +482,20 @@ class ProxyLocker ():
 		except Exception as ex:
 			issue = ex
 
-			# we try to release the lockfile and THEN we send the core exception up
+			# we try to release the lock and THEN we send the core exception up
 			try:
-				releaseFSLock(proxy_id, meta_id, shape_id)
+				releaseLock(resourcelock)
 			except Exception as ex:
-				raise InternalProxyException ("Failed to release lockfile for %s/%s.%s \n(%s)\n while closing after the following error:\n%s", (proxy_id, meta_id, shape_id, ex.message, issue.message))
+				raise InternalProxyException ("Failed to release lock for %s/%s.%s \n(%s)\n while closing after the following error:\n%s" % (proxy_id, meta_id, shape_id, ex, issue))
 
 
-			raise issue
+			raise
 
 
-		# 3. Release the lockfile if we did NOT crash the main action
+		# 3. Release the lock if we did NOT crash the main action
 		try:
-			releaseFSLock(proxy_id, meta_id, shape_id)
+			releaseLock(resourcelock)
 		except Exception as ex:
-			raise BadLockReleaseException ("Failed to release lockfile for %s/%s.%s \n(%s)\n after successful activity ", (proxy_id, meta_id, shape_id, ex.message))
-		#TODO: CHECK the actuall effect of raise+finally
-		# it may be ok as long as the top process uses the exception ONLY by lodding
-		finally:
-			return output
-
-
-
-
-
-
-
+			raise BadLockReleaseException ("Failed to release lock for %s/%s.%s \n(%s)\n after successful activity " % (proxy_id, meta_id, shape_id, ex))
 
+		return output
@@ -0,0 +1,371 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+__author__ = 'Antonio Vaccarino'
+__docformat__ = 'restructuredtext en'
+
+import os
+import sys
+import time
+import atexit
+import smtplib
+import threading
+from email.mime.text import MIMEText
+
+try:
+	import Queue as queue
+except ImportError:
+	import queue
+
+import proxy_config_core as conf
+
+"""
+Logging of the proxy events, off the event path.
+Log lines are put in a bounded in-memory queue and written by a background thread, in batches: each batch is written with one write per file and fsynced once (conf.log_fsync). If the queue is full the line is dropped and counted rather than blocking the caller, the count is logged as soon as there is room.
+Lines about a proxy go to $log_folder/proxy_$proxy_id.log, the others to $log_folder/proxyops.log. Files are rotated (file.1 ... file.$log_backups) when they exceed conf.log_max_bytes and when a new conf.log_rotate_interval period starts.
+Errors are also mailed to conf.mail_admin by another background thread, at most one mail every conf.mail_min_interval seconds: the errors raised in the meantime are aggregated in the next mail. Mails go through the SMTP server at conf.mail_smtp_host, a local stand-in for the tests (see config_testing); mails are disabled if it is None.
+"""
+
+# queue marker asking the writer to flush and stop
+STOP = object()
+
+
+def toUtf8 (text):
+	"""
+	Log lines are written as utf-8, whatever their string type (unicode on python 2, str on python 3)
+	:param text:
+	:return: byte string
+	"""
+	if not isinstance(text, bytes):
+		text = text.encode('utf-8')
+	return text
+
+
+class LogFile ():
+	"""
+	Log file kept open by the writer, with size and time rotation
+	"""
+
+	def __init__ (self, path):
+
+		self.path = path
+		self.fp = None
+		self.size = 0
+		self.period = None
+
+	def getPeriod (self, when):
+		if not conf.log_rotate_interval:
+			return None
+		return int(when // conf.log_rotate_interval)
+
+	def open (self):
+
+		folder = os.path.dirname(self.path)
+		if folder != "" and not os.path.exists(folder):
+			os.makedirs(folder)
+
+		self.fp = open(self.path, 'ab')
+		stat = os.fstat(self.fp.fileno())
+		self.size = stat.st_size
+		# an existing file belongs to the period of its last write
+		self.period = self.getPeriod(stat.st_mtime if stat.st_size > 0 else time.time())
+
+	def rotate (self):
+
+		self.close()
+		for i in range (conf.log_backups - 1, 0, -1):
+			older = "%s.%d" % (self.path, i)
+			if os.path.exists(older):
+				os.rename(older, "%s.%d" % (self.path, i + 1))
+		if conf.log_backups > 0:
+			os.rename(self.path, self.path + ".1")
+		else:
+			os.remove(self.path)
+
+	def write (self, text, now):
+		"""
+		Appends text to the file, rotating it first if needed; the text is not flushed
+		:param text: one or more lines, utf-8 bytes (see toUtf8)
+		:param now: time of the write
+		:return:
+		"""
+
+		if self.fp is None:
+			self.open()
+
+		newperiod = self.getPeriod(now)
+		if self.size > 0 and (self.size + len(text) > conf.log_max_bytes or newperiod != self.period):
+			self.rotate()
+			self.open()
+			self.period = newperiod
+
+		self.fp.write(text)
+		self.size += len(text)
+
+	def sync (self):
+
+		if self.fp is None:
+			return
+		self.fp.flush()
+		if conf.log_fsync:
+			os.fsync(self.fp.fileno())
+
+	def close (self):
+
+		if self.fp is not None:
+			self.fp.close()
+			self.fp = None
+
+
+class ErrorMailer ():
+	"""
+	Sends the errors by mail, aggregating the ones raised within conf.mail_min_interval seconds from the previous mail
+	"""
+
+	def __init__ (self, onfailure=None):
+
+		self.onfailure = onfailure
+		self.lock = threading.Lock()
+		self.pending = []
+		self.count = 0
+		self.lastsent = 0
+		self.wakeup = threading.Event()
+		self.stopping = threading.Event()
+		self.thread = threading.Thread(target=self.mailLoop)
+		self.thread.daemon = True
+		self.thread.start()
+
+	def add (self, message):
+
+		with self.lock:
+			self.count += 1
+			# only the first errors are listed, the others are counted
+			if len(self.pending) < conf.mail_max_errors:
+				self.pending.append(message)
+		self.wakeup.set()
+
+	def mailLoop (self):
+
+		while True:
+			self.wakeup.wait()
+			# waits for the end of the interval, collecting the errors raised meanwhile; a stop sends what is pending at once
+			delay = self.lastsent + conf.mail_min_interval - time.time()
+			if delay > 0:
+				self.stopping.wait(delay)
+
+			with self.lock:
+				messages, count = self.pending, self.count
+				self.pending = []
+				self.count = 0
+				self.wakeup.clear()
+
+			if count > 0:
+				self.lastsent = time.time()
+				try:
+					self.sendMail(messages, count)
+				except Exception as issue:
+					if self.onfailure is not None:
+						self.onfailure("Failed to mail %d errors: %s" % (count, issue))
+
+			if self.stopping.is_set():
+				return
+
+	def sendMail (self, messages, count):
+
+		recipients = conf.mail_admin
+		if not isinstance(recipients, (list, tuple)):
+			recipients = [recipients]
+
+		if sys.version_info[0] < 3:
+			# str and unicode lines cannot be joined if not ascii
+			messages = [toUtf8(message) for message in messages]
+		text = "\n".join(messages)
+		if count > len(messages):
+			text += "\n... and %d more errors, see the proxy logs" % (count - len(messages))
+
+		mail = MIMEText(text, 'plain', 'utf-8')
+		mail['Subject'] = "[FIdER proxy] %d errors" % count
+		mail['From'] = conf.mail_sender
+		mail['To'] = ", ".join(recipients)
+
+		smtp = smtplib.SMTP(conf.mail_smtp_host, conf.mail_smtp_port, timeout=conf.connection_timeout)
+		try:
+			smtp.sendmail(conf.mail_sender, recipients, mail.as_string())
+		finally:
+			smtp.quit()
+
+	def stop (self, timeout=None):
+
+		self.stopping.set()
+		self.wakeup.set()
+		self.thread.join(timeout)
+
+
+class LogWriter ():
+	"""
+	Queue and background writer of the log lines
+	"""
+
+	def __init__ (self):
+
+		self.queue = queue.Queue(conf.log_queue_size)
+		self.dropped = 0
+		self.droppedlock = threading.Lock()
+		self.files = {}
+		# lines about the batches that could not be written, added to the next batch
+		self.failures = []
+		self.thread = threading.Thread(target=self.writeLoop)
+		self.thread.daemon = True
+		self.thread.start()
+
+		self.mailer = None
+		if conf.mail_smtp_host is not None:
+			self.mailer = ErrorMailer(self.log)
+
+	def getLogPath (self, proxy_id):
+
+		if proxy_id is None:
+			return os.path.join(conf.log_folder, "proxyops.log")
+		return os.path.join(conf.log_folder, "proxy_%s.log" % proxy_id)
+
+	def log (self, message, proxy_id=None):
+		"""
+		Queues a line for the log of a proxy, never blocks
+		:param message: text of the line
+		:param proxy_id: None for the general log
+		:return: False if the line has been dropped
+		"""
+
+		try:
+			self.queue.put_nowait((proxy_id, message))
+		except queue.Full:
+			with self.droppedlock:
+				self.dropped += 1
+			return False
+		return True
+
+	def mail (self, message):
+		if self.mailer is not None:
+			self.mailer.add(message)
+
+	def takeBatch (self):
+		"""
+		Waits for the next lines and takes all the queued ones, up to conf.log_batch_size
+		:return: tuple (list of (proxy_id, message), True if the writer must stop)
+		"""
+
+		batch = []
+		entry = self.queue.get()
+		while entry is not STOP:
+			batch.append(entry)
+			if len(batch) >= conf.log_batch_size:
+				break
+			try:
+				entry = self.queue.get_nowait()
+			except queue.Empty:
+				break
+
+		return batch, entry is STOP
+
+	def writeLoop (self):
+
+		while True:
+			batch, stopping = self.takeBatch()
+
+			with self.droppedlock:
+				dropped, self.dropped = self.dropped, 0
+			if dropped > 0:
+				batch.append((None, "%d log lines dropped, the log queue was full" % dropped))
+			batch.extend(self.failures)
+			self.failures = []
+
+			self.writeBatch(batch)
+
+			if stopping:
+				for logfile in self.files.values():
+					logfile.close()
+				return
+
+	def writeBatch (self, batch):
+
+		if len(batch) == 0:
+			return
+
+		lines = {}
+		for proxy_id, message in batch:
+			lines.setdefault(proxy_id, []).append(message)
+
+		now = time.time()
+		for proxy_id, messages in lines.items():
+			logfile = self.files.get(proxy_id)
+			if logfile is None:
+				logfile = LogFile(self.getLogPath(proxy_id))
+				self.files[proxy_id] = logfile
+			try:
+				logfile.write(b"".join(toUtf8(message) + b"\n" for message in messages), now)
+				logfile.sync()
+			except Exception as issue:
+				# the writer must survive any failure: the file is reopened by the next write, the lines of this batch are lost and reported with the next batch
+				logfile.close()
+				self.failures.append((None, "%d log lines lost, could not write %s: %s" % (len(messages), logfile.path, issue)))
+
+	def stop (self, timeout=None):
+		"""
+		Writes the queued lines and stops the background threads
+		:param timeout: max seconds to wait for each thread
+		:return:
+		"""
+
+		if self.mailer is not None:
+			self.mailer.stop(timeout)
+		# the marker waits for room if the queue is full
+		try:
+			self.queue.put(STOP, True, timeout)
+		except queue.Full:
+			return
+		self.thread.join(timeout)
+
+
+logwriter = None
+logwriterlock = threading.Lock()
+
+
+def getLogWriter ():
+	"""
+	Returns the shared log writer of the process, starting it if needed. It is stopped, writing the queued lines, when the process exits
+	:return: LogWriter
+	"""
+
+	global logwriter
+
+	with logwriterlock:
+		if logwriter is None:
+			logwriter = LogWriter()
+			atexit.register(stopLogWriter)
+		return logwriter
+
+
+def stopLogWriter ():
+
+	global logwriter
+
+	with logwriterlock:
+		writer = logwriter
+		logwriter = None
+	if writer is not None:
+		writer.stop(conf.log_stop_timeout)
+
+
+def log (message, proxy_id=None, iserror=False):
+	"""
+	Logs a line, and mails it if it is an error
+	:param message:
+	:param proxy_id: proxy the line is about, None for the general log
+	:param iserror:
+	:return:
+	"""
+
+	writer = getLogWriter()
+	writer.log(message, proxy_id)
+	if iserror:
+		writer.mail(message)
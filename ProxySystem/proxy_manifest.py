@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+__author__ = 'Antonio Vaccarino'
+__docformat__ = 'restructuredtext en'
+
+import os
+import json
+import threading
+
+from errors import *
+import proxy_config_core as conf
+
+"""
+In-memory registry of the proxy manifests.
+Each manifest is parsed once and kept with an index of its metadata by name; it is parsed again only when the manifest file changes (different inode, mtime or size), so a rewrite or replacement of the file is always picked up.
+"""
+
+
+class ManifestRegistry ():
+	"""
+	Cache of the parsed manifests of the soft proxies, keyed by proxy_id
+	"""
+
+	def __init__ (self):
+
+		# proxy_id -> (file signature, manifest dict, dict of metadata entries by name)
+		self.entries = {}
+		self.lock = threading.Lock()
+
+	def getEntry (self, proxy_id):
+		"""
+		Returns the cached data for a proxy, (re)loading the manifest if it changed on disk
+		:param proxy_id:
+		:return: tuple (manifest, metadata index)
+		"""
+
+		path_manifest = os.path.join(conf.baseproxypath, proxy_id, conf.path_manifest)
+
+		try:
+			stat = os.stat(path_manifest)
+		except OSError:
+			raise InvalidProxyException ("Proxy instance %s does not exist" % proxy_id)
+
+		signature = (stat.st_ino, stat.st_mtime, stat.st_size)
+
+		with self.lock:
+			cached = self.entries.get(proxy_id)
+			if cached is not None and cached[0] == signature:
+				return cached[1], cached[2]
+
+		try:
+			manifest_fp = open(path_manifest)
+		except IOError:
+			raise InvalidProxyException ("Proxy instance %s does not exist" % proxy_id)
+		try:
+			manifest = json.load(manifest_fp)
+		except ValueError:
+			raise InternalProxyException ("Non valid manifest for proxy %s" % proxy_id)
+		finally:
+			manifest_fp.close()
+
+		metaindex = {}
+		for currentmeta in manifest['metadata']:
+			metaindex[currentmeta['name']] = currentmeta
+
+		with self.lock:
+			self.entries[proxy_id] = (signature, manifest, metaindex)
+
+		return manifest, metaindex
+
+	def getManifest (self, proxy_id):
+		return self.getEntry(proxy_id)[0]
+
+	def getMeta (self, proxy_id, meta_id):
+		"""
+		Returns the manifest entry of a meta
+		:param proxy_id:
+		:param meta_id:
+		:return: dict, None if the meta is not in the manifest
+		"""
+		return self.getEntry(proxy_id)[1].get(meta_id)
+
+	def hasMeta (self, proxy_id, meta_id):
+		return meta_id in self.getEntry(proxy_id)[1]
+
+	def invalidate (self, proxy_id=None):
+
+		with self.lock:
+			if proxy_id is None:
+				self.entries = {}
+			else:
+				self.entries.pop(proxy_id, None)
+
+
+# shared registry, used by the event handling, the send path and the capabilities messages
+registry = ManifestRegistry()
+
+
+def getManifest (proxy_id):
+	return registry.getManifest(proxy_id)
+
+def getMeta (proxy_id, meta_id):
+	return registry.getMeta(proxy_id, meta_id)
+
+def hasMeta (proxy_id, meta_id):
+	return registry.hasMeta(proxy_id, meta_id)
@@ -0,0 +1,420 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+__author__ = 'Antonio Vaccarino'
+__docformat__ = 'restructuredtext en'
+
+import os
+import json
+import time
+import atexit
+import threading
+
+try:
+	from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+except ImportError:
+	from http.server import BaseHTTPRequestHandler, HTTPServer
+
+import proxy_config_core as conf
+
+"""
+Instrumentation of the event handling and of the sends to the main server.
+Spans time the stages of the work (verify, lock_wait, extract, convert, replicate, queue, send), counters count features, bytes and lock retries. Both are aggregated by the shared registry of the process and, while a trace is open in the current thread (one per filesystem event and one per send), also collected in the trace, which is handed to the exporters when it ends:
+	with proxy_metrics.trace("event", path=eventpath) as eventtrace:
+		with proxy_metrics.span("verify"):
+			...
+		proxy_metrics.count("features", 120, op="written")
+Exporters are chosen with conf.metrics_exporters ("jsonlines" writes a json object per trace to conf.metrics_jsonl_file, more can be added with registerExporter); the aggregates are served as Prometheus text by the daemon on conf.metrics_http_port.
+The spans of the stages done under lock (extract, replicate) include their lock_wait, and replicate includes convert (the features are read from the shapefile while they are written).
+With conf.metrics_enabled False span and trace return a shared object that does nothing and count returns immediately, so the instrumentation points cost a function call each.
+"""
+
+
+class NullSpan ():
+	"""
+	Span and trace used when the instrumentation is disabled
+	"""
+
+	def __enter__ (self):
+		return self
+
+	def __exit__ (self, exctype, excvalue, traceback):
+		return False
+
+	def setLabels (self, **labels):
+		pass
+
+
+NULL_SPAN = NullSpan()
+
+
+class Span ():
+	"""
+	Times a stage, see span()
+	"""
+
+	def __init__ (self, registry, stage):
+		self.registry = registry
+		self.stage = stage
+		self.started = None
+
+	def __enter__ (self):
+		self.started = time.time()
+		return self
+
+	def __exit__ (self, exctype, excvalue, traceback):
+		self.registry.observe(self.stage, time.time() - self.started)
+		return False
+
+	def setLabels (self, **labels):
+		pass
+
+
+class Trace ():
+	"""
+	Collects the spans and counters of a unit of work (an event or a send) of the current thread, see trace()
+	"""
+
+	def __init__ (self, registry, kind, labels):
+
+		self.registry = registry
+		self.kind = kind
+		self.labels = labels
+		self.spans = {}
+		self.counters = {}
+		self.started = None
+		self.previous = None
+
+	def setLabels (self, **labels):
+		"""
+		Adds labels known only while the work is done (e.g. the proxy of an event, after its path has been verified)
+		:param labels:
+		:return:
+		"""
+		self.labels.update(labels)
+
+	def __enter__ (self):
+		self.started = time.time()
+		# traces can be nested (a send started by an event), the inner one collects until it ends
+		self.previous = getattr(self.registry.local, 'trace', None)
+		self.registry.local.trace = self
+		return self
+
+	def __exit__ (self, exctype, excvalue, traceback):
+
+		self.registry.local.trace = self.previous
+
+		record = {
+			"kind": self.kind,
+			"time": self.started,
+			"seconds": time.time() - self.started,
+			"labels": self.labels,
+			"spans": self.spans,
+			"counters": self.counters,
+			"error": None if excvalue is None else str(excvalue)
+		}
+		self.registry.exportTrace(record)
+		return False
+
+
+class JsonLinesExporter ():
+	"""
+	Appends each trace as a json object on its own line. The file is kept open and flushed after each trace; it is opened again if it has been moved away (e.g. by logrotate)
+	"""
+
+	def __init__ (self, path=None):
+
+		if path is None:
+			path = conf.metrics_jsonl_file
+		self.path = path
+		self.lock = threading.Lock()
+		self.fp = None
+		atexit.register(self.close)
+
+	def isMoved (self):
+
+		try:
+			return os.stat(self.path).st_ino != os.fstat(self.fp.fileno()).st_ino
+		except OSError:
+			return True
+
+	def export (self, record):
+
+		line = json.dumps(record, sort_keys=True) + "\n"
+		with self.lock:
+			if self.fp is not None and self.isMoved():
+				self.fp.close()
+				self.fp = None
+			if self.fp is None:
+				self.fp = open(self.path, 'a')
+			self.fp.write(line)
+			self.fp.flush()
+
+	def close (self):
+
+		with self.lock:
+			if self.fp is not None:
+				self.fp.close()
+				self.fp = None
+
+
+# exporter name (as in conf.metrics_exporters) -> function creating the exporter
+exporterfactories = {
+	"jsonlines": JsonLinesExporter
+}
+
+
+def registerExporter (name, factory):
+	"""
+	Adds an exporter that can be selected in conf.metrics_exporters
+	:param name:
+	:param factory: callable without arguments returning an object with an export(record) method, called with the dict of each trace
+	:return:
+	"""
+	exporterfactories[name] = factory
+
+
+class MetricsRegistry ():
+	"""
+	Aggregates of the spans and counters of the process, and dispatch of the traces to the exporters
+	"""
+
+	def __init__ (self):
+
+		self.lock = threading.Lock()
+		self.local = threading.local()
+		self.exporters = None
+		self.reset()
+
+	def reset (self):
+		with self.lock:
+			# stage -> [count, total seconds, max seconds]
+			self.stages = {}
+			# (name, sorted label items) -> value
+			self.counters = {}
+
+	def getTrace (self):
+		return getattr(self.local, 'trace', None)
+
+	def observe (self, stage, seconds):
+
+		with self.lock:
+			aggregate = self.stages.get(stage)
+			if aggregate is None:
+				aggregate = [0, 0.0, 0.0]
+				self.stages[stage] = aggregate
+			aggregate[0] += 1
+			aggregate[1] += seconds
+			aggregate[2] = max(aggregate[2], seconds)
+
+		current = self.getTrace()
+		if current is not None:
+			current.spans[stage] = current.spans.get(stage, 0.0) + seconds
+
+	def count (self, name, amount, labels):
+
+		key = (name, tuple(sorted(labels.items())))
+		with self.lock:
+			self.counters[key] = self.counters.get(key, 0) + amount
+
+		current = self.getTrace()
+		if current is not None:
+			# the labels of the counters in a trace are joined to the name, e.g. features.op=written
+			tracekey = ".".join([name] + ["%s=%s" % item for item in key[1]])
+			current.counters[tracekey] = current.counters.get(tracekey, 0) + amount
+
+	def timeIterator (self, stage, iterable):
+
+		iterator = iter(iterable)
+		total = 0.0
+		try:
+			while True:
+				started = time.time()
+				try:
+					item = next(iterator)
+				except StopIteration:
+					break
+				total += time.time() - started
+				yield item
+		finally:
+			self.observe(stage, total)
+
+	def getExporters (self):
+
+		with self.lock:
+			if self.exporters is None:
+				self.exporters = [exporterfactories[name]() for name in conf.metrics_exporters]
+			return self.exporters
+
+	def exportTrace (self, record):
+
+		for exporter in self.getExporters():
+			try:
+				exporter.export(record)
+			except Exception:
+				# the instrumentation must never break the work it measures
+				pass
+
+	def getSnapshot (self):
+		"""
+		Copies the aggregates
+		:return: tuple (dict stage -> (count, total seconds, max seconds), dict (name, labels) -> value)
+		"""
+		with self.lock:
+			stages = dict((stage, tuple(aggregate)) for stage, aggregate in self.stages.items())
+			return stages, dict(self.counters)
+
+
+registry = MetricsRegistry()
+
+
+def span (stage):
+	"""
+	Context manager timing a stage
+	:param stage: name of the stage
+	:return: context manager
+	"""
+	if not conf.metrics_enabled:
+		return NULL_SPAN
+	return Span(registry, stage)
+
+
+def trace (kind, **labels):
+	"""
+	Context manager collecting the spans and counters of a unit of work done by the current thread, exported when it ends
+	:param kind: "event" or "send"
+	:param labels: values identifying the work (path, proxy, ...)
+	:return: context manager, with a setLabels method
+	"""
+	if not conf.metrics_enabled:
+		return NULL_SPAN
+	return Trace(registry, kind, labels)
+
+
+def setTraceLabels (**labels):
+	"""
+	Adds labels to the trace open in the current thread, if any
+	:param labels:
+	:return:
+	"""
+	if conf.metrics_enabled:
+		current = registry.getTrace()
+		if current is not None:
+			current.setLabels(**labels)
+
+
+def observe (stage, seconds):
+	"""
+	Records a stage timed by the caller
+	:param stage:
+	:param seconds:
+	:return:
+	"""
+	if conf.metrics_enabled:
+		registry.observe(stage, seconds)
+
+
+def count (name, amount=1, **labels):
+	"""
+	Increments a counter
+	:param name:
+	:param amount:
+	:param labels:
+	:return:
+	"""
+	if conf.metrics_enabled:
+		registry.count(name, amount, labels)
+
+
+def timeIterator (stage, iterable):
+	"""
+	Times the production of the items of an iterable (e.g. the features read from a shapefile while they are written elsewhere) as a single span
+	:param stage:
+	:param iterable:
+	:return: the iterable itself if the instrumentation is disabled, else a generator over its items
+	"""
+	if not conf.metrics_enabled:
+		return iterable
+	return registry.timeIterator(stage, iterable)
+
+
+def formatLabels (labels):
+
+	if len(labels) == 0:
+		return ""
+	return "{%s}" % ",".join('%s="%s"' % (name, str(value).replace('\\', '\\\\').replace('"', '\\"')) for name, value in labels)
+
+
+def renderPrometheus ():
+	"""
+	Renders the aggregates in the Prometheus text exposition format
+	:return: string
+	"""
+
+	stages, counters = registry.getSnapshot()
+
+	lines = [
+		"# HELP proxy_stage_seconds Time spent in the stages of the events and sends",
+		"# TYPE proxy_stage_seconds summary"
+	]
+	for stage in sorted(stages.keys()):
+		stagecount, total, longest = stages[stage]
+		labels = formatLabels([("stage", stage)])
+		lines.append("proxy_stage_seconds_count%s %d" % (labels, stagecount))
+		lines.append("proxy_stage_seconds_sum%s %r" % (labels, total))
+	lines.append("# TYPE proxy_stage_seconds_max gauge")
+	for stage in sorted(stages.keys()):
+		lines.append("proxy_stage_seconds_max%s %r" % (formatLabels([("stage", stage)]), stages[stage][2]))
+
+	names = sorted(set(name for name, labels in counters.keys()))
+	for name in names:
+		lines.append("# TYPE proxy_%s_total counter" % name)
+		for (countername, labels), value in sorted(counters.items()):
+			if countername == name:
+				lines.append("proxy_%s_total%s %r" % (name, formatLabels(labels), float(value)))
+
+	return "\n".join(lines) + "\n"
+
+
+class MetricsRequestHandler (BaseHTTPRequestHandler):
+	"""
+	Serves renderPrometheus on /metrics
+	"""
+
+	def do_GET (self):
+
+		if self.path.split('?')[0] != "/metrics":
+			self.send_error(404)
+			return
+
+		body = renderPrometheus().encode('utf-8')
+		self.send_response(200)
+		self.send_header("Content-Type", "text/plain; version=0.0.4")
+		self.send_header("Content-Length", str(len(body)))
+		self.end_headers()
+		self.wfile.write(body)
+
+	def log_message (self, format, *args):
+		# the scrapes are not logged
+		pass
+
+
+def startMetricsServer (port=None, address=None):
+	"""
+	Starts the Prometheus text endpoint in a background thread
+	:param port: defaults to conf.metrics_http_port
+	:param address: defaults to conf.metrics_http_address
+	:return: the HTTPServer, stop it with shutdown() and server_close()
+	"""
+
+	if port is None:
+		port = conf.metrics_http_port
+	if address is None:
+		address = conf.metrics_http_address
+
+	server = HTTPServer((address, port), MetricsRequestHandler)
+	serving = threading.Thread(target=server.serve_forever)
+	serving.daemon = True
+	serving.start()
+
+	return server
@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+__author__ = 'Antonio Vaccarino'
+__docformat__ = 'restructuredtext en'
+
+import os
+import errno
+import shutil
+import ctypes
+import ctypes.util
+
+from errors import *
+import proxy_config_core as conf
+
+"""
+Atomic publishing of the mirror and geojson data.
+New versions are built in staging paths next to the published ones (same filesystem) and swapped in with a rename, so readers see either the old or the new version, never a partial one, and the data is never copied a second time.
+Directories are swapped with renameat2(RENAME_EXCHANGE) where the kernel and libc support it; otherwise the old directory is first renamed out of the way, which leaves a short window where the shape is missing but still never half-written.
+"""
+
+# staging area inside each meta directory of the mirror; hidden so it is never taken for a shape
+STAGING_DIR = ".staging"
+
+AT_FDCWD = -100
+RENAME_EXCHANGE = 2
+
+try:
+	libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+	renameat2 = libc.renameat2
+	renameat2.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_int, ctypes.c_char_p, ctypes.c_uint]
+	renameat2.restype = ctypes.c_int
+except (OSError, AttributeError, TypeError):
+	renameat2 = None
+
+
+def getStagingPath (proxy_id, meta_id, shape_id):
+	"""
+	Returns the directory where the new mirror data of a shape is prepared before publishing
+	:param proxy_id:
+	:param meta_id:
+	:param shape_id:
+	:return: path
+	"""
+	return os.path.join(conf.baseproxypath, proxy_id, conf.path_mirror, meta_id, STAGING_DIR, shape_id)
+
+
+def exchangePaths (path_a, path_b):
+	"""
+	Atomically exchanges two existing paths
+	:param path_a:
+	:param path_b:
+	:return: True on success, False if the exchange is not supported here
+	"""
+
+	if renameat2 is None:
+		return False
+
+	if renameat2(AT_FDCWD, path_a.encode('utf-8'), AT_FDCWD, path_b.encode('utf-8'), RENAME_EXCHANGE) == 0:
+		return True
+
+	err = ctypes.get_errno()
+	if err in (errno.ENOSYS, errno.EINVAL, errno.EPERM):
+		# old kernel or a filesystem without exchange support
+		return False
+
+	raise OSError (err, os.strerror(err), path_a)
+
+
+def publishDirectory (path_new, path_current):
+	"""
+	Replaces path_current with path_new (which must be on the same filesystem) and removes the old version
+	:param path_new: fully prepared directory
+	:param path_current: published directory, may not exist yet
+	:return:
+	"""
+
+	if not os.path.exists(path_current):
+		os.rename(path_new, path_current)
+		return
+
+	if exchangePaths(path_new, path_current):
+		# path_new now holds the old version
+		shutil.rmtree(path_new)
+		return
+
+	path_old = path_new + ".old"
+	if os.path.exists(path_old):
+		shutil.rmtree(path_old)
+	os.rename(path_current, path_old)
+	try:
+		os.rename(path_new, path_current)
+	except OSError:
+		# putting back the old version rather than leaving nothing published
+		os.rename(path_old, path_current)
+		raise
+	shutil.rmtree(path_old)
+
+
+def getTempFilePath (path_file):
+	"""
+	Returns the hidden path, in the same directory, where a new version of a file is written before publishFile
+	:param path_file:
+	:return: path
+	"""
+	dirname, filename = os.path.split(path_file)
+	return os.path.join(dirname, "."+filename+".tmp")
+
+
+def publishFile (path_new, path_current):
+	"""
+	Atomically replaces a file with a new version
+	:param path_new:
+	:param path_current:
+	:return:
+	"""
+	os.rename(path_new, path_current)
@@ -0,0 +1,355 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+__author__ = 'Antonio Vaccarino'
+__docformat__ = 'restructuredtext en'
+
+import os
+import sys
+import zlib
+import json
+import time
+import email
+import shutil
+import argparse
+import tempfile
+import threading
+
+try:
+	import BaseHTTPServer as httpserver
+	import SocketServer as socketserver
+except ImportError:
+	import http.server as httpserver
+	import socketserver
+
+import proxy_config_core as conf
+import proxy_client
+import proxy_log
+
+"""
+Self checks of the links of the proxy with external services, run against local stand-ins started on ephemeral ports, so they need no network and no configured instance:
+
+	client: the main server client (proxy_client) against a local HTTP server; retried requests must send the whole body again, and a pooled connection closed by the server must be replaced at once, without backoff
+	mail: the error mails (proxy_log.ErrorMailer) against a local SMTP server, with a short conf.mail_min_interval; errors raised within the interval must be aggregated in one mail, listed up to conf.mail_max_errors
+	logs: the log writer (proxy_log.LogWriter) with a small conf.log_max_bytes; files must be rotated, keeping conf.log_backups of them, and non-ascii lines written as utf-8
+
+Each check raises AssertionError on failure; the exit status is 1 if any of the checks failed:
+
+	python proxy_selfcheck.py [check ...]
+"""
+
+
+class StandInRequestHandler (httpserver.BaseHTTPRequestHandler):
+	"""
+	Main server stand-in: decodes the chunked gzip body of each POST, records it and answers with the next status of server.statuses (200 when they run out)
+	"""
+
+	protocol_version = "HTTP/1.1"
+
+	def log_message (self, *args):
+		pass
+
+	def readChunkedBody (self):
+
+		chunks = []
+		while True:
+			size = int(self.rfile.readline().strip(), 16)
+			if size == 0:
+				self.rfile.readline()
+				break
+			chunks.append(self.rfile.read(size))
+			self.rfile.readline()
+		return b"".join(chunks)
+
+	def do_POST (self):
+
+		body = self.readChunkedBody()
+		if self.headers.get("Content-Encoding") == "gzip":
+			body = zlib.decompress(body, 16 + zlib.MAX_WBITS)
+		self.server.bodies.append(body)
+
+		status = self.server.statuses.pop(0) if self.server.statuses else 200
+		data = json.dumps({"received": len(body)}).encode('utf-8')
+		self.send_response(status)
+		self.send_header("Content-Type", "application/json")
+		self.send_header("Content-Length", str(len(data)))
+		self.end_headers()
+		self.wfile.write(data)
+		self.wfile.flush()
+
+		# the connection is dropped without announcing it, as a server closing an idle keep-alive connection
+		if self.server.dropconnections:
+			self.close_connection = True
+
+
+class StandInHTTPServer (socketserver.ThreadingMixIn, httpserver.HTTPServer):
+	# the connections kept alive by the client must not block the shutdown
+	daemon_threads = True
+
+
+def startHttpStandIn (statuses=None, dropconnections=False):
+	"""
+	Starts a main server stand-in on an ephemeral port of localhost, in a daemon thread
+	:param statuses: list of the statuses of the first responses
+	:param dropconnections: if True each connection is closed after its first response
+	:return: server, its url is server.url
+	"""
+
+	server = StandInHTTPServer(("127.0.0.1", 0), StandInRequestHandler)
+	server.statuses = list(statuses or [])
+	server.dropconnections = dropconnections
+	server.bodies = []
+	server.url = "http://127.0.0.1:%s/" % server.server_address[1]
+
+	thread = threading.Thread(target=server.serve_forever)
+	thread.daemon = True
+	thread.start()
+
+	return server
+
+
+def iterCompressedChunks (payload, chunksize=1024):
+
+	compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+	for offset in range(0, len(payload), chunksize):
+		yield compressor.compress(payload[offset:offset+chunksize])
+	yield compressor.flush()
+
+
+def checkClient ():
+	"""
+	Checks the retries of proxy_client.MainServerClient against a local HTTP server
+	"""
+
+	payload = json.dumps({"features": ["x" * 64] * 1000}).encode('utf-8')
+	calls = []
+
+	def messagefactory ():
+		calls.append(len(calls))
+		return iterCompressedChunks(payload)
+
+	# a server error: the retry sends the whole body again, built anew by the factory
+	server = startHttpStandIn(statuses=[503])
+	try:
+		client = proxy_client.MainServerClient(server.url, maxinflight=2, tries=3, wait=0.01, timeout=10)
+		response = client.sendMessage(messagefactory)
+		stats = client.getStats()
+	finally:
+		server.shutdown()
+		server.server_close()
+
+	assert response == {"received": len(payload)}, "unexpected response %s" % response
+	assert len(calls) == 2, "the body was built %s times for 2 attempts" % len(calls)
+	assert server.bodies == [payload, payload], "a retried body was not sent whole"
+	assert stats["retries"] == 1 and stats["succeeded"] == 1, "unexpected stats %s" % stats
+
+	# a pooled connection closed by the server: repeated at once on a new connection, the backoff (wait) would take minutes
+	del calls[:]
+	server = startHttpStandIn(dropconnections=True)
+	try:
+		client = proxy_client.MainServerClient(server.url, maxinflight=1, tries=3, wait=60, timeout=10)
+		client.sendMessage(messagefactory)
+		# leaves time to the server to close the connection
+		time.sleep(0.2)
+		started = time.time()
+		response = client.sendMessage(messagefactory)
+		elapsed = time.time() - started
+		stats = client.getStats()
+	finally:
+		server.shutdown()
+		server.server_close()
+
+	assert response == {"received": len(payload)}, "unexpected response %s" % response
+	assert elapsed < 10, "the stale connection was retried after %.1f s" % elapsed
+	assert stats["stale_connections"] == 1, "unexpected stats %s" % stats
+	assert stats["retries"] == 0 and stats["connections_opened"] == 2, "unexpected stats %s" % stats
+	assert server.bodies == [payload, payload], "the body of the repeated request was not sent whole"
+
+
+class StandInSMTPHandler (socketserver.StreamRequestHandler):
+	"""
+	SMTP server stand-in: accepts every message and records it in server.messages with its time
+	"""
+
+	def reply (self, line):
+		self.wfile.write(line.encode('ascii') + b"\r\n")
+		self.wfile.flush()
+
+	def handle (self):
+
+		self.reply("220 localhost stand-in")
+		while True:
+			line = self.rfile.readline()
+			if not line:
+				return
+			command = line.decode('ascii', 'replace').strip().upper()
+			if command.startswith("DATA"):
+				self.reply("354 end with <CRLF>.<CRLF>")
+				lines = []
+				while True:
+					dataline = self.rfile.readline()
+					if dataline in (b".\r\n", b".\n", b""):
+						break
+					lines.append(dataline)
+				self.server.messages.append((time.time(), b"".join(lines)))
+				self.reply("250 accepted")
+			elif command.startswith("QUIT"):
+				self.reply("221 bye")
+				return
+			else:
+				# EHLO, HELO, MAIL, RCPT, RSET, NOOP
+				self.reply("250 ok")
+
+
+class StandInSMTPServer (socketserver.ThreadingMixIn, socketserver.TCPServer):
+	daemon_threads = True
+	allow_reuse_address = True
+
+
+def startSmtpStandIn ():
+	"""
+	Starts an SMTP server stand-in on an ephemeral port of localhost, in a daemon thread
+	:return: server, its port is server.server_address[1]
+	"""
+
+	server = StandInSMTPServer(("127.0.0.1", 0), StandInSMTPHandler)
+	server.messages = []
+
+	thread = threading.Thread(target=server.serve_forever)
+	thread.daemon = True
+	thread.start()
+
+	return server
+
+
+class ConfigOverride ():
+	"""
+	Sets configuration values for the duration of a check
+	"""
+
+	def __init__ (self, **values):
+		self.values = values
+		self.previous = {}
+
+	def __enter__ (self):
+		for name, value in self.values.items():
+			self.previous[name] = getattr(conf, name)
+			setattr(conf, name, value)
+		return self
+
+	def __exit__ (self, exctype, excvalue, traceback):
+		for name, value in self.previous.items():
+			setattr(conf, name, value)
+		return False
+
+
+def checkMail ():
+	"""
+	Checks the aggregation and the rate limiting of the error mails against a local SMTP server
+	"""
+
+	server = startSmtpStandIn()
+	try:
+		with ConfigOverride(mail_smtp_host="127.0.0.1", mail_smtp_port=server.server_address[1], mail_min_interval=1.0, mail_max_errors=3):
+			failures = []
+			mailer = proxy_log.ErrorMailer(failures.append)
+			try:
+				# the first error is mailed at once, the next ones wait for the end of the interval and go in a single mail
+				mailer.add(u"Errore sulla mappa di Forl\xec")
+				deadline = time.time() + 10
+				while len(server.messages) < 1 and time.time() < deadline:
+					time.sleep(0.05)
+				for i in range (0, 5):
+					mailer.add("Error %d" % i)
+				deadline = time.time() + 10
+				while len(server.messages) < 2 and time.time() < deadline:
+					time.sleep(0.05)
+				# nothing else must be sent
+				time.sleep(0.5)
+			finally:
+				mailer.stop(10)
+	finally:
+		server.shutdown()
+		server.server_close()
+
+	assert failures == [], "mails failed: %s" % failures
+	assert len(server.messages) == 2, "%d mails sent for 2 intervals" % len(server.messages)
+
+	(firsttime, first), (secondtime, second) = server.messages
+	assert secondtime - firsttime >= 0.9, "mails sent %.2f s apart, the min interval is 1 s" % (secondtime - firsttime)
+
+	first = email.message_from_string(first.decode('ascii'))
+	second = email.message_from_string(second.decode('ascii'))
+	assert first['Subject'] == "[FIdER proxy] 1 errors", "unexpected subject %s" % first['Subject']
+	assert u"Forl\xec" in first.get_payload(decode=True).decode('utf-8'), "non-ascii error text lost"
+	assert second['Subject'] == "[FIdER proxy] 5 errors", "unexpected subject %s" % second['Subject']
+	text = second.get_payload(decode=True).decode('utf-8')
+	assert "Error 2" in text and "Error 3" not in text and "and 2 more errors" in text, "errors not aggregated as expected: %s" % text
+
+
+def checkLogs ():
+	"""
+	Checks the rotation of the log files (written one line per batch, as files are rotated between batches) and the writing of non-ascii lines
+	"""
+
+	path_logs = tempfile.mkdtemp(prefix="proxyselfcheck")
+	try:
+		with ConfigOverride(log_folder=path_logs, log_max_bytes=200, log_rotate_interval=None, log_backups=2, log_batch_size=1, log_fsync=False, mail_smtp_host=None):
+			writer = proxy_log.LogWriter()
+			for i in range (0, 40):
+				writer.log(u"line %02d citt\xe0" % i)
+			writer.stop(10)
+
+		filenames = sorted(os.listdir(path_logs))
+		assert filenames == ["proxyops.log", "proxyops.log.1", "proxyops.log.2"], "unexpected log files %s" % filenames
+
+		lines = []
+		for filename in reversed(filenames):
+			log_fp = open(os.path.join(path_logs, filename), 'rb')
+			try:
+				content = log_fp.read()
+			finally:
+				log_fp.close()
+			assert len(content) <= 200, "%s is larger than log_max_bytes" % filename
+			lines.extend(content.decode('utf-8').splitlines())
+	finally:
+		shutil.rmtree(path_logs, ignore_errors=True)
+
+	assert lines[-1] == u"line 39 citt\xe0", "last line is %r" % lines[-1]
+	assert lines == [u"line %02d citt\xe0" % i for i in range (40 - len(lines), 40)], "lines lost or out of order within the kept files"
+
+
+CHECKS = (
+	("client", checkClient),
+	("mail", checkMail),
+	("logs", checkLogs)
+)
+
+
+def main (argv=None):
+
+	parser = argparse.ArgumentParser(description="Self checks against local stand-ins of the external services")
+	parser.add_argument("checks", nargs="*", help="checks to run, all by default: %s" % ", ".join(name for name, check in CHECKS))
+	args = parser.parse_args(argv)
+
+	for name in args.checks:
+		if name not in dict(CHECKS):
+			parser.error("unknown check %s" % name)
+
+	failed = 0
+	for name, check in CHECKS:
+		if args.checks and name not in args.checks:
+			continue
+		try:
+			check()
+		except Exception as ex:
+			failed += 1
+			sys.stdout.write("%s: FAILED (%s: %s)\n" % (name, type(ex).__name__, ex))
+		else:
+			sys.stdout.write("%s: ok\n" % name)
+
+	sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,184 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+__author__ = 'Antonio Vaccarino'
+__docformat__ = 'restructuredtext en'
+
+import os
+import time
+import threading
+
+try:
+	import Queue as queue
+except ImportError:
+	import queue
+
+from errors import *
+import proxy_config_core as conf
+import proxy_journal
+
+"""
+Scheduler of the sends to the main server for all the soft proxies of the hard proxy.
+The update journals of every proxy are scanned every conf.send_scan_interval seconds. A meta is ready to be sent when it has not been updated for conf.send_window seconds, so a burst of updates on the same meta goes out in a single send, or when its oldest unsent update is older than conf.send_max_delay. Proxies with ready metas are queued at most once each (first come first served, so a busy proxy cannot starve the others) and sent by a pool of conf.send_workers threads, which is also the global cap on concurrent sends.
+A meta whose latest sends failed (e.g. not in the manifest any more, or refused by the main server) is only ready again after a delay growing with each failure, and is left alone after conf.send_max_attempts failures (see proxy_journal.getRetryDelay, isGivenUp).
+"""
+
+
+class SendScheduler ():
+	"""
+	Periodically scans the proxies for pending updates and sends them concurrently
+	"""
+
+	def __init__ (self, sender=None, workers=None, window=None, maxdelay=None, interval=None):
+
+		# the sender defaults to ProxyFS.sendUpdatesToMain; imported here to keep this module free of the ogr dependencies
+		if sender is None:
+			import ProxyFS
+			sender = ProxyFS.sendUpdatesToMain
+		if workers is None:
+			workers = conf.send_workers
+		if window is None:
+			window = conf.send_window
+		if maxdelay is None:
+			maxdelay = conf.send_max_delay
+		if interval is None:
+			interval = conf.send_scan_interval
+
+		self.sender = sender
+		self.window = window
+		self.maxdelay = maxdelay
+		self.interval = interval
+
+		# proxies queued or being sent, never queued twice
+		self.scheduled = set()
+		self.lock = threading.Lock()
+		self.ready = queue.Queue()
+		self.stopping = threading.Event()
+
+		self.scanner = threading.Thread(target=self.scanLoop)
+		self.scanner.daemon = True
+		self.workers = []
+		for i in range (0, max(1, workers)):
+			worker = threading.Thread(target=self.workerLoop)
+			worker.daemon = True
+			self.workers.append(worker)
+
+	def listPending (self, proxy_id):
+		"""
+		Lists the metas with pending updates of a proxy
+		:param proxy_id:
+		:return: dict meta_id -> tuple (latest sequence number, time of the first update, time of the latest update)
+		"""
+
+		# proxies that never recorded an update have no journal, and scanning must not create one
+		if not proxy_journal.hasJournal(proxy_id):
+			return {}
+
+		return proxy_journal.getJournal(proxy_id).pending()
+
+	def listFailures (self, proxy_id):
+		"""
+		Lists the metas of a proxy whose latest sends failed
+		:param proxy_id:
+		:return: dict meta_id -> tuple (number of consecutive failed sends, time of the latest)
+		"""
+
+		if not proxy_journal.hasJournal(proxy_id):
+			return {}
+
+		return proxy_journal.getJournal(proxy_id).failures()
+
+	def selectReady (self, proxy_id, pending, now, failures=None):
+		"""
+		Applies the send window, and the backoff of the failed metas, to the pending metas of a proxy
+		:param proxy_id:
+		:param pending: dict as returned by listPending
+		:param now:
+		:param failures: dict as returned by listFailures
+		:return: list of meta_ids to send
+		"""
+
+		if failures is None:
+			failures = {}
+
+		readylist = []
+		for meta_id, (seq, first, latest) in pending.items():
+			if meta_id in failures:
+				attempts, lastfailed = failures[meta_id]
+				if proxy_journal.isGivenUp(attempts) or now - lastfailed < proxy_journal.getRetryDelay(attempts):
+					continue
+			if now - latest >= self.window or now - first >= self.maxdelay:
+				readylist.append(meta_id)
+
+		return sorted(readylist)
+
+	def scanOnce (self):
+		"""
+		Scans all the proxies and queues the ones with metas ready to be sent
+		:return: number of proxies queued
+		"""
+
+		try:
+			proxies = sorted(os.listdir(conf.baseproxypath))
+		except OSError:
+			return 0
+
+		now = time.time()
+		queued = 0
+		for proxy_id in proxies:
+			with self.lock:
+				if proxy_id in self.scheduled:
+					continue
+			pending = self.listPending(proxy_id)
+			if len(pending) == 0:
+				continue
+			readylist = self.selectReady(proxy_id, pending, now, self.listFailures(proxy_id))
+			if len(readylist) == 0:
+				continue
+			with self.lock:
+				self.scheduled.add(proxy_id)
+			self.ready.put((proxy_id, readylist))
+			queued += 1
+
+		return queued
+
+	def scanLoop (self):
+
+		while not self.stopping.is_set():
+			self.scanOnce()
+			self.stopping.wait(self.interval)
+
+	def workerLoop (self):
+
+		while True:
+			job = self.ready.get()
+			if job is None:
+				break
+			proxy_id, readylist = job
+			# the sender logs its own failures, the metas left in the journal are picked up again by the next scans
+			try:
+				self.sender(proxy_id, readylist)
+			except Exception:
+				pass
+			finally:
+				with self.lock:
+					self.scheduled.discard(proxy_id)
+
+	def start (self):
+
+		self.scanner.start()
+		for worker in self.workers:
+			worker.start()
+
+	def stop (self):
+		"""
+		Stops scanning and waits for the sends already queued
+		:return:
+		"""
+
+		self.stopping.set()
+		self.scanner.join()
+		for worker in self.workers:
+			self.ready.put(None)
+		for worker in self.workers:
+			worker.join()
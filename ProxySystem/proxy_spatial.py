@@ -0,0 +1,383 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+__author__ = 'Antonio Vaccarino'
+__docformat__ = 'restructuredtext en'
+
+import os
+import mmap
+import struct
+
+from errors import *
+import proxy_config_core as conf
+import proxy_json
+import proxy_publish
+
+"""
+Spatial index of the replicated shapes, used to answer the BB queries without reading the whole geojson data of a meta.
+For every shape the proxy keeps a packed Hilbert R-tree ($proxy/maps/spatial/$meta/$shape) of the envelopes of its features, built while replicateShapeData writes the geojson file. The leaves point to the features in the geojson file (byte offset and length of their line, see proxy_core.writeFeatureCollection), so a query reads only the matching features.
+The index is a static tree: features are sorted by the Hilbert value of the center of their envelope and grouped in nodes of conf.spatial_node_size entries, level by level up to a single root. It is rebuilt from scratch on every replication of the shape, as the geojson file is.
+Index file layout (little endian): header, end position of each level, the boxes of all the nodes (leaves first, minx miny maxx maxy doubles), then offset (uint64) and length (uint32) of the feature of each leaf.
+"""
+
+MAGIC = b"PHRT"
+VERSION = 1
+
+# magic, version, node size, number of levels, number of features, inode and size of the geojson file the index refers to
+HEADER = struct.Struct("<4sHHIQQQ")
+BOX = struct.Struct("<4d")
+LEAF = struct.Struct("<QI")
+
+# resolution of the Hilbert curve used for the ordering (bits per axis)
+HILBERT_BITS = 16
+
+
+def getSpatialPath (proxy_id, meta_id, shape_id):
+	return os.path.join(conf.baseproxypath, proxy_id, conf.path_spatial, meta_id, shape_id)
+
+
+def getGeometryEnvelope (geometry):
+	"""
+	Computes the envelope of a GeoJSON geometry
+	:param geometry: dict, GeoJSON geometry
+	:return: tuple (minx, miny, maxx, maxy), None for empty or null geometries
+	"""
+
+	if geometry is None:
+		return None
+
+	if geometry.get('type') == 'GeometryCollection':
+		envelopes = [getGeometryEnvelope(member) for member in geometry.get('geometries', [])]
+		envelopes = [envelope for envelope in envelopes if envelope is not None]
+		if len(envelopes) == 0:
+			return None
+		return (
+			min(envelope[0] for envelope in envelopes),
+			min(envelope[1] for envelope in envelopes),
+			max(envelope[2] for envelope in envelopes),
+			max(envelope[3] for envelope in envelopes)
+		)
+
+	xs = []
+	ys = []
+	pending = [geometry.get('coordinates')]
+	while len(pending) > 0:
+		coords = pending.pop()
+		if not coords:
+			continue
+		if isinstance(coords[0], (int, float)):
+			xs.append(coords[0])
+			ys.append(coords[1])
+		else:
+			pending.extend(coords)
+
+	if len(xs) == 0:
+		return None
+
+	return min(xs), min(ys), max(xs), max(ys)
+
+
+def intersects (box_a, box_b):
+	return box_a[0] <= box_b[2] and box_a[2] >= box_b[0] and box_a[1] <= box_b[3] and box_a[3] >= box_b[1]
+
+
+def hilbertValue (x, y, bits=HILBERT_BITS):
+	"""
+	Position of a cell on the Hilbert curve covering a 2^bits x 2^bits grid
+	:param x: column of the cell
+	:param y: row of the cell
+	:param bits:
+	:return: int
+	"""
+
+	value = 0
+	side = 1 << (bits - 1)
+	while side > 0:
+		rx = 1 if (x & side) else 0
+		ry = 1 if (y & side) else 0
+		value += side * side * ((3 * rx) ^ ry)
+		# rotating the quadrant
+		if ry == 0:
+			if rx == 1:
+				x = side - 1 - x
+				y = side - 1 - y
+			x, y = y, x
+		side >>= 1
+
+	return value
+
+
+def buildTree (entries, nodesize):
+	"""
+	Builds the levels of a packed Hilbert R-tree
+	:param entries: list of (box, offset, length) tuples, the leaves
+	:param nodesize: max number of children of a node
+	:return: tuple (boxes of all the nodes, leaves first, list of the end positions of each level, sorted leaf entries)
+	"""
+
+	if len(entries) == 0:
+		return [], [], []
+
+	minx = min(entry[0][0] for entry in entries)
+	miny = min(entry[0][1] for entry in entries)
+	maxx = max(entry[0][2] for entry in entries)
+	maxy = max(entry[0][3] for entry in entries)
+
+	scale = (1 << HILBERT_BITS) - 1
+	width = (maxx - minx) or 1.0
+	height = (maxy - miny) or 1.0
+
+	def sortkey (entry):
+		box = entry[0]
+		x = int(scale * ((box[0] + box[2]) / 2.0 - minx) / width)
+		y = int(scale * ((box[1] + box[3]) / 2.0 - miny) / height)
+		return hilbertValue(x, y)
+
+	entries = sorted(entries, key=sortkey)
+
+	boxes = [entry[0] for entry in entries]
+	levelbounds = [len(boxes)]
+
+	levelstart = 0
+	while levelbounds[-1] - levelstart > 1:
+		levelend = levelbounds[-1]
+		for childstart in range (levelstart, levelend, nodesize):
+			children = boxes[childstart:min(childstart+nodesize, levelend)]
+			boxes.append((
+				min(box[0] for box in children),
+				min(box[1] for box in children),
+				max(box[2] for box in children),
+				max(box[3] for box in children)
+			))
+		levelstart = levelend
+		levelbounds.append(len(boxes))
+
+	return boxes, levelbounds, entries
+
+
+class SpatialIndexBuilder ():
+	"""
+	Collects the envelopes of the features of a shape while its geojson file is written (pass add as the onwrite callback of writeFeatureCollection), then writes the index with commit() or drops it with discard()
+	"""
+
+	def __init__ (self, proxy_id, meta_id, shape_id, nodesize=None):
+
+		if nodesize is None:
+			nodesize = conf.spatial_node_size
+
+		self.path_index = getSpatialPath(proxy_id, meta_id, shape_id)
+		self.path_index_new = proxy_publish.getTempFilePath(self.path_index)
+		self.nodesize = max(2, nodesize)
+
+		self.entries = []
+
+	def add (self, fid, featurejson, offset, length):
+		"""
+		Records the envelope of a feature written to the geojson file
+		:param fid:
+		:param featurejson: geojson string of the feature
+		:param offset: byte offset of the feature in the geojson file
+		:param length: byte length of the feature
+		:return:
+		"""
+
+		if isinstance(featurejson, dict):
+			geometry = featurejson.get('geometry')
+		else:
+			geometry = proxy_json.loads(featurejson).get('geometry')
+
+		envelope = getGeometryEnvelope(geometry)
+		if envelope is None:
+			# features without geometry never match a BB query
+			return
+
+		self.entries.append((envelope, offset, length))
+
+	def commit (self, path_gj):
+		"""
+		Writes the index aside; it must be published (see publish) when the geojson file it refers to is published
+		:param path_gj: the geojson file that has just been written, the index records its inode and size
+		:return: number of indexed features
+		"""
+
+		if not os.path.exists(os.path.dirname(self.path_index)):
+			os.makedirs(os.path.dirname(self.path_index))
+
+		stat = os.stat(path_gj)
+		boxes, levelbounds, entries = buildTree(self.entries, self.nodesize)
+		self.entries = []
+
+		index_fp = open(self.path_index_new, 'wb')
+		try:
+			index_fp.write(HEADER.pack(MAGIC, VERSION, self.nodesize, len(levelbounds), len(entries), stat.st_ino, stat.st_size))
+			index_fp.write(struct.pack("<%dQ" % len(levelbounds), *levelbounds))
+			for box in boxes:
+				index_fp.write(BOX.pack(*box))
+			for box, offset, length in entries:
+				index_fp.write(LEAF.pack(offset, length))
+		finally:
+			index_fp.close()
+
+		return len(entries)
+
+	def publish (self):
+		proxy_publish.publishFile(self.path_index_new, self.path_index)
+
+	def discard (self):
+
+		self.entries = []
+		if os.path.exists(self.path_index_new):
+			os.remove(self.path_index_new)
+
+
+def removeShapeIndex (proxy_id, meta_id, shape_id):
+
+	path_index = getSpatialPath(proxy_id, meta_id, shape_id)
+	if os.path.exists(path_index):
+		os.remove(path_index)
+
+
+def searchIndex (index, bb):
+	"""
+	Walks a packed Hilbert R-tree
+	:param index: buffer with the content of an index file
+	:param bb: tuple (minx, miny, maxx, maxy)
+	:return: list of (offset, length) of the matching features, in file order
+	"""
+
+	magic, version, nodesize, levels, count, ino, size = HEADER.unpack_from(index, 0)
+	if count == 0:
+		return []
+
+	levelbounds = struct.unpack_from("<%dQ" % levels, index, HEADER.size)
+	boxesstart = HEADER.size + 8 * levels
+	leavesstart = boxesstart + BOX.size * levelbounds[-1]
+
+	matches = []
+	# stack of (level, node position); the root is the only node of the top level
+	stack = [(levels - 1, levelbounds[-1] - 1)]
+	while len(stack) > 0:
+		level, position = stack.pop()
+		if not intersects(BOX.unpack_from(index, boxesstart + BOX.size * position), bb):
+			continue
+		if level == 0:
+			matches.append(LEAF.unpack_from(index, leavesstart + LEAF.size * position))
+			continue
+		levelstart = levelbounds[level-1]
+		childlevelstart = levelbounds[level-2] if level > 1 else 0
+		firstchild = childlevelstart + (position - levelstart) * nodesize
+		for child in range (firstchild, min(firstchild + nodesize, levelbounds[level-1])):
+			stack.append((level - 1, child))
+
+	return sorted(matches)
+
+
+def openIndex (path_index, gj_fp):
+	"""
+	Maps an index file, if it refers to the given geojson file
+	:param path_index:
+	:param gj_fp: geojson file open for reading
+	:return: mmap of the index, None if there is no usable index
+	"""
+
+	try:
+		index_fp = open(path_index, 'rb')
+	except IOError:
+		return None
+
+	try:
+		if os.fstat(index_fp.fileno()).st_size < HEADER.size:
+			return None
+		index = mmap.mmap(index_fp.fileno(), 0, access=mmap.ACCESS_READ)
+	finally:
+		index_fp.close()
+
+	magic, version, nodesize, levels, count, ino, size = HEADER.unpack_from(index, 0)
+	stat = os.fstat(gj_fp.fileno())
+	if magic != MAGIC or version != VERSION or ino != stat.st_ino or size != stat.st_size:
+		# written for another version of the geojson file (the two are published one after the other)
+		index.close()
+		return None
+
+	return index
+
+
+def searchShape (proxy_id, meta_id, shape_id, bb):
+	"""
+	Finds the features of a replicated shape whose envelope intersects a bounding box. Shapes without a valid index (replicated before the index existed) are searched by reading their geojson file
+	:param proxy_id:
+	:param meta_id:
+	:param shape_id:
+	:param bb: tuple (minx, miny, maxx, maxy)
+	:return: list of the matching features (dicts)
+	"""
+
+	path_gj = os.path.join(conf.baseproxypath, proxy_id, conf.path_geojson, meta_id, shape_id)
+
+	gj_fp = open(path_gj, 'rb')
+	try:
+		index = openIndex(getSpatialPath(proxy_id, meta_id, shape_id), gj_fp)
+		if index is None:
+			return scanShape(gj_fp, bb)
+
+		try:
+			matches = searchIndex(index, bb)
+		finally:
+			index.close()
+
+		return readIndexedFeatures(gj_fp, matches)
+	finally:
+		gj_fp.close()
+
+
+def readIndexedFeatures (gj_fp, matches):
+	"""
+	Reads the features found through an index from their geojson file
+	:param gj_fp: geojson file open for reading (binary)
+	:param matches: list of (offset, length) of the features in the file, as stored in the indexes
+	:return: list of features (dicts)
+	"""
+
+	features = []
+	for offset, length in matches:
+		gj_fp.seek(offset)
+		features.append(proxy_json.loads(gj_fp.read(length).decode('utf-8')))
+	return features
+
+
+def scanShape (gj_fp, bb):
+	"""
+	Fallback for searchShape, filters all the features of a geojson file
+	:param gj_fp: geojson file open for reading
+	:param bb: tuple (minx, miny, maxx, maxy)
+	:return: list of the matching features
+	"""
+
+	gj_fp.seek(0)
+	collection = proxy_json.loads(gj_fp.read().decode('utf-8'))
+
+	features = []
+	for feature in collection.get('features', []):
+		envelope = getGeometryEnvelope(feature.get('geometry'))
+		if envelope is not None and intersects(envelope, bb):
+			features.append(feature)
+
+	return features
+
+
+def parseBB (bb):
+	"""
+	Validates the BB of a query message
+	:param bb: list [minx, miny, maxx, maxy]
+	:return: tuple of floats
+	"""
+
+	try:
+		minx, miny, maxx, maxy = [float(value) for value in bb]
+	except (TypeError, ValueError):
+		raise InvalidQueryException ("Non valid bounding box %s, expected [minx, miny, maxx, maxy]" % (bb,))
+
+	if minx > maxx or miny > maxy:
+		raise InvalidQueryException ("Non valid bounding box %s, min greater than max" % (bb,))
+
+	return minx, miny, maxx, maxy
@@ -0,0 +1,640 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+__author__ = 'Antonio Vaccarino'
+__docformat__ = 'restructuredtext en'
+
+import os
+import mmap
+import time
+import bisect
+import struct
+import calendar
+
+from errors import *
+import proxy_config_core as conf
+import proxy_json
+import proxy_publish
+import proxy_spatial
+
+"""
+Attribute and time indexes of the replicated shapes, used to answer the inventory and time queries without reading the geojson data.
+Both are built while replicateShapeData writes the geojson file of a shape, like the spatial index (see proxy_spatial):
+- the inventory summary ($proxy/maps/summary/$meta/$shape, json) has the number of features and, for each attribute, the number of features for each of its values (up to conf.inventory_max_values distinct values, the features with other values are only counted: the queries on those values read the geojson file of the shape, see getOverflowKeys) and of features without it; the values are keyed with their type (see getValueKey);
+- the time index ($proxy/maps/time/$meta/$shape) lists the features sorted by their time (the first attribute of the feature named as one of conf.time_attributes that holds an ISO 8601 date) with their byte offset and length in the geojson file, then the features without a time.
+Features without a time take the time range of their meta in the manifest: they match a time query if that range does (or if the meta has none). A date without a time as the end of a range stands for the whole day.
+Time index file layout (little endian): header, (time, offset, length) of the timed features by time, (offset, length) of the others.
+"""
+
+# format of the inventory summaries, older summaries are rebuilt (see loadShapeSummary)
+SUMMARY_FORMAT = 2
+
+MAGIC = b"TIDX"
+VERSION = 1
+
+# magic, version, number of timed features, number of untimed features, inode and size of the geojson file the index refers to
+HEADER = struct.Struct("<4sHQQQQ")
+TIMED = struct.Struct("<dQI")
+UNTIMED = struct.Struct("<QI")
+
+DATE_FORMATS = (
+	"%Y-%m-%d",
+	"%Y/%m/%d"
+)
+
+TIME_FORMATS = (
+	"%Y-%m-%dT%H:%M:%S.%fZ",
+	"%Y-%m-%dT%H:%M:%SZ",
+	"%Y-%m-%dT%H:%MZ",
+	"%Y-%m-%dT%H:%M:%S",
+	"%Y-%m-%dT%H:%M",
+	"%Y-%m-%d %H:%M:%S"
+) + DATE_FORMATS
+
+DAY_SECONDS = 24 * 60 * 60
+
+
+def getSummaryPath (proxy_id, meta_id, shape_id):
+	return os.path.join(conf.baseproxypath, proxy_id, conf.path_summary, meta_id, shape_id)
+
+def getTimeIndexPath (proxy_id, meta_id, shape_id):
+	return os.path.join(conf.baseproxypath, proxy_id, conf.path_timeindex, meta_id, shape_id)
+
+
+def parseTime (value, endofday=False):
+	"""
+	Converts an ISO 8601 date or datetime (UTC) to seconds from the epoch
+	:param value: string
+	:param endofday: if True a date without a time is taken as the last second of the day, for the end of a range
+	:return: float, None if the value is not a date
+	"""
+
+	try:
+		text = value.strip()
+	except AttributeError:
+		return None
+
+	for timeformat in TIME_FORMATS:
+		try:
+			parsed = time.strptime(text, timeformat)
+		except ValueError:
+			continue
+		seconds = float(calendar.timegm(parsed))
+		if endofday and timeformat in DATE_FORMATS:
+			seconds += DAY_SECONDS - 1
+		return seconds
+
+	return None
+
+
+def parseTimeFilter (timefilter):
+	"""
+	Validates the time of a query message: an ISO 8601 interval "start/end", where either end can be empty or ".." for an open interval, or a single date. An end given as a date without a time includes the whole day
+	:param timefilter: string
+	:return: tuple (start, end) in seconds from the epoch, None for open ends
+	"""
+
+	try:
+		parts = timefilter.split("/")
+	except AttributeError:
+		raise InvalidQueryException ("Non valid time filter %s" % (timefilter,))
+
+	if len(parts) == 1:
+		parts = [parts[0], parts[0]]
+	if len(parts) != 2:
+		raise InvalidQueryException ("Non valid time filter %s, expected start/end" % timefilter)
+
+	bounds = []
+	for position, part in enumerate(parts):
+		if part.strip() in ("", ".."):
+			bounds.append(None)
+			continue
+		parsed = parseTime(part, endofday=(position == 1))
+		if parsed is None:
+			raise InvalidQueryException ("Non valid date %s in time filter %s" % (part, timefilter))
+		bounds.append(parsed)
+
+	if bounds[0] is not None and bounds[1] is not None and bounds[0] > bounds[1]:
+		raise InvalidQueryException ("Non valid time filter %s, start after end" % timefilter)
+
+	return tuple(bounds)
+
+
+def inTimeRange (start, end, timerange):
+	"""
+	Checks if an interval overlaps a time filter
+	:param start: seconds from the epoch
+	:param end: seconds from the epoch
+	:param timerange: tuple as returned by parseTimeFilter
+	:return: boolean
+	"""
+
+	if timerange[0] is not None and end < timerange[0]:
+		return False
+	if timerange[1] is not None and start > timerange[1]:
+		return False
+	return True
+
+
+def isMetaInTimeRange (metainfo, timerange):
+	"""
+	Checks the time range of a meta in the manifest against a time filter; metas without a (valid) time range always match
+	:param metainfo: manifest entry of the meta
+	:param timerange: tuple as returned by parseTimeFilter
+	:return: boolean
+	"""
+
+	try:
+		start, end = metainfo['time']
+		start, end = parseTime(start), parseTime(end, endofday=True)
+	except (KeyError, TypeError, ValueError):
+		return True
+
+	if start is None or end is None:
+		return True
+
+	return inTimeRange(start, end, timerange)
+
+
+def getFeatureTime (properties):
+	"""
+	Finds the time of a feature in its attributes (see conf.time_attributes)
+	:param properties: dict, attributes of the feature
+	:return: float seconds from the epoch, None if the feature has no time
+	"""
+
+	if not properties:
+		return None
+
+	for name in conf.time_attributes:
+		for key, value in properties.items():
+			if key.lower() == name:
+				featuretime = parseTime(value)
+				if featuretime is not None:
+					return featuretime
+
+	return None
+
+
+def getValueKey (value):
+	"""
+	Key of an attribute value in the inventory summaries and counts, the value prefixed by its type, so that values of different types are counted apart: "s:" strings, "i:" integers, "f:" floats, "b:" booleans, "j:" anything else (as json)
+	:param value:
+	:return: string
+	"""
+
+	if isinstance(value, str):
+		return "s:" + value
+	try:
+		if isinstance(value, unicode):
+			return u"s:" + value
+		if isinstance(value, long):
+			return "i:%d" % value
+	except NameError:
+		pass
+	if isinstance(value, bool):
+		return "b:" + proxy_json.dumps(value)
+	if isinstance(value, int):
+		return "i:%d" % value
+	if isinstance(value, float):
+		return "f:" + repr(value)
+	return "j:" + proxy_json.dumps(value)
+
+
+class SummaryIndexBuilder ():
+	"""
+	Collects the inventory summary and the time index of a shape while its geojson file is written (see proxy_spatial.SpatialIndexBuilder, same usage)
+	"""
+
+	def __init__ (self, proxy_id, meta_id, shape_id, maxvalues=None):
+
+		if maxvalues is None:
+			maxvalues = conf.inventory_max_values
+
+		self.path_summary = getSummaryPath(proxy_id, meta_id, shape_id)
+		self.path_timeindex = getTimeIndexPath(proxy_id, meta_id, shape_id)
+		self.maxvalues = maxvalues
+
+		self.count = 0
+		self.attributes = {}
+		self.timed = []
+		self.untimed = []
+
+	def add (self, fid, featurejson, offset, length):
+		"""
+		Records the attributes and the time of a feature written to the geojson file
+		:param fid:
+		:param featurejson: geojson string or dict of the feature
+		:param offset: byte offset of the feature in the geojson file
+		:param length: byte length of the feature
+		:return:
+		"""
+
+		if isinstance(featurejson, dict):
+			feature = featurejson
+		else:
+			feature = proxy_json.loads(featurejson)
+
+		properties = feature.get('properties') or {}
+
+		# attributes missing from some features are counted as nulls for those, so that count = nulls + values + others always holds
+		for name in properties:
+			if name not in self.attributes:
+				self.attributes[name] = {
+					'values': {},
+					'others': 0,
+					'nulls': self.count
+				}
+		for name, summary in self.attributes.items():
+			value = properties.get(name)
+			if value is None:
+				summary['nulls'] += 1
+				continue
+			key = getValueKey(value)
+			if key in summary['values']:
+				summary['values'][key] += 1
+			elif len(summary['values']) < self.maxvalues:
+				summary['values'][key] = 1
+			else:
+				summary['others'] += 1
+
+		featuretime = getFeatureTime(properties)
+		if featuretime is None:
+			self.untimed.append((offset, length))
+		else:
+			self.timed.append((featuretime, offset, length))
+
+		self.count += 1
+
+	def commit (self, path_gj):
+		"""
+		Writes the summary and the time index aside; they must be published (see publish) when the geojson file they refer to is published
+		:param path_gj: the geojson file that has just been written
+		:return:
+		"""
+
+		for path in (self.path_summary, self.path_timeindex):
+			if not os.path.exists(os.path.dirname(path)):
+				os.makedirs(os.path.dirname(path))
+
+		stat = os.stat(path_gj)
+		self.timed.sort()
+
+		timerange = None
+		if len(self.timed) > 0:
+			timerange = [self.timed[0][0], self.timed[-1][0]]
+
+		summary = {
+			'format': SUMMARY_FORMAT,
+			'source': [stat.st_ino, stat.st_size],
+			'count': self.count,
+			'attributes': self.attributes,
+			'time': timerange,
+			'untimed': len(self.untimed)
+		}
+
+		summary_fp = proxy_json.openText(proxy_publish.getTempFilePath(self.path_summary), 'w')
+		try:
+			summary_fp.write(proxy_json.dumps(summary))
+		finally:
+			summary_fp.close()
+
+		index_fp = open(proxy_publish.getTempFilePath(self.path_timeindex), 'wb')
+		try:
+			index_fp.write(HEADER.pack(MAGIC, VERSION, len(self.timed), len(self.untimed), stat.st_ino, stat.st_size))
+			for featuretime, offset, length in self.timed:
+				index_fp.write(TIMED.pack(featuretime, offset, length))
+			for offset, length in self.untimed:
+				index_fp.write(UNTIMED.pack(offset, length))
+		finally:
+			index_fp.close()
+
+		self.attributes = {}
+		self.timed = []
+		self.untimed = []
+
+	def publish (self):
+
+		for path in (self.path_summary, self.path_timeindex):
+			proxy_publish.publishFile(proxy_publish.getTempFilePath(path), path)
+
+	def discard (self):
+
+		self.attributes = {}
+		self.timed = []
+		self.untimed = []
+		for path in (self.path_summary, self.path_timeindex):
+			if os.path.exists(proxy_publish.getTempFilePath(path)):
+				os.remove(proxy_publish.getTempFilePath(path))
+
+
+def removeShapeSummary (proxy_id, meta_id, shape_id):
+
+	for path in (getSummaryPath(proxy_id, meta_id, shape_id), getTimeIndexPath(proxy_id, meta_id, shape_id)):
+		if os.path.exists(path):
+			os.remove(path)
+
+
+def loadShapeSummary (proxy_id, meta_id, shape_id):
+	"""
+	Reads the inventory summary of a shape, if it refers to the published geojson file of the shape and has the current format
+	:param proxy_id:
+	:param meta_id:
+	:param shape_id:
+	:return: dict, None if there is no usable summary
+	"""
+
+	path_gj = os.path.join(conf.baseproxypath, proxy_id, conf.path_geojson, meta_id, shape_id)
+
+	try:
+		summary_fp = proxy_json.openText(getSummaryPath(proxy_id, meta_id, shape_id), 'r')
+	except IOError:
+		return None
+	try:
+		summary = proxy_json.loads(summary_fp.read())
+	except ValueError:
+		return None
+	finally:
+		summary_fp.close()
+
+	stat = os.stat(path_gj)
+	if summary.get('format') != SUMMARY_FORMAT or summary.get('source') != [stat.st_ino, stat.st_size]:
+		return None
+
+	return summary
+
+
+def summarizeShape (proxy_id, meta_id, shape_id):
+	"""
+	Builds the inventory summary of a shape without a usable summary, from its geojson file
+	:param proxy_id:
+	:param meta_id:
+	:param shape_id:
+	:return: dict, as the stored summaries
+	"""
+
+	path_gj = os.path.join(conf.baseproxypath, proxy_id, conf.path_geojson, meta_id, shape_id)
+	builder = SummaryIndexBuilder(proxy_id, meta_id, shape_id)
+
+	gj_fp = open(path_gj, 'rb')
+	try:
+		collection = proxy_json.loads(gj_fp.read().decode('utf-8'))
+		for feature in collection.get('features', []):
+			builder.add(feature.get('id'), feature, 0, 0)
+	finally:
+		gj_fp.close()
+
+	return {
+		'count': builder.count,
+		'attributes': builder.attributes
+	}
+
+
+def getRequestedValues (inventory):
+	"""
+	Checks an inventory query and returns the values requested for each attribute
+	:param inventory: dict with the attribute names as keys and, as values, the list of attribute values to count (an empty list or None counts all the values)
+	:return: dict with the attribute names as keys and the list of the requested value keys (see getValueKey) as values, None for all the values
+	"""
+
+	if not isinstance(inventory, dict):
+		raise InvalidQueryException ("Non valid inventory query %s" % (inventory,))
+
+	requested = {}
+	for name, values in inventory.items():
+		if values is not None and not isinstance(values, list):
+			values = [values]
+		if values:
+			requested[name] = [getValueKey(value) for value in values]
+		else:
+			requested[name] = None
+
+	return requested
+
+
+def getOverflowKeys (summary, inventory):
+	"""
+	Returns the requested values that a shape summary cannot count exactly, as they may be among the values beyond conf.inventory_max_values of its attributes
+	:param summary: shape summary
+	:param inventory: dict, see countInventory
+	:return: dict with the attribute names as keys and the list of the value keys to count as values, None for all the values; empty if the summary answers the query exactly
+	"""
+
+	overflow = {}
+	for name, keys in getRequestedValues(inventory).items():
+		attribute = summary['attributes'].get(name)
+		if attribute is None or attribute['others'] == 0:
+			continue
+		if keys is None:
+			overflow[name] = None
+		else:
+			missing = [key for key in keys if key not in attribute['values']]
+			if len(missing) > 0:
+				overflow[name] = missing
+
+	return overflow
+
+
+def completeSummary (summary, overflow, features):
+	"""
+	Counts the values of a shape that its summary could not count (see getOverflowKeys) by reading all its features
+	:param summary: shape summary
+	:param overflow: dict, as returned by getOverflowKeys
+	:param features: iterable of the geojson strings or dicts of the features of the shape
+	:return: a copy of the summary, with the values of overflow counted exactly
+	"""
+
+	counts = dict((name, {}) for name in overflow)
+	for feature in features:
+		if not isinstance(feature, dict):
+			feature = proxy_json.loads(feature)
+		properties = feature.get('properties') or {}
+		for name, keys in overflow.items():
+			value = properties.get(name)
+			if value is None:
+				continue
+			key = getValueKey(value)
+			if keys is None or key in keys:
+				counts[name][key] = counts[name].get(key, 0) + 1
+
+	completed = dict(summary)
+	completed['attributes'] = dict(summary['attributes'])
+	for name, keys in overflow.items():
+		attribute = dict(summary['attributes'][name])
+		if keys is None:
+			attribute['values'] = counts[name]
+			attribute['others'] = 0
+		else:
+			attribute['values'] = dict(attribute['values'])
+			for key in keys:
+				attribute['values'][key] = counts[name].get(key, 0)
+				attribute['others'] -= counts[name].get(key, 0)
+		completed['attributes'][name] = attribute
+
+	return completed
+
+
+def countInventory (summaries, inventory):
+	"""
+	Answers an inventory query from the summaries of the shapes of a meta. The counts are exact only if no summary has overflowing values for the query, see getOverflowKeys and completeSummary
+	:param summaries: list of shape summaries
+	:param inventory: dict with the attribute names as keys and, as values, the list of attribute values to count (an empty list or None counts all the values)
+	:return: dict with the total number of features ('count') and, in 'attributes', for each requested attribute a dict with the number of features by value key ('values', see getValueKey) and the number of features without the attribute ('nulls')
+	"""
+
+	total = sum(summary['count'] for summary in summaries)
+
+	attributes = {}
+	for name, keys in getRequestedValues(inventory).items():
+		counts = {
+			'values': {},
+			'nulls': 0
+		}
+		for summary in summaries:
+			attribute = summary['attributes'].get(name)
+			if attribute is None:
+				counts['nulls'] += summary['count']
+				continue
+			counts['nulls'] += attribute['nulls']
+			if keys is not None:
+				for key in keys:
+					counts['values'][key] = counts['values'].get(key, 0) + attribute['values'].get(key, 0)
+			else:
+				for key, count in attribute['values'].items():
+					counts['values'][key] = counts['values'].get(key, 0) + count
+
+		attributes[name] = counts
+
+	return {
+		'count': total,
+		'attributes': attributes
+	}
+
+
+def openTimeIndex (path_index, gj_fp):
+	"""
+	Maps a time index file, if it refers to the given geojson file
+	:param path_index:
+	:param gj_fp: geojson file open for reading
+	:return: mmap of the index, None if there is no usable index
+	"""
+
+	try:
+		index_fp = open(path_index, 'rb')
+	except IOError:
+		return None
+
+	try:
+		if os.fstat(index_fp.fileno()).st_size < HEADER.size:
+			return None
+		index = mmap.mmap(index_fp.fileno(), 0, access=mmap.ACCESS_READ)
+	finally:
+		index_fp.close()
+
+	magic, version, timed, untimed, ino, size = HEADER.unpack_from(index, 0)
+	stat = os.fstat(gj_fp.fileno())
+	if magic != MAGIC or version != VERSION or ino != stat.st_ino or size != stat.st_size:
+		index.close()
+		return None
+
+	return index
+
+
+class TimedEntries ():
+	"""
+	Sequence view of the times in a time index, for bisect
+	"""
+
+	def __init__ (self, index, count):
+		self.index = index
+		self.count = count
+
+	def __len__ (self):
+		return self.count
+
+	def __getitem__ (self, position):
+		return TIMED.unpack_from(self.index, HEADER.size + TIMED.size * position)[0]
+
+
+def searchTimeIndex (index, timerange, includeuntimed):
+	"""
+	Finds the features of a time index in a time range
+	:param index: buffer with the content of a time index file
+	:param timerange: tuple as returned by parseTimeFilter
+	:param includeuntimed: if the features without a time match
+	:return: list of (offset, length) of the matching features, in file order
+	"""
+
+	magic, version, timed, untimed, ino, size = HEADER.unpack_from(index, 0)
+
+	entries = TimedEntries(index, timed)
+	first = 0
+	last = timed
+	if timerange[0] is not None:
+		first = bisect.bisect_left(entries, timerange[0])
+	if timerange[1] is not None:
+		last = bisect.bisect_right(entries, timerange[1])
+
+	matches = []
+	for position in range (first, last):
+		matches.append(TIMED.unpack_from(index, HEADER.size + TIMED.size * position)[1:])
+
+	if includeuntimed:
+		untimedstart = HEADER.size + TIMED.size * timed
+		for position in range (0, untimed):
+			matches.append(UNTIMED.unpack_from(index, untimedstart + UNTIMED.size * position))
+
+	return sorted(matches)
+
+
+def searchShapeTime (proxy_id, meta_id, shape_id, timerange, includeuntimed):
+	"""
+	Finds the features of a replicated shape in a time range. Shapes without a valid index are searched by reading their geojson file
+	:param proxy_id:
+	:param meta_id:
+	:param shape_id:
+	:param timerange: tuple as returned by parseTimeFilter
+	:param includeuntimed: if the features without a time match (see isMetaInTimeRange)
+	:return: list of the matching features (dicts)
+	"""
+
+	path_gj = os.path.join(conf.baseproxypath, proxy_id, conf.path_geojson, meta_id, shape_id)
+
+	gj_fp = open(path_gj, 'rb')
+	try:
+		index = openTimeIndex(getTimeIndexPath(proxy_id, meta_id, shape_id), gj_fp)
+		if index is None:
+			return scanShapeTime(gj_fp, timerange, includeuntimed)
+
+		try:
+			matches = searchTimeIndex(index, timerange, includeuntimed)
+		finally:
+			index.close()
+
+		return proxy_spatial.readIndexedFeatures(gj_fp, matches)
+	finally:
+		gj_fp.close()
+
+
+def scanShapeTime (gj_fp, timerange, includeuntimed):
+	"""
+	Fallback for searchShapeTime, filters all the features of a geojson file
+	:param gj_fp: geojson file open for reading
+	:param timerange: tuple as returned by parseTimeFilter
+	:param includeuntimed: if the features without a time match
+	:return: list of the matching features (dicts)
+	"""
+
+	gj_fp.seek(0)
+	collection = proxy_json.loads(gj_fp.read().decode('utf-8'))
+
+	features = []
+	for feature in collection.get('features', []):
+		featuretime = getFeatureTime(feature.get('properties'))
+		if featuretime is None:
+			if includeuntimed:
+				features.append(feature)
+		elif inTimeRange(featuretime, featuretime, timerange):
+			features.append(feature)
+
+	return features
@@ -0,0 +1,285 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+__author__ = 'Antonio Vaccarino'
+__docformat__ = 'restructuredtext en'
+
+import os
+import time
+import errno
+import select
+import struct
+import threading
+import ctypes
+import ctypes.util
+
+try:
+	import Queue as queue
+except ImportError:
+	import queue
+
+from errors import *
+import proxy_config_core as conf
+
+"""
+Native watcher for the upload tree and event coalescing.
+A single upload fires several create/modify events on the same $upload/$proxy/$meta/$shape.zip; the coalescer merges them and hands the path to the handler only once the file has been quiet for conf.watch_quiet_period seconds. Whether the result is an upsert or a delete is decided by the handler on the final state of the file. Different shapes are handled concurrently, events for the same shape are never handled in parallel.
+"""
+
+# inotify constants from sys/inotify.h
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0x00000800
+
+WATCH_MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF
+
+EVENT_HEADER = struct.Struct("iIII")
+
+# depth of the shape archives below the upload root: $proxy/$meta/$shape.zip
+SHAPE_DEPTH = 3
+
+
+class EventCoalescer ():
+	"""
+	Debounces file events per path and dispatches the quiet paths to a pool of worker threads
+	"""
+
+	def __init__ (self, handler, quiet=None, workers=None):
+
+		if quiet is None:
+			quiet = conf.watch_quiet_period
+		if workers is None:
+			workers = conf.event_workers
+
+		self.handler = handler
+		self.quiet = quiet
+
+		# path -> time of the latest event received
+		self.pending = {}
+		# paths currently being handled, further events on them wait in pending
+		self.running = set()
+
+		self.condition = threading.Condition()
+		self.ready = queue.Queue()
+		self.flushing = False
+		self.stopped = False
+
+		self.scheduler = threading.Thread(target=self.scheduleLoop)
+		self.scheduler.daemon = True
+
+		self.workers = []
+		for i in range (0, max(1, workers)):
+			worker = threading.Thread(target=self.workerLoop)
+			worker.daemon = True
+			self.workers.append(worker)
+
+	def start (self):
+		self.scheduler.start()
+		for worker in self.workers:
+			worker.start()
+
+	def addEvent (self, eventpath):
+		"""
+		Records an event on a path, postponing its handling until the path is quiet
+		:param eventpath:
+		:return:
+		"""
+
+		with self.condition:
+			self.pending[eventpath] = time.time()
+			self.condition.notify_all()
+
+	def scheduleLoop (self):
+		"""
+		Moves the paths that have been quiet long enough (and are not being handled) to the workers queue
+		:return:
+		"""
+
+		with self.condition:
+			while not self.stopped:
+				now = time.time()
+				quiet = 0 if self.flushing else self.quiet
+				nextcheck = None
+
+				for eventpath, eventtime in list(self.pending.items()):
+					if eventpath in self.running:
+						continue
+					due = eventtime + quiet
+					if due <= now:
+						del self.pending[eventpath]
+						self.running.add(eventpath)
+						self.ready.put(eventpath)
+					elif nextcheck is None or due < nextcheck:
+						nextcheck = due
+
+				if nextcheck is None:
+					self.condition.wait()
+				else:
+					self.condition.wait(nextcheck - now)
+
+	def workerLoop (self):
+
+		while True:
+			eventpath = self.ready.get()
+			if eventpath is None:
+				break
+			# the handler is expected to log its own failures (as ProxyFS.handleFSChange does), this only protects the worker
+			try:
+				self.handler(eventpath)
+			except Exception:
+				pass
+			finally:
+				with self.condition:
+					self.running.discard(eventpath)
+					self.condition.notify_all()
+
+	def stop (self):
+		"""
+		Handles all the pending paths without waiting for them to be quiet, then stops the threads
+		:return:
+		"""
+
+		with self.condition:
+			self.flushing = True
+			self.condition.notify_all()
+			while len(self.pending) > 0 or len(self.running) > 0:
+				self.condition.wait()
+			self.stopped = True
+			self.condition.notify_all()
+
+		self.scheduler.join()
+		for worker in self.workers:
+			self.ready.put(None)
+		for worker in self.workers:
+			worker.join()
+
+
+class UploadWatcher ():
+	"""
+	Watches the upload tree with inotify and reports the events on shape archives to a callback (usually EventCoalescer.addEvent). New proxy and meta directories are added to the watch automatically
+	"""
+
+	def __init__ (self, callback, uploadpath=None):
+
+		if uploadpath is None:
+			uploadpath = conf.baseuploadpath
+
+		self.callback = callback
+		self.uploadpath = os.path.realpath(uploadpath)
+
+		libcname = ctypes.util.find_library('c')
+		if libcname is None:
+			raise InternalProxyException ("Could not find the C library for inotify support")
+		self.libc = ctypes.CDLL(libcname, use_errno=True)
+
+		self.fd = self.libc.inotify_init1(IN_NONBLOCK)
+		if self.fd < 0:
+			raise InternalProxyException ("Could not initialize inotify (errno %s)" % ctypes.get_errno())
+
+		# watch descriptor -> (directory path, depth below the upload root)
+		self.watches = {}
+		self.stopped = False
+		self.thread = None
+
+	def addWatch (self, dirpath, depth):
+		"""
+		Watches a directory and, up to the meta level, its subdirectories. Archives already present in the meta directories are reported, since they may have been written before the watch was in place
+		:param dirpath:
+		:param depth: 0 for the upload root, 1 for proxies, 2 for metas
+		:return:
+		"""
+
+		wd = self.libc.inotify_add_watch(self.fd, dirpath.encode('utf-8'), WATCH_MASK)
+		if wd < 0:
+			# the directory may have been removed in the meantime
+			return
+		self.watches[wd] = (dirpath, depth)
+
+		try:
+			entries = os.listdir(dirpath)
+		except OSError:
+			return
+
+		for entry in entries:
+			entrypath = os.path.join(dirpath, entry)
+			if depth < SHAPE_DEPTH - 1 and os.path.isdir(entrypath):
+				self.addWatch(entrypath, depth + 1)
+			elif depth == SHAPE_DEPTH - 1 and entry.endswith(".zip"):
+				self.callback(entrypath)
+
+	def readEvents (self):
+		"""
+		Reads and dispatches all the events available on the inotify descriptor
+		:return:
+		"""
+
+		try:
+			buf = os.read(self.fd, 65536)
+		except OSError as ex:
+			if ex.errno == errno.EAGAIN:
+				return
+			raise
+
+		offset = 0
+		while offset < len(buf):
+			wd, mask, cookie, namelen = EVENT_HEADER.unpack_from(buf, offset)
+			offset += EVENT_HEADER.size
+			name = buf[offset:offset+namelen].rstrip(b"\0").decode('utf-8')
+			offset += namelen
+
+			if mask & IN_Q_OVERFLOW:
+				# we lost events: rebuild the watches and report every archive in the tree
+				self.rescan()
+				continue
+
+			if mask & IN_IGNORED:
+				self.watches.pop(wd, None)
+				continue
+
+			if wd not in self.watches:
+				continue
+
+			dirpath, depth = self.watches[wd]
+			eventpath = os.path.join(dirpath, name)
+
+			if mask & IN_ISDIR:
+				if depth < SHAPE_DEPTH - 1 and mask & (IN_CREATE | IN_MOVED_TO):
+					self.addWatch(eventpath, depth + 1)
+			elif depth == SHAPE_DEPTH - 1 and name.endswith(".zip"):
+				self.callback(eventpath)
+
+	def rescan (self):
+
+		for wd in list(self.watches.keys()):
+			self.libc.inotify_rm_watch(self.fd, wd)
+		self.watches = {}
+		self.addWatch(self.uploadpath, 0)
+
+	def watchLoop (self):
+
+		while not self.stopped:
+			readable, writable, errored = select.select([self.fd], [], [], 0.5)
+			if readable:
+				self.readEvents()
+
+	def start (self):
+
+		self.addWatch(self.uploadpath, 0)
+		self.thread = threading.Thread(target=self.watchLoop)
+		self.thread.daemon = True
+		self.thread.start()
+
+	def stop (self):
+
+		self.stopped = True
+		if self.thread is not None:
+			self.thread.join()
+		os.close(self.fd)